@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+# pytest plugin for the testbench matrix:
+#  - records per-test wall time and simulated time (--store-test-times);
+#    sim time only for testbenches that run through mqnic_tb.run_sim, those
+#    calling cocotb_test.simulator.run directly record wall time only
+#  - runs the longest tests first, so xdist workers finish together
+#  - "smoke" profile: a covering subset of each parametrization
+#    (--test-profile=smoke or MQNIC_TEST_PROFILE=smoke)
+
+import json
+import os
+import sys
+
+import pytest
+
+TEST_TIMES_FILE = ".test_times"
+# pytest-split durations, used for wall time of tests without recorded times
+TEST_DURATIONS_FILE = ".test_durations"
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("mqnic")
+    group.addoption("--test-profile", choices=["full", "smoke"],
+        default=os.getenv("MQNIC_TEST_PROFILE", "full"),
+        help="full parameter matrix, or a subset covering every parameter value (smoke)")
+    group.addoption("--store-test-times", action="store_true", default=False,
+        help=f"store per-test wall and sim time in {TEST_TIMES_FILE}")
+    group.addoption("--test-times-path", default=None,
+        help=f"test times file (default: {TEST_TIMES_FILE} in rootdir)")
+    group.addoption("--no-longest-first", action="store_true", default=False,
+        help="keep collection order instead of running the longest tests first")
+
+
+def pytest_configure(config):
+    config.pluginmanager.register(TestTimes(config), "mqnic_test_times")
+
+
+def smoke_subset(items, times):
+    # greedy set cover over (parameter, value) pairs, preferring short tests
+    def pairs(item):
+        return {(k, repr(v)) for k, v in item.callspec.params.items()}
+
+    uncovered = set().union(*(pairs(item) for item in items))
+    remaining = list(items)
+    selected = []
+
+    while uncovered:
+        best = min(remaining, key=lambda item: (-len(pairs(item) & uncovered),
+            times.get(item.nodeid, {}).get('wall', 0)))
+        remaining.remove(best)
+        selected.append(best)
+        uncovered -= pairs(best)
+
+    return selected
+
+
+class TestTimes:
+    __test__ = False
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config.getoption("test_times_path") or os.path.join(str(config.rootpath), TEST_TIMES_FILE)
+        self.times = self.load()
+        self.new_times = {}
+
+    def load(self):
+        # {nodeid: {'wall': seconds, 'sim_ns': ns}}
+        times = {}
+
+        path = os.path.join(str(self.config.rootpath), TEST_DURATIONS_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                durations = json.load(f)
+            if isinstance(durations, list):
+                durations = dict(durations)
+            for nodeid, wall in durations.items():
+                times[nodeid] = {'wall': wall}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                times.update(json.load(f))
+
+        return times
+
+    def get_wall(self, nodeid, default=0):
+        return self.times.get(nodeid, {}).get('wall', default)
+
+    def pytest_collection_modifyitems(self, session, config, items):
+        if config.getoption("test_profile") == "smoke":
+            # group parametrized items by test function
+            groups = {}
+            for item in items:
+                if hasattr(item, "callspec"):
+                    groups.setdefault((str(item.fspath), item.originalname), []).append(item)
+
+            keep = set()
+            for group in groups.values():
+                keep.update(id(item) for item in smoke_subset(group, self.times))
+
+            deselected = [item for item in items if hasattr(item, "callspec") and id(item) not in keep]
+            if deselected:
+                config.hook.pytest_deselected(items=deselected)
+                items[:] = [item for item in items if not hasattr(item, "callspec") or id(item) in keep]
+
+        if not config.getoption("no_longest_first"):
+            # unknown tests count as average; stable sort, so all xdist workers agree
+            known = [t['wall'] for t in self.times.values() if 'wall' in t]
+            default = sum(known) / len(known) if known else 0
+            items.sort(key=lambda item: -self.get_wall(item.nodeid, default))
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        report = outcome.get_result()
+
+        if call.when == "call":
+            # sim time of the last mqnic_tb.run_sim call in this process
+            mqnic_tb = sys.modules.get("mqnic_tb")
+            if mqnic_tb is not None and getattr(mqnic_tb, 'sim_time_ns', None) is not None:
+                report.user_properties.append(("sim_time_ns", mqnic_tb.sim_time_ns))
+                mqnic_tb.sim_time_ns = None
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != "call" or not report.passed:
+            return
+
+        entry = {'wall': report.duration}
+        for name, value in report.user_properties:
+            if name == "sim_time_ns":
+                entry['sim_ns'] = value
+        self.new_times[report.nodeid] = entry
+
+    def pytest_sessionfinish(self, session):
+        # xdist workers report to the controller, which writes the file
+        if hasattr(self.config, "workerinput") or not self.config.getoption("store_test_times"):
+            return
+
+        if not self.new_times:
+            return
+
+        times = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                times = json.load(f)
+        times.update(self.new_times)
+
+        with open(self.path, 'w') as f:
+            json.dump(times, f, indent=2, sort_keys=True)
+            f.write("\n")
@@ -0,0 +1 @@
+../../../../common/tb/mqnic_loopback.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../../common/tb/mqnic_tb.py
\ No newline at end of file
@@ -1,7 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2021-2023 The Regents of the University of California
 
-import logging
 import os
 import struct
 import sys
@@ -10,445 +9,44 @@ import scapy.utils
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP, UDP
 
-import cocotb_test.simulator
 import pytest
 
 import cocotb
-from cocotb.log import SimLog
-from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge, FallingEdge, Timer
-
-from cocotbext.axi import AxiStreamBus
-from cocotbext.axi import AxiSlave, AxiBus, SparseMemoryRegion
-from cocotbext.eth import EthMac
-from cocotbext.pcie.core import RootComplex
+from cocotb.triggers import RisingEdge, Timer
+
 from cocotbext.pcie.xilinx.us import UltraScalePlusPcieDevice
 
 try:
     import mqnic
+    import mqnic_tb
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_tb
     finally:
         del sys.path[0]
 
 
-class TB(object):
-    def __init__(self, dut, msix_count=32):
-        self.dut = dut
-
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
+class TB(mqnic_tb.BaseTB):
+    def __init__(self, dut):
+        super().__init__(dut)
 
         # PCIe
-        self.rc = RootComplex()
-
-        self.rc.max_payload_size = 0x1  # 256 bytes
-        self.rc.max_read_request_size = 0x2  # 512 bytes
-
-        self.dev = UltraScalePlusPcieDevice(
-            # configuration options
-            pcie_generation=3,
-            # pcie_link_width=16,
-            user_clk_frequency=250e6,
-            alignment="dword",
-            cq_straddle=len(dut.pcie_if_inst.pcie_us_if_cq_inst.rx_req_tlp_valid_reg) > 1,
-            cc_straddle=len(dut.pcie_if_inst.pcie_us_if_cc_inst.out_tlp_valid) > 1,
-            rq_straddle=len(dut.pcie_if_inst.pcie_us_if_rq_inst.out_tlp_valid) > 1,
-            rc_straddle=len(dut.pcie_if_inst.pcie_us_if_rc_inst.rx_cpl_tlp_valid_reg) > 1,
-            rc_4tlp_straddle=len(dut.pcie_if_inst.pcie_us_if_rc_inst.rx_cpl_tlp_valid_reg) > 2,
-            pf_count=1,
-            max_payload_size=1024,
-            enable_client_tag=True,
-            enable_extended_tag=True,
-            enable_parity=False,
-            enable_rx_msg_interface=False,
-            enable_sriov=False,
-            enable_extended_configuration=False,
-
-            pf0_msi_enable=False,
-            pf0_msi_count=32,
-            pf1_msi_enable=False,
-            pf1_msi_count=1,
-            pf2_msi_enable=False,
-            pf2_msi_count=1,
-            pf3_msi_enable=False,
-            pf3_msi_count=1,
-            pf0_msix_enable=True,
-            pf0_msix_table_size=msix_count-1,
-            pf0_msix_table_bir=0,
-            pf0_msix_table_offset=0x00010000,
-            pf0_msix_pba_bir=0,
-            pf0_msix_pba_offset=0x00018000,
-            pf1_msix_enable=False,
-            pf1_msix_table_size=0,
-            pf1_msix_table_bir=0,
-            pf1_msix_table_offset=0x00000000,
-            pf1_msix_pba_bir=0,
-            pf1_msix_pba_offset=0x00000000,
-            pf2_msix_enable=False,
-            pf2_msix_table_size=0,
-            pf2_msix_table_bir=0,
-            pf2_msix_table_offset=0x00000000,
-            pf2_msix_pba_bir=0,
-            pf2_msix_pba_offset=0x00000000,
-            pf3_msix_enable=False,
-            pf3_msix_table_size=0,
-            pf3_msix_table_bir=0,
-            pf3_msix_table_offset=0x00000000,
-            pf3_msix_pba_bir=0,
-            pf3_msix_pba_offset=0x00000000,
-
-            # signals
-            # Clock and Reset Interface
-            user_clk=dut.clk,
-            user_reset=dut.rst,
-            # user_lnk_up
-            # sys_clk
-            # sys_clk_gt
-            # sys_reset
-            # phy_rdy_out
-
-            # Requester reQuest Interface
-            rq_bus=AxiStreamBus.from_prefix(dut, "m_axis_rq"),
-            pcie_rq_seq_num0=dut.s_axis_rq_seq_num_0,
-            pcie_rq_seq_num_vld0=dut.s_axis_rq_seq_num_valid_0,
-            pcie_rq_seq_num1=dut.s_axis_rq_seq_num_1,
-            pcie_rq_seq_num_vld1=dut.s_axis_rq_seq_num_valid_1,
-            # pcie_rq_tag0
-            # pcie_rq_tag1
-            # pcie_rq_tag_av
-            # pcie_rq_tag_vld0
-            # pcie_rq_tag_vld1
-
-            # Requester Completion Interface
-            rc_bus=AxiStreamBus.from_prefix(dut, "s_axis_rc"),
-
-            # Completer reQuest Interface
-            cq_bus=AxiStreamBus.from_prefix(dut, "s_axis_cq"),
-            # pcie_cq_np_req
-            # pcie_cq_np_req_count
-
-            # Completer Completion Interface
-            cc_bus=AxiStreamBus.from_prefix(dut, "m_axis_cc"),
-
-            # Transmit Flow Control Interface
-            # pcie_tfc_nph_av=dut.pcie_tfc_nph_av,
-            # pcie_tfc_npd_av=dut.pcie_tfc_npd_av,
-
-            # Configuration Management Interface
-            cfg_mgmt_addr=dut.cfg_mgmt_addr,
-            cfg_mgmt_function_number=dut.cfg_mgmt_function_number,
-            cfg_mgmt_write=dut.cfg_mgmt_write,
-            cfg_mgmt_write_data=dut.cfg_mgmt_write_data,
-            cfg_mgmt_byte_enable=dut.cfg_mgmt_byte_enable,
-            cfg_mgmt_read=dut.cfg_mgmt_read,
-            cfg_mgmt_read_data=dut.cfg_mgmt_read_data,
-            cfg_mgmt_read_write_done=dut.cfg_mgmt_read_write_done,
-            # cfg_mgmt_debug_access
-
-            # Configuration Status Interface
-            # cfg_phy_link_down
-            # cfg_phy_link_status
-            # cfg_negotiated_width
-            # cfg_current_speed
-            cfg_max_payload=dut.cfg_max_payload,
-            cfg_max_read_req=dut.cfg_max_read_req,
-            # cfg_function_status
-            # cfg_vf_status
-            # cfg_function_power_state
-            # cfg_vf_power_state
-            # cfg_link_power_state
-            # cfg_err_cor_out
-            # cfg_err_nonfatal_out
-            # cfg_err_fatal_out
-            # cfg_local_error_out
-            # cfg_local_error_valid
-            # cfg_rx_pm_state
-            # cfg_tx_pm_state
-            # cfg_ltssm_state
-            cfg_rcb_status=dut.cfg_rcb_status,
-            # cfg_obff_enable
-            # cfg_pl_status_change
-            # cfg_tph_requester_enable
-            # cfg_tph_st_mode
-            # cfg_vf_tph_requester_enable
-            # cfg_vf_tph_st_mode
-
-            # Configuration Received Message Interface
-            # cfg_msg_received
-            # cfg_msg_received_data
-            # cfg_msg_received_type
-
-            # Configuration Transmit Message Interface
-            # cfg_msg_transmit
-            # cfg_msg_transmit_type
-            # cfg_msg_transmit_data
-            # cfg_msg_transmit_done
-
-            # Configuration Flow Control Interface
-            cfg_fc_ph=dut.cfg_fc_ph,
-            cfg_fc_pd=dut.cfg_fc_pd,
-            cfg_fc_nph=dut.cfg_fc_nph,
-            cfg_fc_npd=dut.cfg_fc_npd,
-            cfg_fc_cplh=dut.cfg_fc_cplh,
-            cfg_fc_cpld=dut.cfg_fc_cpld,
-            cfg_fc_sel=dut.cfg_fc_sel,
-
-            # Configuration Control Interface
-            # cfg_hot_reset_in
-            # cfg_hot_reset_out
-            # cfg_config_space_enable
-            # cfg_dsn
-            # cfg_bus_number
-            # cfg_ds_port_number
-            # cfg_ds_bus_number
-            # cfg_ds_device_number
-            # cfg_ds_function_number
-            # cfg_power_state_change_ack
-            # cfg_power_state_change_interrupt
-            cfg_err_cor_in=dut.status_error_cor,
-            cfg_err_uncor_in=dut.status_error_uncor,
-            # cfg_flr_in_process
-            # cfg_flr_done
-            # cfg_vf_flr_in_process
-            # cfg_vf_flr_func_num
-            # cfg_vf_flr_done
-            # cfg_pm_aspm_l1_entry_reject
-            # cfg_pm_aspm_tx_l0s_entry_disable
-            # cfg_req_pm_transition_l23_ready
-            # cfg_link_training_enable
-
-            # Configuration Interrupt Controller Interface
-            # cfg_interrupt_int
-            # cfg_interrupt_sent
-            # cfg_interrupt_pending
-            # cfg_interrupt_msi_enable
-            # cfg_interrupt_msi_mmenable
-            # cfg_interrupt_msi_mask_update
-            # cfg_interrupt_msi_data
-            # cfg_interrupt_msi_select
-            # cfg_interrupt_msi_int
-            # cfg_interrupt_msi_pending_status
-            # cfg_interrupt_msi_pending_status_data_enable
-            # cfg_interrupt_msi_pending_status_function_num
-            # cfg_interrupt_msi_sent
-            # cfg_interrupt_msi_fail
-            cfg_interrupt_msix_enable=dut.cfg_interrupt_msix_enable,
-            cfg_interrupt_msix_mask=dut.cfg_interrupt_msix_mask,
-            cfg_interrupt_msix_vf_enable=dut.cfg_interrupt_msix_vf_enable,
-            cfg_interrupt_msix_vf_mask=dut.cfg_interrupt_msix_vf_mask,
-            cfg_interrupt_msix_address=dut.cfg_interrupt_msix_address,
-            cfg_interrupt_msix_data=dut.cfg_interrupt_msix_data,
-            cfg_interrupt_msix_int=dut.cfg_interrupt_msix_int,
-            cfg_interrupt_msix_vec_pending=dut.cfg_interrupt_msix_vec_pending,
-            cfg_interrupt_msix_vec_pending_status=dut.cfg_interrupt_msix_vec_pending_status,
-            cfg_interrupt_msix_sent=dut.cfg_interrupt_msix_sent,
-            cfg_interrupt_msix_fail=dut.cfg_interrupt_msix_fail,
-            # cfg_interrupt_msi_attr
-            # cfg_interrupt_msi_tph_present
-            # cfg_interrupt_msi_tph_type
-            # cfg_interrupt_msi_tph_st_tag
-            cfg_interrupt_msi_function_number=dut.cfg_interrupt_msi_function_number,
-
-            # Configuration Extend Interface
-            # cfg_ext_read_received
-            # cfg_ext_write_received
-            # cfg_ext_register_number
-            # cfg_ext_function_number
-            # cfg_ext_write_data
-            # cfg_ext_write_byte_enable
-            # cfg_ext_read_data
-            # cfg_ext_read_data_valid
-        )
-
-        # self.dev.log.setLevel(logging.DEBUG)
-
-        self.rc.make_port().connect(self.dev)
-
-        self.driver = mqnic.Driver()
-
-        self.dev.functions[0].configure_bar(0, 2**len(dut.core_pcie_inst.axil_ctrl_araddr), ext=True, prefetch=True)
-        if hasattr(dut.core_pcie_inst, 'pcie_app_ctrl'):
-            self.dev.functions[0].configure_bar(2, 2**len(dut.core_pcie_inst.axil_app_ctrl_araddr), ext=True, prefetch=True)
-
-        core_inst = dut.core_pcie_inst.core_inst
-
-        # Ethernet
-        self.port_mac = []
-
-        eth_int_if_width = len(core_inst.m_axis_tx_tdata) / len(core_inst.m_axis_tx_tvalid)
-        eth_clock_period = 6.4
-        eth_speed = 10e9
-
-        if eth_int_if_width == 64:
-            # 10G
-            eth_clock_period = 6.4
-            eth_speed = 10e9
-        elif eth_int_if_width == 128:
-            # 25G
-            eth_clock_period = 2.56
-            eth_speed = 25e9
-        elif eth_int_if_width == 512:
-            # 100G
-            eth_clock_period = 3.102
-            eth_speed = 100e9
-
-        for iface in core_inst.iface:
-            for k in range(len(iface.port)):
-                cocotb.start_soon(Clock(iface.port[k].port_rx_clk, eth_clock_period, units="ns").start())
-                cocotb.start_soon(Clock(iface.port[k].port_tx_clk, eth_clock_period, units="ns").start())
-
-                iface.port[k].port_rx_rst.setimmediatevalue(0)
-                iface.port[k].port_tx_rst.setimmediatevalue(0)
-
-                mac = EthMac(
-                    tx_clk=iface.port[k].port_tx_clk,
-                    tx_rst=iface.port[k].port_tx_rst,
-                    tx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_tx_inst, "m_axis_tx"),
-                    tx_ptp_time=iface.port[k].port_tx_ptp_ts_tod,
-                    tx_ptp_ts=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_ts,
-                    tx_ptp_ts_tag=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_tag,
-                    tx_ptp_ts_valid=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_valid,
-                    rx_clk=iface.port[k].port_rx_clk,
-                    rx_rst=iface.port[k].port_rx_rst,
-                    rx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_rx_inst, "s_axis_rx"),
-                    rx_ptp_time=iface.port[k].port_rx_ptp_ts_tod,
-                    ifg=12, speed=eth_speed
-                )
-
-                self.port_mac.append(mac)
-
-        dut.eth_tx_status.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.eth_tx_fc_quanta_clk_en.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.eth_rx_status.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.eth_rx_lfc_req.setimmediatevalue(0)
-        dut.eth_rx_pfc_req.setimmediatevalue(0)
-        dut.eth_rx_fc_quanta_clk_en.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-
-        # DDR
-        self.ddr_group_size = core_inst.DDR_GROUP_SIZE.value
-        self.ddr_ram = []
-        self.ddr_axi_if = []
-        if hasattr(core_inst, 'ddr'):
-            ram = None
-            for i, ch in enumerate(core_inst.ddr.dram_if_inst.ch):
-                cocotb.start_soon(Clock(ch.ch_clk, 3.332, units="ns").start())
-                ch.ch_rst.setimmediatevalue(0)
-                ch.ch_status.setimmediatevalue(1)
-
-                if i % self.ddr_group_size == 0:
-                    ram = SparseMemoryRegion()
-                    self.ddr_ram.append(ram)
-                self.ddr_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
-
-        # HBM
-        self.hbm_group_size = core_inst.HBM_GROUP_SIZE.value
-        self.hbm_ram = []
-        self.hbm_axi_if = []
-        if hasattr(core_inst, 'hbm'):
-            ram = None
-            for i, ch in enumerate(core_inst.hbm.dram_if_inst.ch):
-                cocotb.start_soon(Clock(ch.ch_clk, 2.222, units="ns").start())
-                ch.ch_rst.setimmediatevalue(0)
-                ch.ch_status.setimmediatevalue(1)
-
-                if i % self.hbm_group_size == 0:
-                    ram = SparseMemoryRegion()
-                    self.hbm_ram.append(ram)
-                self.hbm_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
-
-        dut.ctrl_reg_wr_wait.setimmediatevalue(0)
-        dut.ctrl_reg_wr_ack.setimmediatevalue(0)
-        dut.ctrl_reg_rd_data.setimmediatevalue(0)
-        dut.ctrl_reg_rd_wait.setimmediatevalue(0)
-        dut.ctrl_reg_rd_ack.setimmediatevalue(0)
-
-        cocotb.start_soon(Clock(dut.ptp_clk, 6.4, units="ns").start())
-        dut.ptp_rst.setimmediatevalue(0)
-        cocotb.start_soon(Clock(dut.ptp_sample_clk, 8, units="ns").start())
-
-        dut.s_axis_stat_tdata.setimmediatevalue(0)
-        dut.s_axis_stat_tid.setimmediatevalue(0)
-        dut.s_axis_stat_tvalid.setimmediatevalue(0)
-
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
-
-    async def init(self):
-
-        for mac in self.port_mac:
-            mac.rx.reset.setimmediatevalue(0)
-            mac.tx.reset.setimmediatevalue(0)
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.setimmediatevalue(0)
-
-        await RisingEdge(self.dut.clk)
-        await RisingEdge(self.dut.clk)
-
-        for mac in self.port_mac:
-            mac.rx.reset.setimmediatevalue(1)
-            mac.tx.reset.setimmediatevalue(1)
-
-        self.dut.ptp_rst.setimmediatevalue(1)
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.setimmediatevalue(1)
-
-        await FallingEdge(self.dut.rst)
-        await Timer(100, 'ns')
-
-        await RisingEdge(self.dut.clk)
-        await RisingEdge(self.dut.clk)
-
-        for mac in self.port_mac:
-            mac.rx.reset.setimmediatevalue(0)
-            mac.tx.reset.setimmediatevalue(0)
+        self.init_pcie_dev(UltraScalePlusPcieDevice, dut.core_pcie_inst, dut.clk, dut.rst, dut.pcie_if_inst)
 
-        self.dut.ptp_rst.setimmediatevalue(0)
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.setimmediatevalue(0)
-
-        await self.rc.enumerate()
-
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk)
-
-            if self.loopback_enable:
-                for mac in self.port_mac:
-                    if not mac.tx.empty():
-                        await mac.rx.send(await mac.tx.recv())
+        self.init_core(dut.core_pcie_inst.core_inst)
 
 
 @cocotb.test()
 async def run_test_nic(dut):
 
-    tb = TB(dut, msix_count=2**len(dut.core_pcie_inst.irq_index))
+    tb = TB(dut)
 
     await tb.init()
 
-    tb.log.info("Init driver")
-    await tb.driver.init_pcie_dev(tb.rc.find_device(tb.dev.functions[0].pcie_id))
-    for interface in tb.driver.interfaces:
-        await interface.open()
-
-    # enable queues
-    tb.log.info("Enable queues")
-    for interface in tb.driver.interfaces:
-        await interface.sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
-        for k in range(len(interface.txq)):
-            await interface.sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
-
-    # wait for all writes to complete
-    await tb.driver.hw_regs.read_dword(0)
-    tb.log.info("Init complete")
+    await tb.init_driver()
 
     tb.log.info("Send and receive single packet")
 
@@ -500,7 +98,7 @@ async def run_test_nic(dut):
 
     data = bytearray([x % 256 for x in range(1024)])
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, k)
@@ -514,7 +112,7 @@ async def run_test_nic(dut):
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
         assert pkt.queue == k
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, 0)
 
@@ -526,7 +124,7 @@ async def run_test_nic(dut):
         for k in range(4):
             await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, k, k)
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         queues = set()
 
@@ -556,7 +154,7 @@ async def run_test_nic(dut):
 
         assert len(queues) == 4
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
         await tb.driver.interfaces[0].set_rx_queue_map_rss_mask(0, 0)
 
@@ -566,7 +164,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -579,7 +177,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple large packets")
 
@@ -587,7 +185,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -600,7 +198,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Jumbo frames")
 
@@ -608,7 +206,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(9014)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -621,29 +219,27 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     if len(tb.driver.interfaces) > 1:
         tb.log.info("All interfaces")
 
         count = 64
 
-        pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
-
-        tb.loopback_enable = True
-
-        for k, p in enumerate(pkts):
-            await tb.driver.interfaces[k % len(tb.driver.interfaces)].start_xmit(p, 0)
+        tb.loopback.enable = True
 
-        for k in range(count):
-            pkt = await tb.driver.interfaces[k % len(tb.driver.interfaces)].recv()
+        # all interfaces concurrently, one flow each
+        report = await mqnic.run_traffic_concurrent([(interface, [0]) for interface in tb.driver.interfaces],
+            count // len(tb.driver.interfaces), mqnic.PacketTemplate(size=1514))
 
-            tb.log.info("Packet: %s", pkt)
-            assert pkt.data == pkts[k]
-            if tb.driver.interfaces[0].if_feature_rx_csum:
-                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
+        assert report['received'] == report['sent']
+        assert report['lost'] == 0
+        assert report['corrupted'] == 0
+        assert report['csum_errors'] == 0
+        for flow in report['flows']:
+            assert flow['received'] == flow['sent']
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     if len(tb.driver.interfaces[0].sched_blocks) > 1:
         tb.log.info("All interface 0 scheduler blocks")
@@ -662,28 +258,26 @@ async def run_test_nic(dut):
 
         count = 64
 
-        pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
-
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
-        queues = set()
+        # all ports concurrently, one flow per scheduler block
+        interface = tb.driver.interfaces[0]
+        report = await mqnic.run_traffic_concurrent([(interface, [block.index]) for block in interface.sched_blocks],
+            count // len(interface.sched_blocks), mqnic.PacketTemplate(size=1514))
 
-        for k, p in enumerate(pkts):
-            await tb.driver.interfaces[0].start_xmit(p, k % len(tb.driver.interfaces[0].sched_blocks))
+        assert report['received'] == report['sent']
+        assert report['lost'] == 0
+        assert report['corrupted'] == 0
+        assert report['csum_errors'] == 0
 
-        for k in range(count):
-            pkt = await tb.driver.interfaces[0].recv()
-
-            tb.log.info("Packet: %s", pkt)
-            # assert pkt.data == pkts[k]
-            if tb.driver.interfaces[0].if_feature_rx_csum:
-                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
-
-            queues.add(pkt.queue)
+        queues = set()
+        for flow in report['flows']:
+            assert flow['received'] == flow['sent']
+            queues.update(flow['rx_queues'])
 
-        assert len(queues) == len(tb.driver.interfaces[0].sched_blocks)
+        assert len(queues) == len(interface.sched_blocks)
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
         for block in tb.driver.interfaces[0].sched_blocks[1:]:
             await block.schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000000)
@@ -703,7 +297,7 @@ async def run_test_nic(dut):
 
         pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         for p in pkts:
             await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -716,7 +310,7 @@ async def run_test_nic(dut):
             if tb.driver.interfaces[0].if_feature_rx_csum:
                 assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     app_reg_blocks = mqnic.RegBlockList()
     await app_reg_blocks.enumerate_reg_blocks(tb.driver.app_hw_regs)
@@ -1208,7 +802,7 @@ def test_mqnic_core_pcie_us(request, if_count, ports_per_if, axis_pcie_data_widt
     sim_build = os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
-    cocotb_test.simulator.run(
+    mqnic_tb.run_sim(
         python_search=[tests_dir],
         verilog_sources=verilog_sources,
         toplevel=toplevel,
@@ -1,13 +1,20 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2019-2023 The Regents of the University of California
 
+import csv
 import datetime
-from collections import deque
+import heapq
+import itertools
+import json
+import logging
+import os
+import zlib
+from collections import Counter, deque
 
 import cocotb
 from cocotb.log import SimLog
-from cocotb.queue import Queue
-from cocotb.triggers import Event, Edge, RisingEdge
+from cocotb.triggers import Event, Edge, First, RisingEdge, Timer
+from cocotb.utils import get_sim_steps, get_sim_time
 
 from cocotbext.axi import Window
 
@@ -346,10 +353,308 @@ MQNIC_EQ_CMD_SET_ARM           = 0x40000200
 
 MQNIC_EVENT_TYPE_CPL = 0x0000
 
+# statistics counter indices (stats_pcie_if and stats_dma_if_pcie)
+MQNIC_STATS_NAMES = {
+    0: "pcie_rx_tlp_mem_rd",
+    1: "pcie_rx_tlp_mem_wr",
+    2: "pcie_rx_tlp_io",
+    3: "pcie_rx_tlp_cfg",
+    4: "pcie_rx_tlp_msg",
+    5: "pcie_rx_tlp_cpl",
+    6: "pcie_rx_tlp_cpl_ur",
+    7: "pcie_rx_tlp_cpl_ca",
+    8: "pcie_rx_tlp_atomic",
+    9: "pcie_rx_tlp_ep",
+    10: "pcie_rx_tlp_hdr_dw",
+    11: "pcie_rx_tlp_req_dw",
+    12: "pcie_rx_tlp_payload_dw",
+    13: "pcie_rx_tlp_cpl_dw",
+    16: "pcie_tx_tlp_mem_rd",
+    17: "pcie_tx_tlp_mem_wr",
+    18: "pcie_tx_tlp_io",
+    19: "pcie_tx_tlp_cfg",
+    20: "pcie_tx_tlp_msg",
+    21: "pcie_tx_tlp_cpl",
+    22: "pcie_tx_tlp_cpl_ur",
+    23: "pcie_tx_tlp_cpl_ca",
+    24: "pcie_tx_tlp_atomic",
+    25: "pcie_tx_tlp_ep",
+    26: "pcie_tx_tlp_hdr_dw",
+    27: "pcie_tx_tlp_req_dw",
+    28: "pcie_tx_tlp_payload_dw",
+    29: "pcie_tx_tlp_cpl_dw",
+    32: "dma_rd_op_count",
+    33: "dma_rd_op_bytes",
+    34: "dma_rd_op_latency",
+    35: "dma_rd_op_error",
+    36: "dma_rd_req_count",
+    37: "dma_rd_req_latency",
+    38: "dma_rd_req_timeout",
+    39: "dma_rd_op_table_full",
+    40: "dma_rd_no_tags",
+    41: "dma_rd_tx_limit",
+    42: "dma_rd_tx_stall",
+    48: "dma_wr_op_count",
+    49: "dma_wr_op_bytes",
+    50: "dma_wr_op_latency",
+    51: "dma_wr_op_error",
+    52: "dma_wr_req_count",
+    53: "dma_wr_req_latency",
+    55: "dma_wr_op_table_full",
+    57: "dma_wr_tx_limit",
+    58: "dma_wr_tx_stall",
+}
+
 MQNIC_DESC_SIZE = 16
 MQNIC_CPL_SIZE = 32
 MQNIC_EVENT_SIZE = 32
 
+# max outstanding non-posted MMIO reads (non-extended PCIe tag limit)
+MQNIC_MMIO_MAX_OUTSTANDING = 32
+
+MQNIC_CPL_STRUCT = struct.Struct("<HHHxxLHHLBBHLL")
+MQNIC_EVENT_STRUCT = struct.Struct("<HHLLLLLLL")
+
+# maps each byte to 1 if the phase bit (bit 7) is set, 0 otherwise
+_PHASE_TABLE = bytes((b >> 7) & 1 for b in range(256))
+
+
+def read_ring_records(buf, rec, size, cons_ptr, limit=None):
+    # decode all valid records from cons_ptr up to the phase bit boundary
+    stride = rec.size
+    index = cons_ptr & (size-1)
+    count = size if limit is None else min(limit, size)
+    records = []
+
+    while count > 0:
+        n = min(count, size-index)
+
+        # phase bit is the MSB of the last byte of each record
+        phase = buf[index*stride+stride-1:(index+n)*stride:stride].translate(_PHASE_TABLE)
+        end = phase.find(b'\x01' if cons_ptr & size else b'\x00')
+        if end < 0:
+            end = n
+
+        records.extend(rec.iter_unpack(buf[index*stride:(index+end)*stride]))
+
+        if end < n:
+            break
+
+        count -= n
+        cons_ptr += n
+        index = 0
+
+    return records
+
+
+def count_ring_records(buf, stride, size, cons_ptr):
+    # number of valid records from cons_ptr, without decoding them
+    index = cons_ptr & (size-1)
+    phase = buf[stride-1:size*stride:stride].translate(_PHASE_TABLE)
+    invalid = b'\x01' if cons_ptr & size else b'\x00'
+
+    end = phase.find(invalid, index)
+    if end >= 0:
+        return end - index
+
+    # past the wrap point, valid records carry the opposite phase
+    end = phase.find(b'\x00' if invalid == b'\x01' else b'\x01', 0, index)
+    return size - index + (index if end < 0 else end)
+
+
+# register block topology and firmware IDs, keyed on toplevel, BAR size and build parameters
+_topology_cache = {}
+
+
+async def gather(*aws):
+    # issue operations concurrently, return results in order
+    tasks = [cocotb.start_soon(aw) for aw in aws]
+    return [await task for task in tasks]
+
+
+async def pipelined(aws, max_outstanding=MQNIC_MMIO_MAX_OUTSTANDING):
+    # run operations with at most max_outstanding in flight, return results in order
+    # (aws is consumed lazily, so each operation is only created once a slot frees up)
+    it = enumerate(aws)
+    results = {}
+
+    async def worker():
+        for k, aw in it:
+            results[k] = await aw
+
+    await gather(*(worker() for k in range(max_outstanding)))
+    return [results[k] for k in range(len(results))]
+
+
+async def read_dwords_pipelined(window, offsets, max_outstanding=MQNIC_MMIO_MAX_OUTSTANDING):
+    return await pipelined((window.read_dword(offset) for offset in offsets), max_outstanding)
+
+
+def flow_hash(data):
+    # hash over IP addresses, protocol and L4 ports, falling back on MAC addresses
+    data = bytes(data[:64])
+    offset = 14
+    ethertype = int.from_bytes(data[12:14], 'big')
+
+    if ethertype == 0x8100:
+        ethertype = int.from_bytes(data[16:18], 'big')
+        offset = 18
+
+    if ethertype == 0x0800 and len(data) >= offset+20:
+        ihl = (data[offset] & 0xf)*4
+        proto = data[offset+9]
+        frag = int.from_bytes(data[offset+6:offset+8], 'big') & 0x3fff
+        key = data[offset+12:offset+20] + bytes([proto])
+        if proto in (6, 17) and not frag:
+            key += data[offset+ihl:offset+ihl+4]
+    elif ethertype == 0x86dd and len(data) >= offset+40:
+        proto = data[offset+6]
+        key = data[offset+8:offset+40] + bytes([proto])
+        if proto in (6, 17):
+            key += data[offset+40:offset+44]
+    else:
+        key = data[0:12]
+
+    return zlib.crc32(key)
+
+
+# Toeplitz key hardcoded in mqnic_ingress (rx_hash)
+MQNIC_RSS_HASH_KEY = bytes.fromhex(
+    "6d5a56da255b0ec24167253d43a38fb0d0ca2bcbae7b30b477cb2da3"
+    "8030f20c6a42b73bbeac01fa"
+)
+
+
+def toeplitz_hash(data, key=MQNIC_RSS_HASH_KEY):
+    k = int.from_bytes(key, 'big')
+    shift = len(key)*8-32
+    val = 0
+    for b in data:
+        for j in range(8):
+            if b & (0x80 >> j):
+                val ^= (k >> shift) & 0xffffffff
+            shift -= 1
+    return val
+
+
+def rss_hash(data, key=MQNIC_RSS_HASH_KEY):
+    # model of rx_hash: IPv4 addresses, plus ports for TCP/UDP without IP options
+    data = bytes(data[:38])
+    if len(data) < 34 or data[12:14] != b'\x08\x00':
+        return 0
+
+    if data[14] & 0xf == 5 and data[23] in (6, 17) and len(data) >= 38:
+        return toeplitz_hash(data[26:38], key)
+
+    return toeplitz_hash(data[26:34], key)
+
+
+def rss_indir_table(weights, size):
+    # spread size entries over queues in proportion to weights, interleaved
+    # (smooth weighted round robin) so that low hash bits alone spread flows
+    total = sum(weights)
+    if total <= 0:
+        raise ValueError("RSS weights must have a positive sum")
+
+    table = []
+    credit = [0]*len(weights)
+
+    for k in range(size):
+        for q, w in enumerate(weights):
+            credit[q] += w
+        q = max(range(len(weights)), key=lambda x: credit[x])
+        credit[q] -= total
+        table.append(q)
+
+    return table
+
+
+def imbalance(counts):
+    # ratio of the busiest bin to the mean, 1.0 is perfectly even
+    counts = list(counts)
+    if not counts or not sum(counts):
+        return None
+    return max(counts) / (sum(counts) / len(counts))
+
+
+def ones_complement_sum(data):
+    if len(data) % 2:
+        data = bytes(data) + b'\x00'
+    val = sum(struct.unpack(f"!{len(data)//2}H", data))
+    while val >> 16:
+        val = (val & 0xffff) + (val >> 16)
+    return val
+
+
+def tso_segment(data, mss, csum_offload=True):
+    # split a TCP super-packet into mss-sized segments, returns a list of
+    # (segment, csum) where csum is (csum_start, csum_offset) for offload or None
+    data = bytes(data)
+    offset = 14
+    ethertype = int.from_bytes(data[12:14], 'big')
+
+    if ethertype == 0x8100:
+        ethertype = int.from_bytes(data[16:18], 'big')
+        offset = 18
+
+    if ethertype == 0x0800:
+        ihl = (data[offset] & 0xf)*4
+        proto = data[offset+9]
+        ip_id = int.from_bytes(data[offset+4:offset+6], 'big')
+    elif ethertype == 0x86dd:
+        ihl = 40
+        proto = data[offset+6]
+    else:
+        raise Exception("TSO requires an IPv4 or IPv6 packet")
+
+    if proto != 6:
+        raise Exception("TSO requires a TCP packet")
+
+    l4 = offset+ihl
+    hdr_len = l4 + (data[l4+12] >> 4)*4
+    seq = int.from_bytes(data[l4+4:l4+8], 'big')
+    flags = data[l4+13]
+    payload = data[hdr_len:]
+
+    segs = []
+
+    for k, pos in enumerate(range(0, max(len(payload), 1), mss)):
+        chunk = payload[pos:pos+mss]
+        l4_len = hdr_len-l4+len(chunk)
+        hdr = bytearray(data[:hdr_len])
+
+        if ethertype == 0x0800:
+            struct.pack_into("!HH", hdr, offset+2, ihl+l4_len, (ip_id+k) & 0xffff)
+            struct.pack_into("!H", hdr, offset+10, 0)
+            struct.pack_into("!H", hdr, offset+10, ~ones_complement_sum(hdr[offset:l4]) & 0xffff)
+            pseudo = hdr[offset+12:offset+20] + struct.pack("!xBH", proto, l4_len)
+        else:
+            struct.pack_into("!H", hdr, offset+4, l4_len)
+            pseudo = hdr[offset+8:offset+40] + struct.pack("!LxxxB", l4_len, proto)
+
+        struct.pack_into("!L", hdr, l4+4, (seq+pos) & 0xffffffff)
+
+        # FIN and PSH only on the last segment, CWR only on the first
+        f = flags
+        if pos+mss < len(payload):
+            f &= ~0x09
+        if k:
+            f &= ~0x80
+        hdr[l4+13] = f
+
+        if csum_offload:
+            # seed with pseudo-header sum, hardware sums from csum_start
+            struct.pack_into("!H", hdr, l4+16, ones_complement_sum(pseudo))
+            csum = (l4, 16)
+        else:
+            struct.pack_into("!H", hdr, l4+16, 0)
+            struct.pack_into("!H", hdr, l4+16, ~ones_complement_sum(pseudo + hdr[l4:] + chunk) & 0xffff)
+            csum = None
+
+        segs.append((bytes(hdr)+chunk, csum))
+
+    return segs
+
 
 class Resource:
     def __init__(self, count, parent, stride):
@@ -358,14 +663,51 @@ class Resource:
         self.stride = stride
 
         self.windows = {}
-        self.free_list = list(range(count))
+
+        # bitmap of free indices, plus min-heap for lowest-index allocation
+        # (heap entries are checked against the bitmap and may be stale)
+        self.free_mask = (1 << count) - 1
+        self.free_heap = list(range(count))
 
     def alloc(self):
-        return self.free_list.pop(0)
+        while self.free_heap:
+            index = heapq.heappop(self.free_heap)
+            if self.free_mask >> index & 1:
+                self.free_mask &= ~(1 << index)
+                return index
+        raise Exception("No free resources")
+
+    def alloc_range(self, count):
+        # find lowest run of count free indices
+        mask = self.free_mask
+        run = 1
+        while run < count and mask:
+            shift = min(run, count-run)
+            mask &= mask >> shift
+            run += shift
+
+        if not mask:
+            raise Exception("No free resources")
+
+        index = (mask & -mask).bit_length() - 1
+        self.free_mask &= ~(((1 << count) - 1) << index)
+        return index
 
     def free(self, index):
-        self.free_list.append(index)
-        self.free_list.sort()
+        assert not self.free_mask >> index & 1, "Resource already free"
+        self.free_mask |= 1 << index
+        heapq.heappush(self.free_heap, index)
+
+        # drop stale entries left behind by alloc_range
+        if len(self.free_heap) > 2*self.count:
+            self.free_heap = [k for k in range(self.count) if self.free_mask >> k & 1]
+
+    def free_range(self, index, count):
+        for k in range(index, index+count):
+            self.free(k)
+
+    def get_free_count(self):
+        return bin(self.free_mask).count('1')
 
     def get_count(self):
         return self.count
@@ -379,31 +721,46 @@ class Resource:
 class RegBlock(Window):
     def __init__(self, parent, offset, size, base=0, **kwargs):
         super().__init__(parent, offset, size, base, **kwargs)
-        self._offset = offset
         self.type = 0
         self.version = 0
 
 
 class RegBlockList:
     def __init__(self):
+        self.log = SimLog("cocotb.mqnic")
         self.blocks = []
 
-    async def enumerate_reg_blocks(self, window, offset=0):
+    async def enumerate_reg_blocks(self, window, offset=0, topology=None):
+        if topology is not None:
+            # use cached topology instead of walking the list
+            for rb_offset, rb_type, rb_version in topology:
+                rb = window.create_window(rb_offset, window_type=RegBlock)
+                rb.type = rb_type
+                rb.version = rb_version
+                self.blocks.append(rb)
+            return
+
         while True:
-            rb_type = await window.read_dword(offset+MQNIC_RB_REG_TYPE)
-            rb_version = await window.read_dword(offset+MQNIC_RB_REG_VER)
+            rb_type, rb_version, next_offset = await gather(
+                window.read_dword(offset+MQNIC_RB_REG_TYPE),
+                window.read_dword(offset+MQNIC_RB_REG_VER),
+                window.read_dword(offset+MQNIC_RB_REG_NEXT_PTR)
+            )
             rb = window.create_window(offset, window_type=RegBlock)
             rb.type = rb_type
             rb.version = rb_version
-            print(f"Block ID {rb_type:#010x} version {rb_version:#010x} at offset {offset:#010x}")
+            self.log.debug("Block ID 0x%08x version 0x%08x at offset 0x%08x", rb_type, rb_version, offset)
             self.blocks.append(rb)
-            offset = await window.read_dword(offset+MQNIC_RB_REG_NEXT_PTR)
+            offset = next_offset
             if offset == 0:
                 return
             assert offset & 0x3 == 0, "Register block not aligned"
             for block in self.blocks:
                 assert block.offset != offset, "Register blocks form a loop"
 
+    def get_topology(self):
+        return [(block.offset, block.type, block.version) for block in self.blocks]
+
     def find(self, rb_type, version=None, index=0):
         for block in self.blocks:
             if block.type == rb_type and (not version or block.version == version):
@@ -428,9 +785,35 @@ class Packet:
         self.timestamp_ns = None
         self.rx_checksum = None
 
+        # backing DMA buffer for zero-copy packets; data is a view into it and
+        # is only valid until release() (copy with bytes(pkt) to keep it), and
+        # passing the packet to start_xmit hands it over, released on TX completion
+        self.buf = None
+        self.buf_offset = 0
+
+    @classmethod
+    def from_buffer(cls, buf, offset, length):
+        pkt = cls(memoryview(buf.mem)[offset:offset+length])
+        pkt.buf = buf
+        pkt.buf_offset = offset
+        return pkt
+
+    def release(self):
+        if self.buf is None:
+            return
+
+        if isinstance(self.data, memoryview):
+            self.data.release()
+
+        if isinstance(self.buf, PacketBuffer):
+            self.buf.pool.free(self.buf)
+
+        self.buf = None
+
     def __repr__(self):
+        data = bytes(self.data) if isinstance(self.data, memoryview) else self.data
         return (
-            f'{type(self).__name__}(data={self.data}, '
+            f'{type(self).__name__}(data={data}, '
             f'queue={self.queue}, '
             f'timestamp_s={self.timestamp_s}, '
             f'timestamp_ns={self.timestamp_ns}, '
@@ -447,6 +830,66 @@ class Packet:
         return bytes(self.data)
 
 
+class PacketBuffer:
+    def __init__(self, pool, region, offset, size):
+        self.pool = pool
+        self.region = region
+        self.offset = offset
+        self.size = size
+        self.mem = memoryview(region.mem)[offset:offset+size]
+        self.allocated = False
+
+    def get_absolute_address(self, address):
+        return self.region.get_absolute_address(self.offset+address)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return bytes(self.mem[key])
+        return self.mem[key]
+
+    def __setitem__(self, key, value):
+        self.mem[key] = value
+
+    def __len__(self):
+        return self.size
+
+
+class PacketBufferPool:
+    def __init__(self, pool, buf_size, arena_size):
+        self.pool = pool
+        self.buf_size = buf_size
+        self.arena_count = max(arena_size // buf_size, 1)
+
+        self.arenas = []
+        self.free_list = deque()
+        self.alloc_count = 0
+
+    def grow(self):
+        region = self.pool.alloc_region(self.buf_size*self.arena_count)
+        self.arenas.append(region)
+        for k in range(self.arena_count):
+            self.free_list.append(PacketBuffer(self, region, k*self.buf_size, self.buf_size))
+
+    def alloc(self):
+        if not self.free_list:
+            self.grow()
+
+        pkt = self.free_list.popleft()
+        pkt.allocated = True
+        self.alloc_count += 1
+        return pkt
+
+    def free(self, pkt):
+        assert pkt.pool is self
+        assert pkt.allocated, "Packet buffer already free"
+        pkt.allocated = False
+        self.alloc_count -= 1
+        self.free_list.append(pkt)
+
+    def get_buffer_count(self):
+        return len(self.arenas)*self.arena_count
+
+
 class Eq:
     def __init__(self, interface):
         self.interface = interface
@@ -497,6 +940,7 @@ class Eq:
         self.cons_ptr = 0
 
         self.irq = irq
+        self.driver.irq_eq_map.setdefault(self.irq, []).append(self)
 
         self.cq_table = {}
 
@@ -521,6 +965,7 @@ class Eq:
 
         # TODO free buffer
 
+        self.driver.irq_eq_map[self.irq].remove(self)
         self.irq = None
 
         self.enabled = False
@@ -553,28 +998,31 @@ class Eq:
         if not self.interface.port_up:
             return
 
-        self.log.info("Process EQ")
+        trace = self.log.isEnabledFor(logging.DEBUG)
+
+        if trace:
+            self.log.debug("Process EQ %d", self.eqn)
 
         eq_cons_ptr = self.cons_ptr
-        eq_index = eq_cons_ptr & self.size_mask
 
-        while True:
-            event_data = struct.unpack_from("<HHLLLLLLL", self.buf, eq_index*self.stride)
+        for event_data in read_ring_records(self.buf, MQNIC_EVENT_STRUCT, self.size, eq_cons_ptr):
+            self.driver.event_counts['eq_event'] += 1
 
-            self.log.info("EQ %d index %d data: %s", self.eqn, eq_index, repr(event_data))
-
-            if bool(event_data[-1] & 0x80000000) == bool(eq_cons_ptr & self.size):
-                self.log.info("EQ %d empty", self.eqn)
-                break
+            if trace:
+                self.log.debug("EQ %d index %d data: %r", self.eqn, eq_cons_ptr & self.size_mask, event_data)
 
             if event_data[0] == MQNIC_EVENT_TYPE_CPL:
                 # completion
                 cq = self.cq_table[event_data[1]]
-                await cq.handler(cq)
-                await cq.arm()
+                cq.event_count += 1
+                if cq.budget is not None:
+                    # poll mode; CQ is re-armed when polling completes
+                    cq.schedule_poll()
+                else:
+                    await cq.handler(cq)
+                    await cq.arm()
 
             eq_cons_ptr += 1
-            eq_index = eq_cons_ptr & self.size_mask
 
         self.cons_ptr = eq_cons_ptr
         await self.write_cons_ptr()
@@ -602,6 +1050,14 @@ class Cq:
         self.src_ring = None
         self.handler = None
 
+        self.budget = None
+        self.coalesce_time = 0
+        self.poll_scheduled = False
+
+        self.event_count = 0
+        self.poll_count = 0
+        self.arm_count = 0
+
         self.prod_ptr = 0
         self.cons_ptr = 0
 
@@ -630,6 +1086,9 @@ class Cq:
         self.prod_ptr = 0
         self.cons_ptr = 0
 
+        self.budget = self.interface.poll_budget
+        self.coalesce_time = self.interface.poll_coalesce_time
+
         eq.attach_cq(self)
         self.eq = eq
 
@@ -671,12 +1130,47 @@ class Cq:
     async def write_cons_ptr(self):
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_CONS_PTR | (self.cons_ptr & MQNIC_CQ_PTR_MASK))
 
+    def read_cpls(self, limit=None):
+        return read_ring_records(self.buf, MQNIC_CPL_STRUCT, self.size, self.cons_ptr, limit)
+
+    def depth(self):
+        return count_ring_records(self.buf, self.stride, self.size, self.cons_ptr)
+
     async def arm(self):
         if not self.hw_regs:
             return
 
+        self.arm_count += 1
+
         await self.hw_regs.write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_CQ_CMD_SET_ARM | 1)
 
+    def schedule_poll(self):
+        if self.poll_scheduled:
+            return
+
+        self.poll_scheduled = True
+        cocotb.start_soon(self._run_poll())
+
+    async def _run_poll(self):
+        # NAPI-style polling: the CQ stays disarmed while the handler keeps
+        # using up its whole budget, and is re-armed once it runs dry
+        while True:
+            if self.coalesce_time:
+                await Timer(self.coalesce_time, 'ns')
+
+            if not self.handler:
+                break
+
+            self.poll_count += 1
+
+            done = await self.handler(self, self.budget)
+
+            if self.budget is None or done < self.budget:
+                break
+
+        self.poll_scheduled = False
+        await self.arm()
+
 
 class Txq:
     def __init__(self, interface):
@@ -707,6 +1201,15 @@ class Txq:
 
         self.packets = 0
         self.bytes = 0
+        self.doorbells = 0
+        self.stalls = 0
+
+        # descriptor timestamps (sim time, ns) when driver.queue_timing is set
+        self.post_time = None
+        self.doorbell_time = None
+        self.doorbell_ptr = 0
+        self.latency = None
+        self.post_latency = None
 
         self.hw_regs = None
 
@@ -736,6 +1239,13 @@ class Txq:
         self.prod_ptr = 0
         self.cons_ptr = 0
 
+        if self.driver.queue_timing:
+            self.post_time = [0]*self.size
+            self.doorbell_time = [0]*self.size
+            self.doorbell_ptr = 0
+            self.latency = LatencyHistogram()
+            self.post_latency = LatencyHistogram()
+
         self.cq = cq
         self.cq.src_ring = self
         self.cq.handler = Txq.process_tx_cq
@@ -791,16 +1301,122 @@ class Txq:
     def full(self):
         return self.prod_ptr - self.cons_ptr >= self.full_size
 
+    async def wait_for_space(self):
+        while self.full():
+            self.stalls += 1
+            self.clean_event.clear()
+            await self.clean_event.wait()
+
     async def read_cons_ptr(self):
         val = await self.hw_regs.read_dword(MQNIC_QUEUE_PTR_REG)
         self.cons_ptr += ((val >> 16) - self.cons_ptr) & MQNIC_QUEUE_PTR_MASK
 
     async def write_prod_ptr(self):
+        self.doorbells += 1
+        if self.latency is not None:
+            self.stamp_doorbell()
         await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_PROD_PTR | (self.prod_ptr & MQNIC_QUEUE_PTR_MASK))
 
+    def stamp_doorbell(self):
+        now = get_sim_time('ns')
+        for ptr in range(self.doorbell_ptr, self.prod_ptr):
+            self.doorbell_time[ptr & self.size_mask] = now
+        self.doorbell_ptr = self.prod_ptr
+
+    def stamp_completion(self, index, now):
+        self.latency.add(now - self.doorbell_time[index])
+        self.post_latency.add(now - self.post_time[index])
+
+    def occupancy(self):
+        return self.prod_ptr - self.cons_ptr
+
+    def prepare_desc(self, index, data, csum_cmd=0):
+        if isinstance(data, Packet) and data.buf is not None:
+            # zero-copy, DMA directly out of the packet buffer
+            pkt = data
+            ptr = pkt.buf.get_absolute_address(pkt.buf_offset)
+        else:
+            pkt = self.driver.alloc_pkt(len(data)+10)
+
+            # put data in packet buffer
+            pkt[10:len(data)+10] = data
+
+            ptr = pkt.get_absolute_address(0)+10
+
+        assert not self.tx_info[index]
+        self.tx_info[index] = pkt
+
+        if self.post_time is not None:
+            self.post_time[index] = get_sim_time('ns')
+
+        length = len(data)
+        offset = 0
+
+        # write descriptors
+        seg = min(length-offset, 42) if self.desc_block_size > 1 else length-offset
+        struct.pack_into("<HHLQ", self.buf, index*self.stride, 0, csum_cmd, seg, ptr+offset if seg else 0)
+        offset += seg
+        for k in range(1, self.desc_block_size):
+            seg = min(length-offset, 4096) if k < self.desc_block_size-1 else length-offset
+            struct.pack_into("<4xLQ", self.buf, index*self.stride+k*MQNIC_DESC_SIZE, seg, ptr+offset if seg else 0)
+            offset += seg
+
+    def prepare_desc_sg(self, index, frags, csum_cmd=0):
+        # one descriptor per fragment, excess fragments are linearized into the last one
+        frags = list(frags)
+        if len(frags) > self.desc_block_size:
+            tail = b''.join(bytes(f) for f in frags[self.desc_block_size-1:])
+            # zero-copy fragments were handed over, and are done with once copied
+            for f in frags[self.desc_block_size-1:]:
+                if isinstance(f, Packet):
+                    f.release()
+            frags = frags[:self.desc_block_size-1] + [tail]
+
+        assert not self.tx_info[index]
+
+        bufs = []
+        segs = []
+
+        for data in frags:
+            if isinstance(data, Packet) and data.buf is not None:
+                # zero-copy, DMA directly out of the packet buffer
+                pkt = data
+                ptr = pkt.buf.get_absolute_address(pkt.buf_offset)
+            else:
+                data = bytes(data)
+                pkt = self.driver.alloc_pkt(len(data))
+                pkt[0:len(data)] = data
+                ptr = pkt.get_absolute_address(0)
+
+            bufs.append(pkt)
+            segs.append((len(data), ptr))
+
+        self.tx_info[index] = bufs
+
+        if self.post_time is not None:
+            self.post_time[index] = get_sim_time('ns')
+
+        # write descriptors
+        for k in range(self.desc_block_size):
+            seg, ptr = segs[k] if k < len(segs) else (0, 0)
+            if k == 0:
+                struct.pack_into("<HHLQ", self.buf, index*self.stride, 0, csum_cmd, seg, ptr)
+            else:
+                struct.pack_into("<4xLQ", self.buf, index*self.stride+k*MQNIC_DESC_SIZE, seg, ptr)
+
+    def free_tx_buf(self, pkt):
+        if isinstance(pkt, Packet):
+            pkt.release()
+        else:
+            self.driver.free_pkt(pkt)
+
     def free_desc(self, index):
         pkt = self.tx_info[index]
-        self.driver.free_pkt(pkt)
+        if isinstance(pkt, list):
+            for p in pkt:
+                self.free_tx_buf(p)
+        else:
+            self.free_tx_buf(pkt)
         self.tx_info[index] = None
 
     def free_buf(self):
@@ -810,38 +1426,40 @@ class Txq:
             self.cons_ptr += 1
 
     @staticmethod
-    async def process_tx_cq(cq):
+    async def process_tx_cq(cq, budget=None):
         interface = cq.interface
+        log = interface.log
+        trace = log.isEnabledFor(logging.DEBUG)
 
-        interface.log.info("Process CQ %d for TXQ %d (interface %d)", cq.cqn, cq.src_ring.index, interface.index)
+        if trace:
+            log.debug("Process CQ %d for TXQ %d (interface %d)", cq.cqn, cq.src_ring.index, interface.index)
 
         ring = cq.src_ring
 
         if not interface.port_up:
-            return
+            return 0
 
         # process completion queue
-        cq_cons_ptr = cq.cons_ptr
-        cq_index = cq_cons_ptr & cq.size_mask
+        done = 0
+        now = get_sim_time('ns') if ring.latency is not None else None
 
-        while True:
-            cpl_data = struct.unpack_from("<HHHxxLHHLBBHLL", cq.buf, cq_index*cq.stride)
+        for cpl_data in cq.read_cpls(budget):
             ring_index = cpl_data[1] & ring.size_mask
 
-            interface.log.info("CQ %d index %d data: %s", cq.cqn, cq_index, repr(cpl_data))
+            if trace:
+                log.debug("CQ %d index %d data: %r", cq.cqn, (cq.cons_ptr+done) & cq.size_mask, cpl_data)
+                log.debug("Ring index: %d", ring_index)
 
-            if bool(cpl_data[-1] & 0x80000000) == bool(cq_cons_ptr & cq.size):
-                interface.log.info("CQ %d empty", cq.cqn)
-                break
-
-            interface.log.info("Ring index: %d", ring_index)
+            if now is not None:
+                ring.stamp_completion(ring_index, now)
 
             ring.free_desc(ring_index)
 
-            cq_cons_ptr += 1
-            cq_index = cq_cons_ptr & cq.size_mask
+            done += 1
+
+        interface.driver.event_counts['tx_cpl'] += done
 
-        cq.cons_ptr = cq_cons_ptr
+        cq.cons_ptr += done
         await cq.write_cons_ptr()
 
         # process ring
@@ -859,6 +1477,8 @@ class Txq:
 
         ring.clean_event.set()
 
+        return done
+
 
 class Rxq:
     def __init__(self, interface):
@@ -880,6 +1500,11 @@ class Rxq:
         self.buf_dma = 0
         self.buf = None
 
+        self.rx_buf_size = 0
+        self.rx_buf_min_size = None
+        self.fill_low = 0
+        self.fill_high = 0
+
         self.cq = None
 
         self.prod_ptr = 0
@@ -887,6 +1512,15 @@ class Rxq:
 
         self.packets = 0
         self.bytes = 0
+        self.doorbells = 0
+        self.refills = 0
+
+        # descriptor timestamps (sim time, ns) when driver.queue_timing is set
+        self.post_time = None
+        self.doorbell_time = None
+        self.doorbell_ptr = 0
+        self.latency = None
+        self.post_latency = None
 
         self.hw_regs = None
 
@@ -908,6 +1542,22 @@ class Rxq:
 
         self.rx_info = [None]*self.size
 
+        # size RX buffers for the MTU; in page split mode, pack several
+        # small buffers into each page instead of rounding up to pkt_buf_min_size
+        self.rx_buf_size = self.interface.rx_mtu or self.driver.pkt_buf_size
+        self.rx_buf_min_size = None
+        if self.interface.rx_page_split and self.rx_buf_size <= self.driver.pkt_page_size:
+            self.rx_buf_min_size = self.interface.rx_page_split_min_size
+
+        # refill when fewer than fill_low buffers are posted, up to fill_high
+        self.fill_high = self.size
+        if self.interface.rx_fill_high is not None:
+            self.fill_high = min(self.interface.rx_fill_high, self.size)
+        self.fill_low = self.size-8
+        if self.interface.rx_fill_low is not None:
+            self.fill_low = self.interface.rx_fill_low
+        self.fill_low = min(self.fill_low, self.fill_high-1)
+
         self.buf_size = self.size*self.stride
         self.buf_region = self.driver.pool.alloc_region(self.buf_size)
         self.buf_dma = self.buf_region.get_absolute_address(0)
@@ -916,6 +1566,13 @@ class Rxq:
         self.prod_ptr = 0
         self.cons_ptr = 0
 
+        if self.driver.queue_timing:
+            self.post_time = [0]*self.size
+            self.doorbell_time = [0]*self.size
+            self.doorbell_ptr = 0
+            self.latency = LatencyHistogram()
+            self.post_latency = LatencyHistogram()
+
         self.cq = cq
         self.cq.src_ring = self
         self.cq.handler = Rxq.process_rx_cq
@@ -978,8 +1635,24 @@ class Rxq:
         self.cons_ptr += ((val >> 16) - self.cons_ptr) & MQNIC_QUEUE_PTR_MASK
 
     async def write_prod_ptr(self):
+        self.doorbells += 1
+        if self.latency is not None:
+            self.stamp_doorbell()
         await self.hw_regs.write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_PROD_PTR | (self.prod_ptr & MQNIC_QUEUE_PTR_MASK))
 
+    def stamp_doorbell(self):
+        now = get_sim_time('ns')
+        for ptr in range(self.doorbell_ptr, self.prod_ptr):
+            self.doorbell_time[ptr & self.size_mask] = now
+        self.doorbell_ptr = self.prod_ptr
+
+    def stamp_completion(self, index, now):
+        self.latency.add(now - self.doorbell_time[index])
+        self.post_latency.add(now - self.post_time[index])
+
+    def occupancy(self):
+        return self.prod_ptr - self.cons_ptr
+
     def free_desc(self, index):
         pkt = self.rx_info[index]
         self.driver.free_pkt(pkt)
@@ -992,9 +1665,12 @@ class Rxq:
             self.cons_ptr += 1
 
     def prepare_desc(self, index):
-        pkt = self.driver.alloc_pkt()
+        pkt = self.driver.alloc_pkt(self.rx_buf_size, self.rx_buf_min_size)
         self.rx_info[index] = pkt
 
+        if self.post_time is not None:
+            self.post_time[index] = get_sim_time('ns')
+
         length = pkt.size
         ptr = pkt.get_absolute_address(0)
         offset = 0
@@ -1006,65 +1682,78 @@ class Rxq:
             offset += seg
 
     async def refill_buffers(self):
-        missing = self.size - (self.prod_ptr - self.cons_ptr)
+        posted = self.prod_ptr - self.cons_ptr
 
-        if missing < 8:
+        if posted > self.fill_low:
             return
 
-        for k in range(missing):
+        for k in range(self.fill_high - posted):
             self.prepare_desc(self.prod_ptr & self.size_mask)
             self.prod_ptr += 1
 
+        self.refills += 1
         await self.write_prod_ptr()
 
     @staticmethod
-    async def process_rx_cq(cq):
+    async def process_rx_cq(cq, budget=None):
         interface = cq.interface
+        log = interface.log
+        trace = log.isEnabledFor(logging.DEBUG)
 
-        interface.log.info("Process CQ %d for RXQ %d (interface %d)", cq.cqn, cq.src_ring.index, interface.index)
+        if trace:
+            log.debug("Process CQ %d for RXQ %d (interface %d)", cq.cqn, cq.src_ring.index, interface.index)
 
         ring = cq.src_ring
 
         if not interface.port_up:
-            return
+            return 0
 
         # process completion queue
-        cq_cons_ptr = cq.cons_ptr
-        cq_index = cq_cons_ptr & cq.size_mask
+        done = 0
+        now = get_sim_time('ns') if ring.latency is not None else None
 
-        while True:
-            cpl_data = struct.unpack_from("<HHHxxLHHLBBHLL", cq.buf, cq_index*cq.stride)
+        for cpl_data in cq.read_cpls(budget):
             ring_index = cpl_data[1] & ring.size_mask
 
-            interface.log.info("CQ %d index %d data: %s", cq.cqn, cq_index, repr(cpl_data))
+            if trace:
+                log.debug("CQ %d index %d data: %r", cq.cqn, (cq.cons_ptr+done) & cq.size_mask, cpl_data)
+                log.debug("Ring index: %d", ring_index)
 
-            if bool(cpl_data[-1] & 0x80000000) == bool(cq_cons_ptr & cq.size):
-                interface.log.info("CQ %d empty", cq.cqn)
-                break
+            if now is not None:
+                ring.stamp_completion(ring_index, now)
 
-            interface.log.info("Ring index: %d", ring_index)
             pkt = ring.rx_info[ring_index]
 
             length = cpl_data[2]
 
-            skb = Packet()
-            skb.data = pkt[:length]
+            if interface.rx_zero_copy:
+                # hand buffer over to the packet, released by the consumer
+                skb = Packet.from_buffer(pkt, 0, length)
+                ring.rx_info[ring_index] = None
+            else:
+                skb = Packet()
+                skb.data = pkt[:length]
+                ring.free_desc(ring_index)
+
             skb.queue = ring.index
             skb.timestamp_ns = cpl_data[3]
             skb.timestamp_s = cpl_data[4]
             skb.rx_checksum = cpl_data[5]
 
-            interface.log.info("Packet: %s", skb)
+            ring.packets += 1
+            ring.bytes += length
+
+            if trace:
+                log.debug("Packet: %s", skb)
 
             interface.pkt_rx_queue.append(skb)
             interface.pkt_rx_sync.set()
 
-            ring.free_desc(ring_index)
+            done += 1
 
-            cq_cons_ptr += 1
-            cq_index = cq_cons_ptr & cq.size_mask
+        interface.driver.event_counts['rx_cpl'] += done
 
-        cq.cons_ptr = cq_cons_ptr
+        cq.cons_ptr += done
         await cq.write_cons_ptr()
 
         # process ring
@@ -1083,6 +1772,8 @@ class Rxq:
         # replenish buffers
         await ring.refill_buffers()
 
+        return done
+
 
 class BaseScheduler:
     def __init__(self, port, index, rb):
@@ -1134,7 +1825,8 @@ class SchedulerBlock:
         # Read ID registers
 
         offset = await self.block_rb.read_dword(MQNIC_RB_SCHED_BLOCK_REG_OFFSET)
-        await self.reg_blocks.enumerate_reg_blocks(self.block_rb.parent, offset)
+        await self.driver.enumerate_reg_blocks(self.reg_blocks, f"if{self.interface.index}.sched{self.index}",
+            self.block_rb.parent, offset)
 
         self.schedulers = []
 
@@ -1176,7 +1868,8 @@ class Port:
         # Read ID registers
 
         offset = await self.port_rb.read_dword(MQNIC_RB_PORT_REG_OFFSET)
-        await self.reg_blocks.enumerate_reg_blocks(self.port_rb.parent, offset)
+        await self.driver.enumerate_reg_blocks(self.reg_blocks, f"if{self.interface.index}.port{self.index}",
+            self.port_rb.parent, offset)
 
         self.port_ctrl_rb = self.reg_blocks.find(MQNIC_RB_PORT_CTRL_TYPE, MQNIC_RB_PORT_CTRL_VER)
 
@@ -1187,12 +1880,12 @@ class Port:
 
         self.log.info("Port features: 0x%08x", self.port_features)
 
-        await self.set_tx_ctrl(0)
-        await self.set_rx_ctrl(0)
-        await self.set_lfc_ctrl(0)
-
-        for k in range(8):
-            await self.set_pfc_ctrl(k, 0)
+        await gather(
+            self.set_tx_ctrl(0),
+            self.set_rx_ctrl(0),
+            self.set_lfc_ctrl(0),
+            *(self.set_pfc_ctrl(k, 0) for k in range(8))
+        )
 
     async def get_tx_ctrl(self):
         return await self.port_ctrl_rb.read_dword(MQNIC_RB_PORT_CTRL_REG_TX_CTRL)
@@ -1245,6 +1938,8 @@ class Interface:
 
         self.max_tx_mtu = 0
         self.max_rx_mtu = 0
+        self.tx_mtu = 0
+        self.rx_mtu = 0
         self.tx_fifo_depth = 0
         self.rx_fifo_depth = 0
 
@@ -1259,6 +1954,11 @@ class Interface:
         self.rx_queue_map_indir_table_size = None
         self.rx_queue_map_indir_table = []
 
+        # shadow copies of the queue map registers for the RSS model
+        self.rss_key = MQNIC_RSS_HASH_KEY
+        self.rss_mask = []
+        self.rss_indir_table = []
+
         self.eq = []
 
         self.txq = []
@@ -1269,6 +1969,31 @@ class Interface:
         self.interrupt_running = False
         self.interrupt_pending = 0
 
+        # CQ poll mode (None for interrupt-driven processing)
+        self.poll_budget = None
+        self.poll_coalesce_time = 0
+
+        # deliver RX packets as views into DMA buffers, see Packet.release()
+        self.rx_zero_copy = False
+
+        # TX queue configuration and selection policy when no ring is specified
+        # (None for ring 0, 'hash', 'round_robin', or 'affinity' by caller flow key)
+        self.txq_size = 1024
+        self.txq_desc_block_size = 4
+        self.txq_desc_block_sizes = {}
+        self.tx_queue_policy = None
+        self.tx_queue_rr = 0
+        self.tx_queue_affinity = {}
+
+        # RX queue configuration, buffers are sized for rx_mtu
+        # (fill watermarks default to refilling once 8 buffers are consumed)
+        self.rxq_size = 1024
+        self.rxq_desc_block_size = 4
+        self.rx_fill_low = None
+        self.rx_fill_high = None
+        self.rx_page_split = False
+        self.rx_page_split_min_size = 256
+
         self.pkt_rx_queue = deque()
         self.pkt_rx_sync = Event()
 
@@ -1276,17 +2001,21 @@ class Interface:
         # Read ID registers
 
         # Enumerate registers
-        await self.reg_blocks.enumerate_reg_blocks(self.hw_regs, self.driver.if_csr_offset)
+        await self.driver.enumerate_reg_blocks(self.reg_blocks, f"if{self.index}",
+            self.hw_regs, self.driver.if_csr_offset)
 
         self.if_ctrl_rb = self.reg_blocks.find(MQNIC_RB_IF_CTRL_TYPE, MQNIC_RB_IF_CTRL_VER)
 
-        self.if_features = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_FEATURES)
-        self.port_count = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_PORT_COUNT)
-        self.sched_block_count = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_SCHED_COUNT)
-        self.max_tx_mtu = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_MAX_TX_MTU)
-        self.max_rx_mtu = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_MAX_RX_MTU)
-        self.tx_fifo_depth = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_TX_FIFO_DEPTH)
-        self.rx_fifo_depth = await self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_RX_FIFO_DEPTH)
+        (self.if_features, self.port_count, self.sched_block_count, self.max_tx_mtu,
+            self.max_rx_mtu, self.tx_fifo_depth, self.rx_fifo_depth) = await gather(
+            self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_FEATURES),
+            self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_PORT_COUNT),
+            self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_SCHED_COUNT),
+            self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_MAX_TX_MTU),
+            self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_MAX_RX_MTU),
+            self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_TX_FIFO_DEPTH),
+            self.if_ctrl_rb.read_dword(MQNIC_RB_IF_CTRL_REG_RX_FIFO_DEPTH)
+        )
 
         self.if_feature_rss = bool(self.if_features & MQNIC_IF_FEATURE_RSS)
         self.if_feature_ptp_ts = bool(self.if_features & MQNIC_IF_FEATURE_PTP_TS)
@@ -1306,9 +2035,11 @@ class Interface:
 
         self.eq_rb = self.reg_blocks.find(MQNIC_RB_EQM_TYPE, MQNIC_RB_EQM_VER)
 
-        offset = await self.eq_rb.read_dword(MQNIC_RB_EQM_REG_OFFSET)
-        count = await self.eq_rb.read_dword(MQNIC_RB_EQM_REG_COUNT)
-        stride = await self.eq_rb.read_dword(MQNIC_RB_EQM_REG_STRIDE)
+        offset, count, stride = await gather(
+            self.eq_rb.read_dword(MQNIC_RB_EQM_REG_OFFSET),
+            self.eq_rb.read_dword(MQNIC_RB_EQM_REG_COUNT),
+            self.eq_rb.read_dword(MQNIC_RB_EQM_REG_STRIDE)
+        )
 
         self.log.info("EQ offset: 0x%08x", offset)
         self.log.info("EQ count: %d", count)
@@ -1320,9 +2051,11 @@ class Interface:
 
         self.cq_rb = self.reg_blocks.find(MQNIC_RB_CQM_TYPE, MQNIC_RB_CQM_VER)
 
-        offset = await self.cq_rb.read_dword(MQNIC_RB_CQM_REG_OFFSET)
-        count = await self.cq_rb.read_dword(MQNIC_RB_CQM_REG_COUNT)
-        stride = await self.cq_rb.read_dword(MQNIC_RB_CQM_REG_STRIDE)
+        offset, count, stride = await gather(
+            self.cq_rb.read_dword(MQNIC_RB_CQM_REG_OFFSET),
+            self.cq_rb.read_dword(MQNIC_RB_CQM_REG_COUNT),
+            self.cq_rb.read_dword(MQNIC_RB_CQM_REG_STRIDE)
+        )
 
         self.log.info("CQ offset: 0x%08x", offset)
         self.log.info("CQ count: %d", count)
@@ -1334,9 +2067,11 @@ class Interface:
 
         self.txq_rb = self.reg_blocks.find(MQNIC_RB_TX_QM_TYPE, MQNIC_RB_TX_QM_VER)
 
-        offset = await self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_OFFSET)
-        count = await self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_COUNT)
-        stride = await self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_STRIDE)
+        offset, count, stride = await gather(
+            self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_OFFSET),
+            self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_COUNT),
+            self.txq_rb.read_dword(MQNIC_RB_TX_QM_REG_STRIDE)
+        )
 
         self.log.info("TXQ offset: 0x%08x", offset)
         self.log.info("TXQ count: %d", count)
@@ -1348,9 +2083,11 @@ class Interface:
 
         self.rxq_rb = self.reg_blocks.find(MQNIC_RB_RX_QM_TYPE, MQNIC_RB_RX_QM_VER)
 
-        offset = await self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_OFFSET)
-        count = await self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_COUNT)
-        stride = await self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_STRIDE)
+        offset, count, stride = await gather(
+            self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_OFFSET),
+            self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_COUNT),
+            self.rxq_rb.read_dword(MQNIC_RB_RX_QM_REG_STRIDE)
+        )
 
         self.log.info("RXQ offset: 0x%08x", offset)
         self.log.info("RXQ count: %d", count)
@@ -1365,6 +2102,8 @@ class Interface:
         val = await self.rx_queue_map_rb.read_dword(MQNIC_RB_RX_QUEUE_MAP_REG_CFG)
         self.rx_queue_map_indir_table_size = 2**((val >> 8) & 0xff)
         self.rx_queue_map_indir_table = []
+        self.rss_mask = [0]*self.port_count
+        self.rss_indir_table = [[0]*self.rx_queue_map_indir_table_size for k in range(self.port_count)]
         for k in range(self.port_count):
             offset = await self.rx_queue_map_rb.read_dword(MQNIC_RB_RX_QUEUE_MAP_CH_OFFSET +
                     MQNIC_RB_RX_QUEUE_MAP_CH_STRIDE*k + MQNIC_RB_RX_QUEUE_MAP_CH_REG_OFFSET)
@@ -1375,17 +2114,16 @@ class Interface:
             await self.set_rx_queue_map_indir_table(k, 0, 0)
 
         # ensure all queues are disabled
-        for k in range(self.eq_res.get_count()):
-            await self.eq_res.get_window(k).write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
-
-        for k in range(self.cq_res.get_count()):
-            await self.cq_res.get_window(k).write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
-
-        for k in range(self.txq_res.get_count()):
-            await self.txq_res.get_window(k).write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
-
-        for k in range(self.rxq_res.get_count()):
-            await self.rxq_res.get_window(k).write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
+        await pipelined(itertools.chain(
+            (self.eq_res.get_window(k).write_dword(MQNIC_EQ_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
+                for k in range(self.eq_res.get_count())),
+            (self.cq_res.get_window(k).write_dword(MQNIC_CQ_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
+                for k in range(self.cq_res.get_count())),
+            (self.txq_res.get_window(k).write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
+                for k in range(self.txq_res.get_count())),
+            (self.rxq_res.get_window(k).write_dword(MQNIC_QUEUE_CTRL_STATUS_REG, MQNIC_QUEUE_CMD_SET_ENABLE | 0)
+                for k in range(self.rxq_res.get_count()))
+        ))
 
         # create ports
         self.ports = []
@@ -1427,7 +2165,7 @@ class Interface:
             await cq.open(self.eq[k % len(self.eq)], 1024)
             await cq.arm()
             rxq = Rxq(self)
-            await rxq.open(cq, 1024, 4)
+            await rxq.open(cq, self.rxq_size, self.rxq_desc_block_size)
             await rxq.enable()
             self.rxq.append(rxq)
 
@@ -1436,7 +2174,7 @@ class Interface:
             await cq.open(self.eq[k % len(self.eq)], 1024)
             await cq.arm()
             txq = Txq(self)
-            await txq.open(cq, 1024, 4)
+            await txq.open(cq, self.txq_size, self.txq_desc_block_sizes.get(k, self.txq_desc_block_size))
             await txq.enable()
             self.txq.append(txq)
 
@@ -1479,74 +2217,198 @@ class Interface:
 
         await self.ports[0].set_tx_ctrl(0)
 
-    async def start_xmit(self, skb, tx_ring=None, csum_start=None, csum_offset=None):
+    def select_tx_queue(self, data, key=None):
+        count = len(self.txq)
+
+        if self.tx_queue_policy == 'hash':
+            if isinstance(data, Packet):
+                data = data.data
+            return flow_hash(data) % count
+        elif self.tx_queue_policy == 'round_robin':
+            # skip over full queues, unless they are all full
+            for k in range(count):
+                index = self.tx_queue_rr % count
+                self.tx_queue_rr += 1
+                if not self.txq[index].full():
+                    break
+            return index
+        elif self.tx_queue_policy == 'affinity':
+            # each producer key sticks to one queue, spread in order of first use
+            if key is None:
+                raise ValueError("Affinity TX queue policy requires a flow key")
+            if key not in self.tx_queue_affinity:
+                self.tx_queue_affinity[key] = len(self.tx_queue_affinity) % count
+            return self.tx_queue_affinity[key]
+        elif self.tx_queue_policy is None:
+            return 0
+
+        raise ValueError(f"Invalid TX queue policy: {self.tx_queue_policy}")
+
+    async def start_xmit(self, skb, tx_ring=None, csum_start=None, csum_offset=None, key=None):
         if not self.port_up:
             return
 
-        data = bytes(skb)
+        if isinstance(skb, Packet) and skb.buf is not None:
+            data = skb
+        else:
+            data = bytes(skb)
 
         assert len(data) < self.max_tx_mtu
 
         if tx_ring is not None:
             ring_index = tx_ring
         else:
-            ring_index = 0
+            ring_index = self.select_tx_queue(data, key)
 
         ring = self.txq[ring_index]
 
-        while True:
-            # check for space in ring
-            if ring.prod_ptr - ring.cons_ptr < ring.full_size:
-                break
-
-            # wait for space
-            ring.clean_event.clear()
-            await ring.clean_event.wait()
+        await ring.wait_for_space()
 
         index = ring.prod_ptr & ring.size_mask
 
         ring.packets += 1
         ring.bytes += len(data)
 
-        pkt = self.driver.alloc_pkt()
+        csum_cmd = 0
+
+        if csum_start is not None and csum_offset is not None:
+            csum_cmd = 0x8000 | (csum_offset << 8) | csum_start
 
-        assert not ring.tx_info[index]
-        ring.tx_info[index] = pkt
+        ring.prepare_desc(index, data, csum_cmd)
+
+        ring.prod_ptr += 1
 
-        # put data in packet buffer
-        pkt[10:len(data)+10] = data
+        self.driver.event_counts['tx_desc'] += 1
+
+        await ring.write_prod_ptr()
+
+    async def start_xmit_sg(self, frags, tx_ring=None, csum_start=None, csum_offset=None, key=None):
+        # frags is a list of buffers (e.g. header and page fragments), one descriptor each
+        if not self.port_up:
+            return
+
+        frags = list(frags)
+        length = sum(len(f) for f in frags)
+
+        assert length < self.max_tx_mtu
+
+        if tx_ring is not None:
+            ring_index = tx_ring
+        else:
+            ring_index = self.select_tx_queue(frags[0] if isinstance(frags[0], Packet) else bytes(frags[0]), key)
+
+        ring = self.txq[ring_index]
+
+        await ring.wait_for_space()
+
+        index = ring.prod_ptr & ring.size_mask
+
+        ring.packets += 1
+        ring.bytes += length
 
         csum_cmd = 0
 
         if csum_start is not None and csum_offset is not None:
             csum_cmd = 0x8000 | (csum_offset << 8) | csum_start
 
-        length = len(data)
-        ptr = pkt.get_absolute_address(0)+10
-        offset = 0
-
-        # write descriptors
-        seg = min(length-offset, 42) if ring.desc_block_size > 1 else length-offset
-        struct.pack_into("<HHLQ", ring.buf, index*ring.stride, 0, csum_cmd, seg, ptr+offset if seg else 0)
-        offset += seg
-        for k in range(1, ring.desc_block_size):
-            seg = min(length-offset, 4096) if k < ring.desc_block_size-1 else length-offset
-            struct.pack_into("<4xLQ", ring.buf, index*ring.stride+k*MQNIC_DESC_SIZE, seg, ptr+offset if seg else 0)
-            offset += seg
+        ring.prepare_desc_sg(index, frags, csum_cmd)
 
         ring.prod_ptr += 1
 
+        self.driver.event_counts['tx_desc'] += 1
+
         await ring.write_prod_ptr()
 
+    async def start_xmit_batch(self, pkts, tx_ring=None, csum=None, key=None):
+        # csum is a (csum_start, csum_offset) pair for the whole batch,
+        # or a sequence with a pair or None per packet
+        pkts = list(pkts)
+
+        if not self.port_up or not pkts:
+            return
+
+        if tx_ring is not None:
+            ring_index = tx_ring
+        else:
+            # whole batch goes to one queue, selected by the first packet
+            skb = pkts[0]
+            ring_index = self.select_tx_queue(skb if isinstance(skb, Packet) else bytes(skb), key)
+
+        ring = self.txq[ring_index]
+
+        if csum is None or (len(csum) == 2 and all(isinstance(x, int) for x in csum)):
+            # one (csum_start, csum_offset) pair for every packet
+            csum = [csum]*len(pkts)
+        else:
+            csum = list(csum)
+            assert len(csum) == len(pkts)
+
+        posted = False
+
+        for skb, c in zip(pkts, csum):
+            if isinstance(skb, Packet) and skb.buf is not None:
+                data = skb
+            else:
+                data = bytes(skb)
+
+            assert len(data) < self.max_tx_mtu
+
+            while True:
+                # check for space in ring
+                if ring.prod_ptr - ring.cons_ptr < ring.full_size:
+                    break
+
+                # ring doorbell for descriptors posted so far before waiting
+                if posted:
+                    await ring.write_prod_ptr()
+                    posted = False
+                    continue
+
+                # wait for space
+                ring.stalls += 1
+                ring.clean_event.clear()
+                await ring.clean_event.wait()
+
+            index = ring.prod_ptr & ring.size_mask
+
+            ring.packets += 1
+            ring.bytes += len(data)
+
+            csum_cmd = 0
+
+            if c is not None:
+                csum_start, csum_offset = c
+                csum_cmd = 0x8000 | (csum_offset << 8) | csum_start
+
+            ring.prepare_desc(index, data, csum_cmd)
+
+            ring.prod_ptr += 1
+            posted = True
+
+            self.driver.event_counts['tx_desc'] += 1
+
+        if posted:
+            await ring.write_prod_ptr()
+
+    async def start_xmit_tso(self, skb, mss, tx_ring=None, key=None):
+        # segment a TCP super-packet in software and post all segments with one doorbell
+        segs = tso_segment(bytes(skb), mss, self.if_feature_tx_csum)
+
+        await self.start_xmit_batch([seg for seg, csum in segs], tx_ring,
+            [csum for seg, csum in segs], key)
+
     async def set_mtu(self, mtu):
         await self.if_ctrl_rb.write_dword(MQNIC_RB_IF_CTRL_REG_TX_MTU, mtu)
         await self.if_ctrl_rb.write_dword(MQNIC_RB_IF_CTRL_REG_RX_MTU, mtu)
+        self.tx_mtu = mtu
+        self.rx_mtu = mtu
 
     async def get_rx_queue_map_rss_mask(self, port):
         return await self.rx_queue_map_rb.read_dword(MQNIC_RB_RX_QUEUE_MAP_CH_OFFSET +
             MQNIC_RB_RX_QUEUE_MAP_CH_STRIDE*port + MQNIC_RB_RX_QUEUE_MAP_CH_REG_RSS_MASK)
 
     async def set_rx_queue_map_rss_mask(self, port, val):
+        self.rss_mask[port] = val
         await self.rx_queue_map_rb.write_dword(MQNIC_RB_RX_QUEUE_MAP_CH_OFFSET +
             MQNIC_RB_RX_QUEUE_MAP_CH_STRIDE*port + MQNIC_RB_RX_QUEUE_MAP_CH_REG_RSS_MASK, val)
 
@@ -1562,8 +2424,48 @@ class Interface:
         return await self.rx_queue_map_indir_table[port].read_dword(index*4)
 
     async def set_rx_queue_map_indir_table(self, port, index, val):
+        self.rss_indir_table[port][index] = val
         await self.rx_queue_map_indir_table[port].write_dword(index*4, val)
 
+    async def set_rss_indir_table(self, port, weights=None, size=None):
+        # program the indirection table from per-queue weights (default: all RX queues
+        # equally), using the first size entries; returns the table
+        if weights is None:
+            weights = [1]*len(self.rxq)
+        if size is None:
+            size = self.rx_queue_map_indir_table_size
+
+        assert size & (size-1) == 0 and size <= self.rx_queue_map_indir_table_size
+
+        table = rss_indir_table(weights, size)
+
+        self.rss_indir_table[port][0:size] = table
+        await pipelined(self.rx_queue_map_indir_table[port].write_dword(k*4, q) for k, q in enumerate(table))
+        await self.set_rx_queue_map_rss_mask(port, size-1)
+
+        return table
+
+    def set_rss_key(self, key):
+        # the hash key is fixed in the RTL, this only changes the software model
+        if len(key) != 40:
+            raise ValueError("RSS key must be 40 bytes")
+        if bytes(key) != MQNIC_RSS_HASH_KEY:
+            self.log.warning("RSS key differs from hardware key, predictions will not match")
+        self.rss_key = bytes(key)
+
+    def predict_rx_queue(self, data, port=0):
+        index = rss_hash(data, self.rss_key) & self.rss_mask[port]
+        return self.rss_indir_table[port][index & (self.rx_queue_map_indir_table_size-1)]
+
+    def rss_spread(self, flows, port=0):
+        # predicted per-queue flow counts and imbalance for a set of packets
+        counts = Counter(self.predict_rx_queue(data, port) for data in flows)
+        return counts, imbalance(counts[q] for q in sorted(set(self.rss_indir_table[port][0:self.rss_mask[port]+1])))
+
+    async def read_cons_ptrs(self):
+        # refresh consumer pointers of all queues with pipelined reads
+        await pipelined(q.read_cons_ptr() for q in self.txq + self.rxq)
+
     async def recv(self):
         if not self.pkt_rx_queue:
             self.pkt_rx_sync.clear()
@@ -1581,12 +2483,390 @@ class Interface:
             await self.pkt_rx_sync.wait()
 
 
+class PacketTemplate:
+    def __init__(self, header=None, size=1514):
+        # header, then stream ID and sequence number, then precomputed payload
+        if header is None:
+            header = bytes.fromhex("dad1d2d3d4d5" "5a5152535455" "88b5")
+        self.header = bytes(header)
+        self.size = size
+        self.tag_offset = len(self.header)
+        self.payload = bytes(x % 256 for x in range(max(size-self.tag_offset-8, 0)))
+
+    def build(self, stream, seq):
+        return self.header + struct.pack("<LL", stream, seq) + self.payload
+
+    def parse(self, data):
+        return struct.unpack_from("<LL", bytes(data[self.tag_offset:self.tag_offset+8]))
+
+
+class TrafficGenerator:
+    def __init__(self, interface, template=None, queues=None, producers=1, rate=None, batch=1, stream_base=0):
+        self.interface = interface
+        self.log = interface.log
+        self.template = template or PacketTemplate()
+        self.queues = list(range(len(interface.txq))) if queues is None else list(queues)
+        self.producers = producers
+        self.batch = batch
+
+        # offset of stream IDs, for several generators sharing one checker
+        self.stream_base = stream_base
+
+        # aggregate rate limit in packets per second of sim time (None for unlimited)
+        self.rate = rate
+        self.next_time = 0
+
+        self.sent = 0
+        self.bytes = 0
+        self.stream_sent = []
+        self.start_time = None
+        self.end_time = None
+
+    def get_stream_count(self):
+        return len(self.queues)*self.producers
+
+    async def _throttle(self, count):
+        if not self.rate:
+            return
+        now = get_sim_time('ns')
+        slot = max(now, self.next_time)
+        self.next_time = slot + count*1e9/self.rate
+        if slot > now:
+            await Timer(round(slot-now), 'ns')
+
+    async def _run_producer(self, stream, queue, count, end_time=None):
+        seq = 0
+        while seq < count if end_time is None else get_sim_time('ns') < end_time:
+            n = self.batch if end_time is not None else min(self.batch, count-seq)
+            pkts = [self.template.build(self.stream_base+stream, seq+k) for k in range(n)]
+
+            await self._throttle(n)
+
+            if n == 1:
+                await self.interface.start_xmit(pkts[0], queue)
+            else:
+                await self.interface.start_xmit_batch(pkts, queue)
+
+            seq += n
+            self.sent += n
+            self.bytes += n*self.template.size
+            self.stream_sent[stream] = seq
+
+    async def run(self, count=None, duration=None):
+        # count packets split evenly over one stream per producer per queue,
+        # or as many as possible in duration ns of sim time
+        if (count is None) == (duration is None):
+            raise ValueError("Specify exactly one of count or duration")
+
+        streams = self.get_stream_count()
+        self.start_time = get_sim_time('ns')
+        self.next_time = self.start_time
+        self.stream_sent = [0]*streams
+
+        end_time = None if duration is None else self.start_time + duration
+
+        tasks = []
+        for stream in range(streams):
+            n = None if count is None else count // streams + (1 if stream < count % streams else 0)
+            queue = self.queues[stream // self.producers]
+            tasks.append(cocotb.start_soon(self._run_producer(stream, queue, n, end_time)))
+
+        for task in tasks:
+            await task
+
+        self.end_time = get_sim_time('ns')
+        return list(self.stream_sent)
+
+
+class TrafficChecker:
+    def __init__(self, interface, template=None):
+        self.interface = interface
+        self.log = interface.log
+        self.template = template or PacketTemplate()
+
+        self.next_seq = {}
+        self.missing_seq = {}
+        self.received = 0
+        self.bytes = 0
+        self.stream_received = Counter()
+        self.stream_bytes = Counter()
+        self.stream_queues = {}
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.corrupted = 0
+        self.csum_errors = 0
+        self.start_time = None
+        self.end_time = None
+
+    def check(self, pkt):
+        data = bytes(pkt.data)
+        stream, seq = self.template.parse(data)
+
+        self.received += 1
+        self.bytes += len(data)
+        self.stream_received[stream] += 1
+        self.stream_bytes[stream] += len(data)
+        self.stream_queues.setdefault(stream, set()).add(pkt.queue)
+        self.end_time = get_sim_time('ns')
+
+        if data != self.template.build(stream, seq):
+            self.corrupted += 1
+
+        if self.interface.if_feature_rx_csum and pkt.rx_checksum != ones_complement_sum(data[14:]):
+            self.csum_errors += 1
+
+        expected = self.next_seq.get(stream, 0)
+        missing = self.missing_seq.setdefault(stream, set())
+        if seq >= expected:
+            # gap counts as lost until the missing packets turn up late
+            self.lost += seq - expected
+            missing.update(range(expected, seq))
+            self.next_seq[stream] = seq+1
+        elif seq in missing:
+            missing.remove(seq)
+            self.lost -= 1
+            self.reordered += 1
+        else:
+            self.duplicates += 1
+
+    async def run(self, count=None):
+        # receive count packets, or until killed
+        if self.start_time is None:
+            self.start_time = get_sim_time('ns')
+
+        k = 0
+        while count is None or k < count:
+            k += 1
+            pkt = await self.interface.recv()
+            self.check(pkt)
+            pkt.release()
+
+    def finish(self, expected):
+        # packets never received at the end of the stream are lost too
+        # (expected is a per-stream list, or a dict of stream ID to count)
+        if not isinstance(expected, dict):
+            expected = dict(enumerate(expected))
+        for stream, n in expected.items():
+            expected_seq = self.next_seq.get(stream, 0)
+            self.lost += n - expected_seq
+            self.missing_seq.setdefault(stream, set()).update(range(expected_seq, n))
+            self.next_seq[stream] = n
+
+    def report(self):
+        elapsed = (self.end_time - self.start_time) if self.received else 0
+        return {
+            'received': self.received,
+            'bytes': self.bytes,
+            'lost': self.lost,
+            'reordered': self.reordered,
+            'duplicates': self.duplicates,
+            'corrupted': self.corrupted,
+            'csum_errors': self.csum_errors,
+            'sim_time_ns': elapsed,
+            'pps': self.received*1e9/elapsed if elapsed else None,
+            'gbps': self.bytes*8/elapsed if elapsed else None,
+        }
+
+
+async def run_traffic(interface, count=None, template=None, timeout=None, duration=None, **kwargs):
+    # generate count packets (or traffic for duration ns) and check what comes
+    # back (e.g. through a loopback)
+    template = template or PacketTemplate()
+    gen = TrafficGenerator(interface, template, **kwargs)
+    chk = TrafficChecker(interface, template)
+    chk.start_time = get_sim_time('ns')
+
+    rx = cocotb.start_soon(chk.run(count))
+    expected = await gen.run(count, duration)
+
+    if count is None:
+        # total is only known now, receive the remainder
+        rx.kill()
+        rx = cocotb.start_soon(chk.run(sum(expected) - chk.received))
+
+    if timeout is not None:
+        await First(rx.join(), Timer(timeout, 'ns', round_mode='round'))
+        if not rx.done():
+            rx.kill()
+    else:
+        await rx
+
+    chk.finish(expected)
+
+    report = chk.report()
+    report['sent'] = gen.sent
+    interface.log.info("Traffic report: %s", report)
+    return report
+
+
+async def run_traffic_concurrent(flows, count=None, template=None, timeout=None, duration=None, **kwargs):
+    # drive several flows at once, each a (interface, queues) pair with its own
+    # generator; flows on the same interface share a checker
+    template = template or PacketTemplate()
+    start_time = get_sim_time('ns')
+
+    checkers = {}
+    gens = []
+    for interface, queues in flows:
+        if interface not in checkers:
+            checkers[interface] = TrafficChecker(interface, template)
+            checkers[interface].start_time = start_time
+        base = sum(g.get_stream_count() for i, g in gens if i is interface)
+        gens.append((interface, TrafficGenerator(interface, template, queues=queues, stream_base=base, **kwargs)))
+
+    rx = {interface: cocotb.start_soon(chk.run()) for interface, chk in checkers.items()}
+
+    tx = [cocotb.start_soon(gen.run(count, duration)) for interface, gen in gens]
+    for task in tx:
+        await task
+
+    expected = {interface: {} for interface in checkers}
+    for interface, gen in gens:
+        for k, n in enumerate(gen.stream_sent):
+            expected[interface][gen.stream_base+k] = n
+
+    # totals are only known now, receive the remainder
+    for interface, chk in checkers.items():
+        rx[interface].kill()
+        rx[interface] = cocotb.start_soon(chk.run(sum(expected[interface].values()) - chk.received))
+
+    deadline = None if timeout is None else get_sim_time('ns') + timeout
+    for interface, task in rx.items():
+        if deadline is None:
+            await task
+            continue
+        remaining = deadline - get_sim_time('ns')
+        if remaining > 0:
+            await First(task.join(), Timer(remaining, 'ns', round_mode='round'))
+        if not task.done():
+            task.kill()
+
+    for interface, chk in checkers.items():
+        chk.finish(expected[interface])
+
+    end_time = max((chk.end_time for chk in checkers.values() if chk.received), default=start_time)
+    elapsed = end_time - start_time
+
+    report = {
+        'sent': sum(gen.sent for interface, gen in gens),
+        'received': 0,
+        'bytes': 0,
+        'lost': 0,
+        'reordered': 0,
+        'duplicates': 0,
+        'corrupted': 0,
+        'csum_errors': 0,
+        'sim_time_ns': elapsed,
+    }
+    for chk in checkers.values():
+        for key in ['received', 'bytes', 'lost', 'reordered', 'duplicates', 'corrupted', 'csum_errors']:
+            report[key] += getattr(chk, key)
+    report['pps'] = report['received']*1e9/elapsed if elapsed else None
+    report['gbps'] = report['bytes']*8/elapsed if elapsed else None
+
+    report['flows'] = []
+    for interface, gen in gens:
+        chk = checkers[interface]
+        streams = range(gen.stream_base, gen.stream_base+gen.get_stream_count())
+        received = sum(chk.stream_received[s] for s in streams)
+        rx_bytes = sum(chk.stream_bytes[s] for s in streams)
+        report['flows'].append({
+            'interface': interface.index,
+            'queues': gen.queues,
+            'sent': gen.sent,
+            'received': received,
+            'bytes': rx_bytes,
+            'rx_queues': sorted(set().union(*(chk.stream_queues.get(s, set()) for s in streams))),
+            'pps': received*1e9/elapsed if elapsed else None,
+            'gbps': rx_bytes*8/elapsed if elapsed else None,
+        })
+
+    log = gens[0][0].log
+    for flow in report['flows']:
+        log.info("Flow report: %s", flow)
+    log.info("Aggregate traffic report: %s", {k: v for k, v in report.items() if k != 'flows'})
+    return report
+
+
+class StatsSnapshot:
+    def __init__(self, time, values, deltas):
+        self.time = time
+        self.values = values
+        self.deltas = deltas
+
+    def __repr__(self):
+        return (
+            f'{type(self).__name__}(time={self.time}, '
+            f'values={self.values}, '
+            f'deltas={self.deltas})'
+        )
+
+    def __getitem__(self, key):
+        return self.deltas[key]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        # power of two buckets, bucket k counts values in [2**(k-1), 2**k)
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[int(value).bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        # upper bound of the bucket containing the p-th percentile
+        if not self.count:
+            return None
+        target = self.count*p/100
+        acc = 0
+        for k in sorted(self.buckets):
+            acc += self.buckets[k]
+            if acc >= target:
+                return min(2**k, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': {2**k: v for k, v in sorted(self.buckets.items())},
+        }
+
+
 class Interrupt:
     def __init__(self, index, handler=None):
         self.index = index
-        self.queue = Queue()
         self.handler = handler
 
+        # moderation: after the first interrupt, hold off the handler for up to
+        # moderation_time ns or until moderation_count interrupts are pending
+        self.moderation_time = 0
+        self.moderation_count = 1
+
+        self.pending = 0
+        self.pending_event = Event()
+
+        self.count = 0
+        self.handler_count = 0
+
         cocotb.start_soon(self._run())
 
     @classmethod
@@ -1596,19 +2876,47 @@ class Interrupt:
         cocotb.start_soon(obj._run_edge())
         return obj
 
+    def set_moderation(self, time=0, count=1):
+        # the EQ is only re-armed by the handler, so a count alone may never be reached
+        if count > 1 and not time:
+            raise ValueError("Interrupt moderation by count requires a moderation time")
+        self.moderation_time = time
+        self.moderation_count = max(count, 1)
+
     async def interrupt(self):
-        self.queue.put_nowait(None)
+        self.count += 1
+        self.pending += 1
+        self.pending_event.set()
 
     async def _run(self):
         while True:
-            await self.queue.get()
+            while not self.pending:
+                self.pending_event.clear()
+                await self.pending_event.wait()
+
+            if self.moderation_time:
+                # in whole simulator steps, so the remaining time is always exact
+                deadline = get_sim_time('step') + get_sim_steps(self.moderation_time, 'ns', round_mode='round')
+                while self.pending < self.moderation_count:
+                    now = get_sim_time('step')
+                    if now >= deadline:
+                        break
+                    self.pending_event.clear()
+                    await First(Timer(deadline-now, 'step'), self.pending_event.wait())
+
+                # one handler call services everything that accumulated
+                self.pending = 0
+            else:
+                self.pending -= 1
+
+            self.handler_count += 1
             if self.handler:
                 await self.handler(self.index)
 
     async def _run_edge(self):
         while True:
             await RisingEdge(self.signal)
-            self.interrupt()
+            await self.interrupt()
 
 
 class Driver:
@@ -1624,11 +2932,22 @@ class Driver:
 
         self.irq_sig = None
         self.irq_list = []
+        self.irq_eq_map = {}
 
         self.reg_blocks = RegBlockList()
         self.fw_id_rb = None
         self.if_rb = None
         self.phc_rb = None
+        self.stats_rb = None
+
+        self.stats_offset = None
+        self.stats_count = 0
+        self.stats_stride = None
+        self.stats_flags = None
+        self.stats_read_count = 64
+        self.stats_last = None
+        self.stats_series = []
+        self.stats_sampler = None
 
         self.fpga_id = None
         self.fw_id = None
@@ -1650,12 +2969,27 @@ class Driver:
         self.initialized = False
         self.interrupt_running = False
 
+        # hot path event counts, per-packet logging is only done at DEBUG level
+        self.event_counts = Counter()
+
         self.if_count = 1
         self.interfaces = []
 
+        self.topology = {}
+        self.topology_key = None
+        self.topology_cached = False
+        self.topology_fw_ids = None
+
         self.pkt_buf_size = 16384
-        self.allocated_packets = []
-        self.free_packets = deque()
+        self.pkt_buf_min_size = 2048
+        self.pkt_page_size = 4096
+        self.pkt_arena_size = 256*1024
+        self.pkt_pools = {}
+
+        # per-queue descriptor latency and occupancy instrumentation
+        self.queue_timing = False
+        self.queue_samples = []
+        self.queue_sampler = None
 
     async def init_pcie_dev(self, dev):
         assert not self.initialized
@@ -1705,27 +3039,39 @@ class Driver:
         if self.ram_hw_regs:
             self.log.info("RAM BAR size: %d", self.ram_hw_regs.size)
 
+        # Look up cached register block topology
+        await self.load_topology()
+
         # Enumerate registers
-        await self.reg_blocks.enumerate_reg_blocks(self.hw_regs)
+        await self.enumerate_reg_blocks(self.reg_blocks, "driver", self.hw_regs)
 
         # Read ID registers
         self.fw_id_rb = self.reg_blocks.find(MQNIC_RB_FW_ID_TYPE, MQNIC_RB_FW_ID_VER)
 
-        self.fpga_id = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FPGA_ID)
+        if self.topology_fw_ids is not None:
+            ids = self.topology_fw_ids
+        else:
+            ids = await gather(
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FPGA_ID),
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FW_ID),
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FW_VER),
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BOARD_ID),
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BOARD_VER),
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BUILD_DATE),
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_GIT_HASH),
+                self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_REL_INFO)
+            )
+
+        (self.fpga_id, self.fw_id, self.fw_ver, self.board_id, self.board_ver,
+            self.build_date, self.git_hash, self.rel_info) = ids
+
         self.log.info("FPGA JTAG ID: 0x%08x", self.fpga_id)
-        self.fw_id = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FW_ID)
         self.log.info("FW ID: 0x%08x", self.fw_id)
-        self.fw_ver = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_FW_VER)
         self.log.info("FW version: %d.%d.%d.%d", *self.fw_ver.to_bytes(4, 'big'))
-        self.board_id = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BOARD_ID)
         self.log.info("Board ID: 0x%08x", self.board_id)
-        self.board_ver = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BOARD_VER)
         self.log.info("Board version: %d.%d.%d.%d", *self.board_ver.to_bytes(4, 'big'))
-        self.build_date = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_BUILD_DATE)
         self.log.info("Build date: %s UTC (raw: 0x%08x)", datetime.datetime.utcfromtimestamp(self.build_date).isoformat(' '), self.build_date)
-        self.git_hash = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_GIT_HASH)
         self.log.info("Git hash: %08x", self.git_hash)
-        self.rel_info = await self.fw_id_rb.read_dword(MQNIC_RB_FW_ID_REG_REL_INFO)
         self.log.info("Release info: %d", self.rel_info)
 
         rb = self.reg_blocks.find(MQNIC_RB_APP_INFO_TYPE, MQNIC_RB_APP_INFO_VER)
@@ -1736,18 +3082,34 @@ class Driver:
 
         self.phc_rb = self.reg_blocks.find(MQNIC_RB_PHC_TYPE, MQNIC_RB_PHC_VER)
 
+        self.stats_rb = self.reg_blocks.find(MQNIC_RB_STATS_TYPE, MQNIC_RB_STATS_VER)
+
+        if self.stats_rb:
+            self.stats_offset, self.stats_count, self.stats_stride, self.stats_flags = await gather(
+                self.stats_rb.read_dword(MQNIC_RB_STATS_REG_OFFSET),
+                self.stats_rb.read_dword(MQNIC_RB_STATS_REG_COUNT),
+                self.stats_rb.read_dword(MQNIC_RB_STATS_REG_STRIDE),
+                self.stats_rb.read_dword(MQNIC_RB_STATS_REG_FLAGS)
+            )
+            self.log.info("Stats offset: 0x%08x", self.stats_offset)
+            self.log.info("Stats count: %d", self.stats_count)
+            self.log.info("Stats stride: 0x%08x", self.stats_stride)
+            self.log.info("Stats flags: 0x%08x", self.stats_flags)
+
         # Enumerate interfaces
         self.if_rb = self.reg_blocks.find(MQNIC_RB_IF_TYPE, MQNIC_RB_IF_VER)
         self.interfaces = []
 
         if self.if_rb:
-            self.if_offset = await self.if_rb.read_dword(MQNIC_RB_IF_REG_OFFSET)
+            self.if_offset, self.if_count, self.if_stride, self.if_csr_offset = await gather(
+                self.if_rb.read_dword(MQNIC_RB_IF_REG_OFFSET),
+                self.if_rb.read_dword(MQNIC_RB_IF_REG_COUNT),
+                self.if_rb.read_dword(MQNIC_RB_IF_REG_STRIDE),
+                self.if_rb.read_dword(MQNIC_RB_IF_REG_CSR_OFFSET)
+            )
             self.log.info("IF offset: %d", self.if_offset)
-            self.if_count = await self.if_rb.read_dword(MQNIC_RB_IF_REG_COUNT)
             self.log.info("IF count: %d", self.if_count)
-            self.if_stride = await self.if_rb.read_dword(MQNIC_RB_IF_REG_STRIDE)
             self.log.info("IF stride: 0x%08x", self.if_stride)
-            self.if_csr_offset = await self.if_rb.read_dword(MQNIC_RB_IF_REG_CSR_OFFSET)
             self.log.info("IF CSR offset: 0x%08x", self.if_csr_offset)
 
             for k in range(self.if_count):
@@ -1758,6 +3120,209 @@ class Driver:
         else:
             self.log.warning("No interface block found")
 
+        self.store_topology()
+
+    async def load_topology(self):
+        self.topology = {}
+        self.topology_key = None
+        self.topology_cached = False
+        self.topology_fw_ids = None
+
+        # build parameters are passed to the simulation as PARAM_* environment variables
+        params = sorted((k, v) for k, v in os.environ.items() if k.startswith("PARAM_"))
+
+        self.topology_key = "%08x" % zlib.crc32(repr((os.getenv("TOPLEVEL"), self.hw_regs.size, params)).encode())
+
+        if self.topology_key not in _topology_cache:
+            cache_file = os.environ.get("MQNIC_TOPOLOGY_CACHE")
+            if cache_file and os.path.exists(cache_file):
+                with open(cache_file, 'r') as f:
+                    _topology_cache.update(json.load(f))
+
+        entry = _topology_cache.get(self.topology_key)
+        if entry is None:
+            return
+
+        # single validation read: git hash from the cached firmware ID block
+        for rb_offset, rb_type, rb_version in entry['blocks'].get("driver", []):
+            if rb_type == MQNIC_RB_FW_ID_TYPE and rb_version == MQNIC_RB_FW_ID_VER:
+                break
+        else:
+            return
+
+        git_hash = await self.hw_regs.read_dword(rb_offset+MQNIC_RB_FW_ID_REG_GIT_HASH)
+        if git_hash != entry['fw_ids'][6]:
+            self.log.info("Cached register block topology is stale (key %s)", self.topology_key)
+            return
+
+        self.log.info("Using cached register block topology (key %s)", self.topology_key)
+        self.topology = entry['blocks']
+        self.topology_fw_ids = entry['fw_ids']
+        self.topology_cached = True
+
+    def store_topology(self):
+        if self.topology_key is None or self.topology_cached or not self.fw_id_rb:
+            return
+
+        entry = {
+            'fw_ids': [self.fpga_id, self.fw_id, self.fw_ver, self.board_id, self.board_ver,
+                self.build_date, self.git_hash, self.rel_info],
+            'blocks': self.topology,
+        }
+
+        _topology_cache[self.topology_key] = entry
+
+        cache_file = os.environ.get("MQNIC_TOPOLOGY_CACHE")
+        if cache_file:
+            cache = {}
+            if os.path.exists(cache_file):
+                with open(cache_file, 'r') as f:
+                    cache = json.load(f)
+            cache[self.topology_key] = entry
+            with open(cache_file+f".{os.getpid()}", 'w') as f:
+                json.dump(cache, f)
+            os.replace(cache_file+f".{os.getpid()}", cache_file)
+
+    async def enumerate_reg_blocks(self, reg_blocks, name, window, offset=0):
+        if self.topology_cached and name in self.topology:
+            await reg_blocks.enumerate_reg_blocks(window, offset, self.topology[name])
+        else:
+            await reg_blocks.enumerate_reg_blocks(window, offset)
+            self.topology[name] = reg_blocks.get_topology()
+
+    async def read_stats(self, count=None):
+        # snapshot of 64-bit statistics counters, with deltas from the previous snapshot
+        if not self.stats_rb:
+            return None
+
+        if count is None:
+            count = self.stats_read_count
+        count = min(count, self.stats_count)
+
+        offsets = []
+        for k in range(count):
+            offsets.append(self.stats_offset + k*self.stats_stride)
+            offsets.append(self.stats_offset + k*self.stats_stride + 4)
+
+        val = await read_dwords_pipelined(self.hw_regs, offsets)
+
+        values = {}
+        for k in range(count):
+            values[MQNIC_STATS_NAMES.get(k, f"stat_{k}")] = val[k*2] | (val[k*2+1] << 32)
+
+        last = self.stats_last.values if self.stats_last else {}
+        deltas = {name: v - last.get(name, 0) for name, v in values.items()}
+
+        self.stats_last = StatsSnapshot(get_sim_time('ns'), values, deltas)
+        return self.stats_last
+
+    def start_stats_sampling(self, period, units='ns', count=None):
+        self.stop_stats_sampling()
+        self.stats_series = []
+        self.stats_sampler = cocotb.start_soon(self._run_stats_sampling(period, units, count))
+
+    def stop_stats_sampling(self):
+        if self.stats_sampler is not None:
+            self.stats_sampler.kill()
+            self.stats_sampler = None
+        return self.stats_series
+
+    async def _run_stats_sampling(self, period, units, count):
+        while True:
+            self.stats_series.append(await self.read_stats(count))
+            await Timer(period, units)
+
+    def get_queues(self):
+        for i in self.interfaces:
+            for q in i.txq:
+                yield i, 'tx', q
+            for q in i.rxq:
+                yield i, 'rx', q
+
+    def sample_queues(self):
+        # ring occupancy and CQ depth from host memory, no MMIO
+        now = get_sim_time('ns')
+        samples = []
+        for i, kind, q in self.get_queues():
+            if not q.cq:
+                continue
+            samples.append({
+                'time': now,
+                'interface': i.index,
+                'queue': kind,
+                'index': q.index,
+                'occupancy': q.occupancy(),
+                'cq_depth': q.cq.depth(),
+            })
+        return samples
+
+    def start_queue_sampling(self, period, units='ns'):
+        self.stop_queue_sampling()
+        self.queue_samples = []
+        self.queue_sampler = cocotb.start_soon(self._run_queue_sampling(period, units))
+
+    def stop_queue_sampling(self):
+        if self.queue_sampler is not None:
+            self.queue_sampler.kill()
+            self.queue_sampler = None
+        return self.queue_samples
+
+    async def _run_queue_sampling(self, period, units):
+        while True:
+            self.queue_samples.extend(self.sample_queues())
+            await Timer(period, units)
+
+    def get_queue_stats(self):
+        stats = []
+        for i, kind, q in self.get_queues():
+            occ = [s['occupancy'] for s in self.queue_samples
+                if s['interface'] == i.index and s['queue'] == kind and s['index'] == q.index]
+            stats.append({
+                'interface': i.index,
+                'queue': kind,
+                'index': q.index,
+                'packets': q.packets,
+                'bytes': q.bytes,
+                'doorbells': q.doorbells,
+                'occupancy_mean': sum(occ)/len(occ) if occ else None,
+                'occupancy_max': max(occ) if occ else None,
+                'latency': q.latency.to_dict() if q.latency else None,
+                'post_latency': q.post_latency.to_dict() if q.post_latency else None,
+            })
+        return stats
+
+    def export_queue_stats(self, path):
+        # JSON with latency histograms and samples, or CSV with one row per queue
+        stats = self.get_queue_stats()
+
+        if str(path).endswith('.csv'):
+            fields = ['interface', 'queue', 'index', 'packets', 'bytes', 'doorbells',
+                'occupancy_mean', 'occupancy_max']
+            lat_fields = ['count', 'min', 'mean', 'p50', 'p99', 'max']
+            with open(path, 'w', newline='') as f:
+                w = csv.writer(f)
+                w.writerow(fields + [f"latency_{k}" for k in lat_fields] + [f"post_latency_{k}" for k in lat_fields])
+                for st in stats:
+                    row = [st[k] for k in fields]
+                    for name in ['latency', 'post_latency']:
+                        row += [st[name][k] if st[name] else None for k in lat_fields]
+                    w.writerow(row)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'queues': stats, 'samples': self.queue_samples}, f, indent=2)
+
+    def export_queue_samples(self, path):
+        fields = ['time', 'interface', 'queue', 'index', 'occupancy', 'cq_depth']
+
+        if str(path).endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                w = csv.DictWriter(f, fieldnames=fields)
+                w.writeheader()
+                w.writerows(self.queue_samples)
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.queue_samples, f, indent=2)
+
     async def _run_edge_interrupts(self, signal):
         last_val = 0
         count = len(signal)
@@ -1769,23 +3334,50 @@ class Driver:
                 await self.irq_list[index].interrupt()
 
     async def interrupt_handler(self, index):
-        self.log.info("Interrupt handler start (IRQ %d)", index)
-        for i in self.interfaces:
-            for eq in i.eq:
-                if eq.irq == index:
-                    await eq.process_eq()
-                    await eq.arm()
-        self.log.info("Interrupt handler end (IRQ %d)", index)
-
-    def alloc_pkt(self):
-        if self.free_packets:
-            return self.free_packets.popleft()
-
-        pkt = self.pool.alloc_region(self.pkt_buf_size)
-        self.allocated_packets.append(pkt)
-        return pkt
+        self.event_counts['irq'] += 1
+        self.log.debug("Interrupt handler start (IRQ %d)", index)
+        for eq in list(self.irq_eq_map.get(index, ())):
+            await eq.process_eq()
+            await eq.arm()
+        self.log.debug("Interrupt handler end (IRQ %d)", index)
+
+    def set_interrupt_moderation(self, time=0, count=1):
+        for irq in self.irq_list:
+            irq.set_moderation(time, count)
+
+    def get_interrupt_stats(self):
+        irqs = sum(irq.count for irq in self.irq_list)
+        handled = sum(irq.handler_count for irq in self.irq_list)
+        packets = 0
+        for i, kind, q in self.get_queues():
+            packets += q.packets
+        return {
+            'interrupts': irqs,
+            'handler_calls': handled,
+            'packets': packets,
+            'interrupts_per_packet': irqs / packets if packets else None,
+            'handler_calls_per_packet': handled / packets if packets else None,
+            'per_irq': {irq.index: (irq.count, irq.handler_count) for irq in self.irq_list if irq.count},
+        }
+
+    def alloc_pkt(self, size=None, min_size=None):
+        if size is None:
+            size = self.pkt_buf_size
+        if min_size is None:
+            min_size = self.pkt_buf_min_size
+
+        # round up to power of two size class; arenas are page multiples,
+        # so classes up to pkt_page_size never straddle a page
+        size = max(1 << (size-1).bit_length(), min_size)
+
+        pool = self.pkt_pools.get(size)
+        if pool is None:
+            pool = PacketBufferPool(self.pool, size, self.pkt_arena_size)
+            self.pkt_pools[size] = pool
+
+        return pool.alloc()
 
     def free_pkt(self, pkt):
         assert pkt is not None
-        assert pkt in self.allocated_packets
-        self.free_packets.append(pkt)
+        assert pkt.pool is self.pkt_pools.get(pkt.size)
+        pkt.pool.free(pkt)
@@ -1,7 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2021-2023 The Regents of the University of California
 
-import logging
 import os
 import struct
 import sys
@@ -10,201 +9,32 @@ import scapy.utils
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP, UDP
 
-import cocotb_test.simulator
 import pytest
 
 import cocotb
-from cocotb.log import SimLog
-from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge, Timer
 
-from cocotbext.axi import AxiStreamBus
-from cocotbext.axi import AddressSpace
-from cocotbext.axi import AxiLiteMaster, AxiLiteBus
-from cocotbext.axi import AxiSlave, AxiBus, SparseMemoryRegion
-from cocotbext.eth import EthMac
-
 try:
     import mqnic
+    import mqnic_tb
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_tb
     finally:
         del sys.path[0]
 
 
-class TB(object):
+class TB(mqnic_tb.BaseTB):
     def __init__(self, dut):
-        self.dut = dut
-
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
-
-        cocotb.start_soon(Clock(dut.clk, 4, units="ns").start())
+        super().__init__(dut)
 
         # AXI
-        self.address_space = AddressSpace()
-        self.pool = self.address_space.create_pool(0, 0x8000_0000)
-
-        self.axil_master = AxiLiteMaster(AxiLiteBus.from_prefix(dut, "s_axil_ctrl"), dut.clk, dut.rst)
-        self.address_space.register_region(self.axil_master, 0x10_0000_0000)
-        self.hw_regs = self.address_space.create_window(0x10_0000_0000, self.axil_master.size)
-
-        self.axi_slave = AxiSlave(AxiBus.from_prefix(dut, "m_axi"), dut.clk, dut.rst, self.address_space)
-
-        self.driver = mqnic.Driver()
-
-        core_inst = dut.core_inst
-
-        # Ethernet
-        self.port_mac = []
-
-        eth_int_if_width = len(core_inst.m_axis_tx_tdata) / len(core_inst.m_axis_tx_tvalid)
-        eth_clock_period = 6.4
-        eth_speed = 10e9
-
-        if eth_int_if_width == 64:
-            # 10G
-            eth_clock_period = 6.4
-            eth_speed = 10e9
-        elif eth_int_if_width == 128:
-            # 25G
-            eth_clock_period = 2.56
-            eth_speed = 25e9
-        elif eth_int_if_width == 512:
-            # 100G
-            eth_clock_period = 3.102
-            eth_speed = 100e9
-
-        for iface in core_inst.iface:
-            for k in range(len(iface.port)):
-                cocotb.start_soon(Clock(iface.port[k].port_rx_clk, eth_clock_period, units="ns").start())
-                cocotb.start_soon(Clock(iface.port[k].port_tx_clk, eth_clock_period, units="ns").start())
-
-                iface.port[k].port_rx_rst.setimmediatevalue(0)
-                iface.port[k].port_tx_rst.setimmediatevalue(0)
-
-                mac = EthMac(
-                    tx_clk=iface.port[k].port_tx_clk,
-                    tx_rst=iface.port[k].port_tx_rst,
-                    tx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_tx_inst, "m_axis_tx"),
-                    tx_ptp_time=iface.port[k].port_tx_ptp_ts_tod,
-                    tx_ptp_ts=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_ts,
-                    tx_ptp_ts_tag=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_tag,
-                    tx_ptp_ts_valid=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_valid,
-                    rx_clk=iface.port[k].port_rx_clk,
-                    rx_rst=iface.port[k].port_rx_rst,
-                    rx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_rx_inst, "s_axis_rx"),
-                    rx_ptp_time=iface.port[k].port_rx_ptp_ts_tod,
-                    ifg=12, speed=eth_speed
-                )
-
-                self.port_mac.append(mac)
-
-        dut.tx_status.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.tx_fc_quanta_clk_en.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.rx_status.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.rx_lfc_req.setimmediatevalue(0)
-        dut.rx_pfc_req.setimmediatevalue(0)
-        dut.rx_fc_quanta_clk_en.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-
-        # DDR
-        self.ddr_group_size = core_inst.DDR_GROUP_SIZE.value
-        self.ddr_ram = []
-        self.ddr_axi_if = []
-        if hasattr(core_inst, 'ddr'):
-            ram = None
-            for i, ch in enumerate(core_inst.ddr.dram_if_inst.ch):
-                cocotb.start_soon(Clock(ch.ch_clk, 3.332, units="ns").start())
-                ch.ch_rst.setimmediatevalue(0)
-                ch.ch_status.setimmediatevalue(1)
-
-                if i % self.ddr_group_size == 0:
-                    ram = SparseMemoryRegion()
-                    self.ddr_ram.append(ram)
-                self.ddr_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
-
-        # HBM
-        self.hbm_group_size = core_inst.HBM_GROUP_SIZE.value
-        self.hbm_ram = []
-        self.hbm_axi_if = []
-        if hasattr(core_inst, 'hbm'):
-            ram = None
-            for i, ch in enumerate(core_inst.hbm.dram_if_inst.ch):
-                cocotb.start_soon(Clock(ch.ch_clk, 2.222, units="ns").start())
-                ch.ch_rst.setimmediatevalue(0)
-                ch.ch_status.setimmediatevalue(1)
-
-                if i % self.hbm_group_size == 0:
-                    ram = SparseMemoryRegion()
-                    self.hbm_ram.append(ram)
-                self.hbm_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
-
-        dut.ctrl_reg_wr_wait.setimmediatevalue(0)
-        dut.ctrl_reg_wr_ack.setimmediatevalue(0)
-        dut.ctrl_reg_rd_data.setimmediatevalue(0)
-        dut.ctrl_reg_rd_wait.setimmediatevalue(0)
-        dut.ctrl_reg_rd_ack.setimmediatevalue(0)
-
-        cocotb.start_soon(Clock(dut.ptp_clk, 6.4, units="ns").start())
-        dut.ptp_rst.setimmediatevalue(0)
-        cocotb.start_soon(Clock(dut.ptp_sample_clk, 8, units="ns").start())
-
-        dut.s_axis_stat_tdata.setimmediatevalue(0)
-        dut.s_axis_stat_tid.setimmediatevalue(0)
-        dut.s_axis_stat_tvalid.setimmediatevalue(0)
-
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
-
-    async def init(self):
-
-        self.dut.rst.setimmediatevalue(0)
-        for mac in self.port_mac:
-            mac.rx.reset.setimmediatevalue(0)
-            mac.tx.reset.setimmediatevalue(0)
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-
-        await RisingEdge(self.dut.clk)
-        await RisingEdge(self.dut.clk)
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.setimmediatevalue(0)
-
-        self.dut.rst.value = 1
-        for mac in self.port_mac:
-            mac.rx.reset.value = 1
-            mac.tx.reset.value = 1
-
-        self.dut.ptp_rst.value = 1
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.value = 1
-
-        await RisingEdge(self.dut.clk)
-        await RisingEdge(self.dut.clk)
-
-        self.dut.rst.value = 0
-        for mac in self.port_mac:
-            mac.rx.reset.value = 0
-            mac.tx.reset.value = 0
-
-        self.dut.ptp_rst.value = 0
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.value = 0
-
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk)
+        self.init_axi_host(dut.clk, dut.rst)
 
-            if self.loopback_enable:
-                for mac in self.port_mac:
-                    if not mac.tx.empty():
-                        await mac.rx.send(await mac.tx.recv())
+        self.init_core(dut.core_inst, eth_prefix="")
 
 
 @cocotb.test()
@@ -214,21 +44,7 @@ async def run_test_nic(dut):
 
     await tb.init()
 
-    tb.log.info("Init driver")
-    await tb.driver.init_axi_dev(tb.pool, tb.hw_regs, irq=dut.irq)
-    for interface in tb.driver.interfaces:
-        await interface.open()
-
-    # enable queues
-    tb.log.info("Enable queues")
-    for interface in tb.driver.interfaces:
-        await interface.sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
-        for k in range(len(interface.txq)):
-            await interface.sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
-
-    # wait for all writes to complete
-    await tb.driver.hw_regs.read_dword(0)
-    tb.log.info("Init complete")
+    await tb.init_driver()
 
     tb.log.info("Send and receive single packet")
 
@@ -280,7 +96,7 @@ async def run_test_nic(dut):
 
     data = bytearray([x % 256 for x in range(1024)])
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, k)
@@ -294,7 +110,7 @@ async def run_test_nic(dut):
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
         assert pkt.queue == k
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, 0)
 
@@ -306,7 +122,7 @@ async def run_test_nic(dut):
         for k in range(4):
             await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, k, k)
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         queues = set()
 
@@ -336,7 +152,7 @@ async def run_test_nic(dut):
 
         assert len(queues) == 4
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
         await tb.driver.interfaces[0].set_rx_queue_map_rss_mask(0, 0)
 
@@ -346,7 +162,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -359,7 +175,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple TX queues")
 
@@ -367,7 +183,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(len(pkts)):
         await tb.driver.interfaces[0].start_xmit(pkts[k], k % len(tb.driver.interfaces[0].txq))
@@ -379,7 +195,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple large packets")
 
@@ -387,7 +203,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -400,7 +216,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Jumbo frames")
 
@@ -408,7 +224,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(9014)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -421,29 +237,27 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     if len(tb.driver.interfaces) > 1:
         tb.log.info("All interfaces")
 
         count = 64
 
-        pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
-
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
-        for k, p in enumerate(pkts):
-            await tb.driver.interfaces[k % len(tb.driver.interfaces)].start_xmit(p, 0)
+        # all interfaces concurrently, one flow each
+        report = await mqnic.run_traffic_concurrent([(interface, [0]) for interface in tb.driver.interfaces],
+            count // len(tb.driver.interfaces), mqnic.PacketTemplate(size=1514))
 
-        for k in range(count):
-            pkt = await tb.driver.interfaces[k % len(tb.driver.interfaces)].recv()
+        assert report['received'] == report['sent']
+        assert report['lost'] == 0
+        assert report['corrupted'] == 0
+        assert report['csum_errors'] == 0
+        for flow in report['flows']:
+            assert flow['received'] == flow['sent']
 
-            tb.log.info("Packet: %s", pkt)
-            assert pkt.data == pkts[k]
-            if tb.driver.interfaces[0].if_feature_rx_csum:
-                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
-
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     if len(tb.driver.interfaces[0].sched_blocks) > 1:
         tb.log.info("All interface 0 scheduler blocks")
@@ -462,28 +276,26 @@ async def run_test_nic(dut):
 
         count = 64
 
-        pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
-
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
-        queues = set()
+        # all ports concurrently, one flow per scheduler block
+        interface = tb.driver.interfaces[0]
+        report = await mqnic.run_traffic_concurrent([(interface, [block.index]) for block in interface.sched_blocks],
+            count // len(interface.sched_blocks), mqnic.PacketTemplate(size=1514))
 
-        for k, p in enumerate(pkts):
-            await tb.driver.interfaces[0].start_xmit(p, k % len(tb.driver.interfaces[0].sched_blocks))
-
-        for k in range(count):
-            pkt = await tb.driver.interfaces[0].recv()
+        assert report['received'] == report['sent']
+        assert report['lost'] == 0
+        assert report['corrupted'] == 0
+        assert report['csum_errors'] == 0
 
-            tb.log.info("Packet: %s", pkt)
-            # assert pkt.data == pkts[k]
-            if tb.driver.interfaces[0].if_feature_rx_csum:
-                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
-
-            queues.add(pkt.queue)
+        queues = set()
+        for flow in report['flows']:
+            assert flow['received'] == flow['sent']
+            queues.update(flow['rx_queues'])
 
-        assert len(queues) == len(tb.driver.interfaces[0].sched_blocks)
+        assert len(queues) == len(interface.sched_blocks)
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
         for block in tb.driver.interfaces[0].sched_blocks[1:]:
             await block.schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000000)
@@ -503,7 +315,7 @@ async def run_test_nic(dut):
 
         pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         for p in pkts:
             await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -516,7 +328,7 @@ async def run_test_nic(dut):
             if tb.driver.interfaces[0].if_feature_rx_csum:
                 assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     tb.log.info("Read statistics counters")
 
@@ -785,7 +597,7 @@ def test_mqnic_core_axi(request, if_count, ports_per_if, axi_data_width,
     sim_build = os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
-    cocotb_test.simulator.run(
+    mqnic_tb.run_sim(
         python_search=[tests_dir],
         verilog_sources=verilog_sources,
         toplevel=toplevel,
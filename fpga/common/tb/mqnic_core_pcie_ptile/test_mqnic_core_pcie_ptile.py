@@ -1,7 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2022-2023 The Regents of the University of California
 
-import logging
 import os
 import struct
 import sys
@@ -10,423 +9,50 @@ import scapy.utils
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP, UDP
 
-import cocotb_test.simulator
 import pytest
 
 import cocotb
-from cocotb.log import SimLog
-from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge, FallingEdge, Timer
+from cocotb.triggers import RisingEdge, Timer
 
-from cocotbext.axi import AxiStreamBus
-from cocotbext.axi import AxiSlave, AxiBus, SparseMemoryRegion
-from cocotbext.eth import EthMac
-from cocotbext.pcie.core import RootComplex
-from cocotbext.pcie.intel.ptile import PTilePcieDevice, PTileRxBus, PTileTxBus
+from cocotbext.pcie.intel.ptile import PTilePcieDevice
 
 try:
     import mqnic
+    import mqnic_tb
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_tb
     finally:
         del sys.path[0]
 
 
-class TB(object):
-    def __init__(self, dut, msix_count=32):
-        self.dut = dut
-
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
-
-        # PCIe
-        self.rc = RootComplex()
-
-        self.rc.max_payload_size = 0x1  # 256 bytes
-        self.rc.max_read_request_size = 0x2  # 512 bytes
-
-        self.dev = PTilePcieDevice(
-            # configuration options
-            pcie_generation=3,
-            # pcie_link_width=2,
-            # pld_clk_frequency=250e6,
-            pf_count=1,
-            max_payload_size=512,
-            enable_extended_tag=True,
-
-            pf0_msi_enable=False,
-            pf0_msi_count=1,
-            pf1_msi_enable=False,
-            pf1_msi_count=1,
-            pf2_msi_enable=False,
-            pf2_msi_count=1,
-            pf3_msi_enable=False,
-            pf3_msi_count=1,
-            pf0_msix_enable=True,
-            pf0_msix_table_size=msix_count-1,
-            pf0_msix_table_bir=0,
-            pf0_msix_table_offset=0x00010000,
-            pf0_msix_pba_bir=0,
-            pf0_msix_pba_offset=0x00018000,
-            pf1_msix_enable=False,
-            pf1_msix_table_size=0,
-            pf1_msix_table_bir=0,
-            pf1_msix_table_offset=0x00000000,
-            pf1_msix_pba_bir=0,
-            pf1_msix_pba_offset=0x00000000,
-            pf2_msix_enable=False,
-            pf2_msix_table_size=0,
-            pf2_msix_table_bir=0,
-            pf2_msix_table_offset=0x00000000,
-            pf2_msix_pba_bir=0,
-            pf2_msix_pba_offset=0x00000000,
-            pf3_msix_enable=False,
-            pf3_msix_table_size=0,
-            pf3_msix_table_bir=0,
-            pf3_msix_table_offset=0x00000000,
-            pf3_msix_pba_bir=0,
-            pf3_msix_pba_offset=0x00000000,
-
-            # signals
-            # Clock and reset
-            reset_status=dut.rst,
-            # reset_status_n=dut.reset_status_n,
-            coreclkout_hip=dut.clk,
-            # refclk0=dut.refclk0,
-            # refclk1=dut.refclk1,
-            # pin_perst_n=dut.pin_perst_n,
-
-            # RX interface
-            rx_bus=PTileRxBus.from_prefix(dut, "rx_st"),
-            # rx_par_err=dut.rx_par_err,
-
-            # TX interface
-            tx_bus=PTileTxBus.from_prefix(dut, "tx_st"),
-            # tx_par_err=dut.tx_par_err,
-
-            # RX flow control
-            rx_buffer_limit=dut.rx_buffer_limit,
-            rx_buffer_limit_tdm_idx=dut.rx_buffer_limit_tdm_idx,
-
-            # TX flow control
-            tx_cdts_limit=dut.tx_cdts_limit,
-            tx_cdts_limit_tdm_idx=dut.tx_cdts_limit_tdm_idx,
-
-            # Power management and hard IP status interface
-            # link_up=dut.link_up,
-            # dl_up=dut.dl_up,
-            # surprise_down_err=dut.surprise_down_err,
-            # ltssm_state=dut.ltssm_state,
-            # pm_state=dut.pm_state,
-            # pm_dstate=dut.pm_dstate,
-            # apps_pm_xmt_pme=dut.apps_pm_xmt_pme,
-            # app_req_retry_en=dut.app_req_retry_en,
-
-            # Interrupt interface
-            # app_int=dut.app_int,
-            # msi_pnd_func=dut.msi_pnd_func,
-            # msi_pnd_byte=dut.msi_pnd_byte,
-            # msi_pnd_addr=dut.msi_pnd_addr,
-
-            # Error interface
-            # serr_out=dut.serr_out,
-            # hip_enter_err_mode=dut.hip_enter_err_mode,
-            # app_err_valid=dut.app_err_valid,
-            # app_err_hdr=dut.app_err_hdr,
-            # app_err_info=dut.app_err_info,
-            # app_err_func_num=dut.app_err_func_num,
-
-            # Completion timeout interface
-            # cpl_timeout=dut.cpl_timeout,
-            # cpl_timeout_avmm_clk=dut.cpl_timeout_avmm_clk,
-            # cpl_timeout_avmm_address=dut.cpl_timeout_avmm_address,
-            # cpl_timeout_avmm_read=dut.cpl_timeout_avmm_read,
-            # cpl_timeout_avmm_readdata=dut.cpl_timeout_avmm_readdata,
-            # cpl_timeout_avmm_readdatavalid=dut.cpl_timeout_avmm_readdatavalid,
-            # cpl_timeout_avmm_write=dut.cpl_timeout_avmm_write,
-            # cpl_timeout_avmm_writedata=dut.cpl_timeout_avmm_writedata,
-            # cpl_timeout_avmm_waitrequest=dut.cpl_timeout_avmm_waitrequest,
-
-            # Configuration output
-            tl_cfg_func=dut.tl_cfg_func,
-            tl_cfg_add=dut.tl_cfg_add,
-            tl_cfg_ctl=dut.tl_cfg_ctl,
-            # dl_timer_update=dut.dl_timer_update,
-
-            # Configuration intercept interface
-            # cii_req=dut.cii_req,
-            # cii_hdr_poisoned=dut.cii_hdr_poisoned,
-            # cii_hdr_first_be=dut.cii_hdr_first_be,
-            # cii_func_num=dut.cii_func_num,
-            # cii_wr_vf_active=dut.cii_wr_vf_active,
-            # cii_vf_num=dut.cii_vf_num,
-            # cii_wr=dut.cii_wr,
-            # cii_addr=dut.cii_addr,
-            # cii_dout=dut.cii_dout,
-            # cii_override_en=dut.cii_override_en,
-            # cii_override_din=dut.cii_override_din,
-            # cii_halt=dut.cii_halt,
-
-            # Hard IP reconfiguration interface
-            # hip_reconfig_clk=dut.hip_reconfig_clk,
-            # hip_reconfig_address=dut.hip_reconfig_address,
-            # hip_reconfig_read=dut.hip_reconfig_read,
-            # hip_reconfig_readdata=dut.hip_reconfig_readdata,
-            # hip_reconfig_readdatavalid=dut.hip_reconfig_readdatavalid,
-            # hip_reconfig_write=dut.hip_reconfig_write,
-            # hip_reconfig_writedata=dut.hip_reconfig_writedata,
-            # hip_reconfig_waitrequest=dut.hip_reconfig_waitrequest,
-
-            # Page request service
-            # prs_event_valid=dut.prs_event_valid,
-            # prs_event_func=dut.prs_event_func,
-            # prs_event=dut.prs_event,
-
-            # SR-IOV (VF error)
-            # vf_err_ur_posted_s0=dut.vf_err_ur_posted_s0,
-            # vf_err_ur_posted_s1=dut.vf_err_ur_posted_s1,
-            # vf_err_ur_posted_s2=dut.vf_err_ur_posted_s2,
-            # vf_err_ur_posted_s3=dut.vf_err_ur_posted_s3,
-            # vf_err_func_num_s0=dut.vf_err_func_num_s0,
-            # vf_err_func_num_s1=dut.vf_err_func_num_s1,
-            # vf_err_func_num_s2=dut.vf_err_func_num_s2,
-            # vf_err_func_num_s3=dut.vf_err_func_num_s3,
-            # vf_err_ca_postedreq_s0=dut.vf_err_ca_postedreq_s0,
-            # vf_err_ca_postedreq_s1=dut.vf_err_ca_postedreq_s1,
-            # vf_err_ca_postedreq_s2=dut.vf_err_ca_postedreq_s2,
-            # vf_err_ca_postedreq_s3=dut.vf_err_ca_postedreq_s3,
-            # vf_err_vf_num_s0=dut.vf_err_vf_num_s0,
-            # vf_err_vf_num_s1=dut.vf_err_vf_num_s1,
-            # vf_err_vf_num_s2=dut.vf_err_vf_num_s2,
-            # vf_err_vf_num_s3=dut.vf_err_vf_num_s3,
-            # vf_err_poisonedwrreq_s0=dut.vf_err_poisonedwrreq_s0,
-            # vf_err_poisonedwrreq_s1=dut.vf_err_poisonedwrreq_s1,
-            # vf_err_poisonedwrreq_s2=dut.vf_err_poisonedwrreq_s2,
-            # vf_err_poisonedwrreq_s3=dut.vf_err_poisonedwrreq_s3,
-            # vf_err_poisonedcompl_s0=dut.vf_err_poisonedcompl_s0,
-            # vf_err_poisonedcompl_s1=dut.vf_err_poisonedcompl_s1,
-            # vf_err_poisonedcompl_s2=dut.vf_err_poisonedcompl_s2,
-            # vf_err_poisonedcompl_s3=dut.vf_err_poisonedcompl_s3,
-            # user_vfnonfatalmsg_func_num=dut.user_vfnonfatalmsg_func_num,
-            # user_vfnonfatalmsg_vfnum=dut.user_vfnonfatalmsg_vfnum,
-            # user_sent_vfnonfatalmsg=dut.user_sent_vfnonfatalmsg,
-            # vf_err_overflow=dut.vf_err_overflow,
-
-            # FLR
-            # flr_rcvd_pf=dut.flr_rcvd_pf,
-            # flr_rcvd_vf=dut.flr_rcvd_vf,
-            # flr_rcvd_pf_num=dut.flr_rcvd_pf_num,
-            # flr_rcvd_vf_num=dut.flr_rcvd_vf_num,
-            # flr_completed_pf=dut.flr_completed_pf,
-            # flr_completed_vf=dut.flr_completed_vf,
-            # flr_completed_pf_num=dut.flr_completed_pf_num,
-            # flr_completed_vf_num=dut.flr_completed_vf_num,
-
-            # VirtIO
-            # virtio_pcicfg_vfaccess=dut.virtio_pcicfg_vfaccess,
-            # virtio_pcicfg_vfnum=dut.virtio_pcicfg_vfnum,
-            # virtio_pcicfg_pfnum=dut.virtio_pcicfg_pfnum,
-            # virtio_pcicfg_bar=dut.virtio_pcicfg_bar,
-            # virtio_pcicfg_length=dut.virtio_pcicfg_length,
-            # virtio_pcicfg_baroffset=dut.virtio_pcicfg_baroffset,
-            # virtio_pcicfg_cfgdata=dut.virtio_pcicfg_cfgdata,
-            # virtio_pcicfg_cfgwr=dut.virtio_pcicfg_cfgwr,
-            # virtio_pcicfg_cfgrd=dut.virtio_pcicfg_cfgrd,
-            # virtio_pcicfg_appvfnum=dut.virtio_pcicfg_appvfnum,
-            # virtio_pcicfg_apppfnum=dut.virtio_pcicfg_apppfnum,
-            # virtio_pcicfg_rdack=dut.virtio_pcicfg_rdack,
-            # virtio_pcicfg_rdbe=dut.virtio_pcicfg_rdbe,
-            # virtio_pcicfg_data=dut.virtio_pcicfg_data,
-        )
-
-        # self.dev.log.setLevel(logging.DEBUG)
-
-        self.rc.make_port().connect(self.dev)
-
-        self.driver = mqnic.Driver()
-
-        self.dev.functions[0].configure_bar(0, 2**len(dut.core_pcie_inst.axil_ctrl_araddr), ext=True, prefetch=True)
-        if hasattr(dut.core_pcie_inst, 'pcie_app_ctrl'):
-            self.dev.functions[0].configure_bar(2, 2**len(dut.core_pcie_inst.axil_app_ctrl_araddr), ext=True, prefetch=True)
-
-        core_inst = dut.core_pcie_inst.core_inst
-
-        # Ethernet
-        self.port_mac = []
-
-        eth_int_if_width = len(core_inst.m_axis_tx_tdata) / len(core_inst.m_axis_tx_tvalid)
-        eth_clock_period = 6.4
-        eth_speed = 10e9
-
-        if eth_int_if_width == 64:
-            # 10G
-            eth_clock_period = 6.4
-            eth_speed = 10e9
-        elif eth_int_if_width == 128:
-            # 25G
-            eth_clock_period = 2.56
-            eth_speed = 25e9
-        elif eth_int_if_width == 512:
-            # 100G
-            eth_clock_period = 3.102
-            eth_speed = 100e9
-
-        for iface in core_inst.iface:
-            for k in range(len(iface.port)):
-                cocotb.start_soon(Clock(iface.port[k].port_rx_clk, eth_clock_period, units="ns").start())
-                cocotb.start_soon(Clock(iface.port[k].port_tx_clk, eth_clock_period, units="ns").start())
-
-                iface.port[k].port_rx_rst.setimmediatevalue(0)
-                iface.port[k].port_tx_rst.setimmediatevalue(0)
-
-                mac = EthMac(
-                    tx_clk=iface.port[k].port_tx_clk,
-                    tx_rst=iface.port[k].port_tx_rst,
-                    tx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_tx_inst, "m_axis_tx"),
-                    tx_ptp_time=iface.port[k].port_tx_ptp_ts_tod,
-                    tx_ptp_ts=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_ts,
-                    tx_ptp_ts_tag=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_tag,
-                    tx_ptp_ts_valid=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_valid,
-                    rx_clk=iface.port[k].port_rx_clk,
-                    rx_rst=iface.port[k].port_rx_rst,
-                    rx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_rx_inst, "s_axis_rx"),
-                    rx_ptp_time=iface.port[k].port_rx_ptp_ts_tod,
-                    ifg=12, speed=eth_speed
-                )
-
-                self.port_mac.append(mac)
-
-        dut.eth_tx_status.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.eth_tx_fc_quanta_clk_en.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.eth_rx_status.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-        dut.eth_rx_lfc_req.setimmediatevalue(0)
-        dut.eth_rx_pfc_req.setimmediatevalue(0)
-        dut.eth_rx_fc_quanta_clk_en.setimmediatevalue(2**len(core_inst.m_axis_tx_tvalid)-1)
-
-        # DDR
-        self.ddr_group_size = core_inst.DDR_GROUP_SIZE.value
-        self.ddr_ram = []
-        self.ddr_axi_if = []
-        if hasattr(core_inst, 'ddr'):
-            ram = None
-            for i, ch in enumerate(core_inst.ddr.dram_if_inst.ch):
-                cocotb.start_soon(Clock(ch.ch_clk, 3.332, units="ns").start())
-                ch.ch_rst.setimmediatevalue(0)
-                ch.ch_status.setimmediatevalue(1)
-
-                if i % self.ddr_group_size == 0:
-                    ram = SparseMemoryRegion()
-                    self.ddr_ram.append(ram)
-                self.ddr_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
-
-        # HBM
-        self.hbm_group_size = core_inst.HBM_GROUP_SIZE.value
-        self.hbm_ram = []
-        self.hbm_axi_if = []
-        if hasattr(core_inst, 'hbm'):
-            ram = None
-            for i, ch in enumerate(core_inst.hbm.dram_if_inst.ch):
-                cocotb.start_soon(Clock(ch.ch_clk, 2.222, units="ns").start())
-                ch.ch_rst.setimmediatevalue(0)
-                ch.ch_status.setimmediatevalue(1)
-
-                if i % self.hbm_group_size == 0:
-                    ram = SparseMemoryRegion()
-                    self.hbm_ram.append(ram)
-                self.hbm_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
-
-        dut.ctrl_reg_wr_wait.setimmediatevalue(0)
-        dut.ctrl_reg_wr_ack.setimmediatevalue(0)
-        dut.ctrl_reg_rd_data.setimmediatevalue(0)
-        dut.ctrl_reg_rd_wait.setimmediatevalue(0)
-        dut.ctrl_reg_rd_ack.setimmediatevalue(0)
-
-        cocotb.start_soon(Clock(dut.ptp_clk, 6.4, units="ns").start())
-        dut.ptp_rst.setimmediatevalue(0)
-        cocotb.start_soon(Clock(dut.ptp_sample_clk, 8, units="ns").start())
-
-        dut.s_axis_stat_tdata.setimmediatevalue(0)
-        dut.s_axis_stat_tid.setimmediatevalue(0)
-        dut.s_axis_stat_tvalid.setimmediatevalue(0)
-
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
-
-    async def init(self):
-
-        for mac in self.port_mac:
-            mac.rx.reset.setimmediatevalue(0)
-            mac.tx.reset.setimmediatevalue(0)
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.setimmediatevalue(0)
-
-        await RisingEdge(self.dut.clk)
-        await RisingEdge(self.dut.clk)
-
-        for mac in self.port_mac:
-            mac.rx.reset.setimmediatevalue(1)
-            mac.tx.reset.setimmediatevalue(1)
-
-        self.dut.ptp_rst.setimmediatevalue(1)
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.setimmediatevalue(1)
-
-        await FallingEdge(self.dut.rst)
-        await Timer(100, 'ns')
-
-        await RisingEdge(self.dut.clk)
-        await RisingEdge(self.dut.clk)
-
-        for mac in self.port_mac:
-            mac.rx.reset.setimmediatevalue(0)
-            mac.tx.reset.setimmediatevalue(0)
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-
-        for ram in self.ddr_axi_if + self.ddr_axi_if:
-            ram.write_if.reset.setimmediatevalue(0)
+class TB(mqnic_tb.BaseTB):
+    def __init__(self, dut):
+        super().__init__(dut)
 
-        await self.rc.enumerate()
+        if mqnic_tb.axi_host():
+            # transaction-level AXI host
+            self.init_axi_host(dut.clk, dut.rst)
 
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk)
+            self.init_core(dut.core_inst, eth_prefix="")
+        else:
+            # PCIe
+            self.init_pcie_dev(PTilePcieDevice, dut.core_pcie_inst, dut.clk, dut.rst)
 
-            if self.loopback_enable:
-                for mac in self.port_mac:
-                    if not mac.tx.empty():
-                        await mac.rx.send(await mac.tx.recv())
+            self.init_core(dut.core_pcie_inst.core_inst)
 
 
 @cocotb.test()
 async def run_test_nic(dut):
 
-    tb = TB(dut, msix_count=2**len(dut.core_pcie_inst.irq_index))
+    tb = TB(dut)
 
     await tb.init()
 
-    tb.log.info("Init driver")
-    await tb.driver.init_pcie_dev(tb.rc.find_device(tb.dev.functions[0].pcie_id))
-    for interface in tb.driver.interfaces:
-        await interface.open()
-
-    # enable queues
-    tb.log.info("Enable queues")
-    for interface in tb.driver.interfaces:
-        await interface.sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
-        for k in range(len(interface.txq)):
-            await interface.sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
-
-    # wait for all writes to complete
-    await tb.driver.hw_regs.read_dword(0)
-    tb.log.info("Init complete")
+    await tb.init_driver()
 
     tb.log.info("Send and receive single packet")
 
@@ -478,7 +104,7 @@ async def run_test_nic(dut):
 
     data = bytearray([x % 256 for x in range(1024)])
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, k)
@@ -492,7 +118,7 @@ async def run_test_nic(dut):
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
         assert pkt.queue == k
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, 0)
 
@@ -504,7 +130,7 @@ async def run_test_nic(dut):
         for k in range(4):
             await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, k, k)
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         queues = set()
 
@@ -534,7 +160,7 @@ async def run_test_nic(dut):
 
         assert len(queues) == 4
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
         await tb.driver.interfaces[0].set_rx_queue_map_rss_mask(0, 0)
 
@@ -544,7 +170,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -557,7 +183,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple TX queues")
 
@@ -565,7 +191,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(len(pkts)):
         await tb.driver.interfaces[0].start_xmit(pkts[k], k % len(tb.driver.interfaces[0].txq))
@@ -577,7 +203,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple large packets")
 
@@ -585,7 +211,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -598,7 +224,7 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Jumbo frames")
 
@@ -606,7 +232,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(9014)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -619,29 +245,27 @@ async def run_test_nic(dut):
         if tb.driver.interfaces[0].if_feature_rx_csum:
             assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     if len(tb.driver.interfaces) > 1:
         tb.log.info("All interfaces")
 
         count = 64
 
-        pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
-
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
-        for k, p in enumerate(pkts):
-            await tb.driver.interfaces[k % len(tb.driver.interfaces)].start_xmit(p, 0)
-
-        for k in range(count):
-            pkt = await tb.driver.interfaces[k % len(tb.driver.interfaces)].recv()
+        # all interfaces concurrently, one flow each
+        report = await mqnic.run_traffic_concurrent([(interface, [0]) for interface in tb.driver.interfaces],
+            count // len(tb.driver.interfaces), mqnic.PacketTemplate(size=1514))
 
-            tb.log.info("Packet: %s", pkt)
-            assert pkt.data == pkts[k]
-            if tb.driver.interfaces[0].if_feature_rx_csum:
-                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
+        assert report['received'] == report['sent']
+        assert report['lost'] == 0
+        assert report['corrupted'] == 0
+        assert report['csum_errors'] == 0
+        for flow in report['flows']:
+            assert flow['received'] == flow['sent']
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     if len(tb.driver.interfaces[0].sched_blocks) > 1:
         tb.log.info("All interface 0 scheduler blocks")
@@ -660,28 +284,26 @@ async def run_test_nic(dut):
 
         count = 64
 
-        pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
-
-        tb.loopback_enable = True
-
-        queues = set()
-
-        for k, p in enumerate(pkts):
-            await tb.driver.interfaces[0].start_xmit(p, k % len(tb.driver.interfaces[0].sched_blocks))
+        tb.loopback.enable = True
 
-        for k in range(count):
-            pkt = await tb.driver.interfaces[0].recv()
+        # all ports concurrently, one flow per scheduler block
+        interface = tb.driver.interfaces[0]
+        report = await mqnic.run_traffic_concurrent([(interface, [block.index]) for block in interface.sched_blocks],
+            count // len(interface.sched_blocks), mqnic.PacketTemplate(size=1514))
 
-            tb.log.info("Packet: %s", pkt)
-            # assert pkt.data == pkts[k]
-            if tb.driver.interfaces[0].if_feature_rx_csum:
-                assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
+        assert report['received'] == report['sent']
+        assert report['lost'] == 0
+        assert report['corrupted'] == 0
+        assert report['csum_errors'] == 0
 
-            queues.add(pkt.queue)
+        queues = set()
+        for flow in report['flows']:
+            assert flow['received'] == flow['sent']
+            queues.update(flow['rx_queues'])
 
-        assert len(queues) == len(tb.driver.interfaces[0].sched_blocks)
+        assert len(queues) == len(interface.sched_blocks)
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
         for block in tb.driver.interfaces[0].sched_blocks[1:]:
             await block.schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000000)
@@ -701,7 +323,7 @@ async def run_test_nic(dut):
 
         pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         for p in pkts:
             await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -714,7 +336,7 @@ async def run_test_nic(dut):
             if tb.driver.interfaces[0].if_feature_rx_csum:
                 assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     tb.log.info("Read statistics counters")
 
@@ -754,7 +376,7 @@ pcie_rtl_dir = os.path.abspath(os.path.join(lib_dir, 'pcie', 'rtl'))
             (1, 1, 512, 512, 512, 1),
         ])
 def test_mqnic_core_pcie_ptile(request, if_count, ports_per_if, pcie_data_width,
-        axis_eth_data_width, axis_eth_sync_data_width, ptp_ts_enable):
+        axis_eth_data_width, axis_eth_sync_data_width, ptp_ts_enable, axi_host=False):
     dut = "mqnic_core_pcie_ptile"
     module = os.path.splitext(os.path.basename(__file__))[0]
     toplevel = dut
@@ -1001,13 +623,20 @@ def test_mqnic_core_pcie_ptile(request, if_count, ports_per_if, pcie_data_width,
     parameters['STAT_INC_WIDTH'] = 24
     parameters['STAT_ID_WIDTH'] = 12
 
+    python_search = [tests_dir]
+
+    if axi_host:
+        # same core and test module on the AXI wrapper, no TLP modeling
+        verilog_sources, parameters = mqnic_tb.fast_host(verilog_sources, parameters)
+        toplevel = mqnic_tb.AXI_HOST_TOPLEVEL
+
     extra_env = {f'PARAM_{k}': str(v) for k, v in parameters.items()}
 
     sim_build = os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
-    cocotb_test.simulator.run(
-        python_search=[tests_dir],
+    mqnic_tb.run_sim(
+        python_search=python_search,
         verilog_sources=verilog_sources,
         toplevel=toplevel,
         module=module,
@@ -1015,3 +644,17 @@ def test_mqnic_core_pcie_ptile(request, if_count, ports_per_if, pcie_data_width,
         sim_build=sim_build,
         extra_env=extra_env,
     )
+
+
+# same test body on the AXI core wrapper, with register access and DMA through
+# transaction-level AXI models instead of the PCIe device model (faster)
+@pytest.mark.parametrize(("if_count", "ports_per_if",
+        "axis_eth_data_width", "axis_eth_sync_data_width", "ptp_ts_enable"), [
+            (1, 1, 64, 64, 1),
+            (2, 1, 64, 64, 1),
+            (1, 2, 64, 64, 1),
+        ])
+def test_mqnic_core_pcie_ptile_axi_host(request, if_count, ports_per_if,
+        axis_eth_data_width, axis_eth_sync_data_width, ptp_ts_enable):
+    test_mqnic_core_pcie_ptile(request, if_count, ports_per_if, 256,
+        axis_eth_data_width, axis_eth_sync_data_width, ptp_ts_enable, axi_host=True)
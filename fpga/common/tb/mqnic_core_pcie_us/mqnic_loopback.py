@@ -0,0 +1 @@
+../mqnic_loopback.py
\ No newline at end of file
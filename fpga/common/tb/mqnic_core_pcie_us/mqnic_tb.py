@@ -0,0 +1 @@
+../mqnic_tb.py
\ No newline at end of file
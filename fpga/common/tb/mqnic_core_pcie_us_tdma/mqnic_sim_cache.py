@@ -0,0 +1 @@
+../mqnic_sim_cache.py
\ No newline at end of file
@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import random
+
+import cocotb
+from cocotb.log import SimLog
+from cocotb.queue import Queue
+from cocotb.triggers import Event, Timer
+from cocotb.utils import get_sim_time
+
+
+class Loopback:
+    def __init__(self, links=None, delay=0, drop_rate=0, reorder_rate=0, seed=None, hold_timeout=1000):
+        self.log = SimLog("cocotb.mqnic.loopback")
+
+        self.links = []
+
+        # fault injection: fixed delay (ns), drop and reorder probabilities
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.reorder_rate = reorder_rate
+        # a reordered frame is sent alone if no other frame follows within this time (ns)
+        self.hold_timeout = hold_timeout
+        self.rand = random.Random(seed)
+
+        self.forwarded = 0
+        self.dropped = 0
+        self.reordered = 0
+
+        self._enable = False
+        self._enable_event = Event()
+
+        for sink, source in links or []:
+            self.add_link(sink, source)
+
+    @property
+    def enable(self):
+        return self._enable
+
+    @enable.setter
+    def enable(self, val):
+        self._enable = bool(val)
+        if self._enable:
+            self._enable_event.set()
+        else:
+            self._enable_event.clear()
+
+    def add_link(self, sink, source):
+        # frames received on sink (DUT TX) are sent back on source (DUT RX)
+        self.links.append((sink, source))
+        queue = Queue()
+        cocotb.start_soon(self._run_link_rx(sink, queue))
+        cocotb.start_soon(self._run_link_tx(queue, source))
+
+    async def _run_link_rx(self, sink, queue):
+        while True:
+            if not self._enable:
+                await self._enable_event.wait()
+
+            # sleep until a frame is available, no per-cycle polling
+            await sink.wait()
+
+            # frames that arrive while disabled are left for the test to receive
+            if not self._enable:
+                continue
+
+            frame = sink.recv_nowait()
+
+            if self.drop_rate and self.rand.random() < self.drop_rate:
+                self.dropped += 1
+                continue
+
+            # timestamp on arrival, so the delay adds latency without limiting throughput
+            queue.put_nowait((get_sim_time('ns') + self.delay, frame))
+
+    async def _run_link_tx(self, queue, source):
+        held = None
+
+        while True:
+            if held is not None and queue.empty():
+                # link idle: do not hold the last frame back indefinitely
+                await Timer(self.hold_timeout, 'ns')
+                if queue.empty():
+                    await source.send(held)
+                    self.forwarded += 1
+                    held = None
+                    continue
+
+            release, frame = await queue.get()
+
+            remaining = release - get_sim_time('ns')
+            if remaining > 0:
+                await Timer(remaining, 'ns', round_mode='round')
+
+            if held is None and self.reorder_rate and self.rand.random() < self.reorder_rate:
+                # hold this frame back and send it after the next one
+                held = frame
+                self.reordered += 1
+                continue
+
+            await source.send(frame)
+            self.forwarded += 1
+
+            if held is not None:
+                await source.send(held)
+                self.forwarded += 1
+                held = None
@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+# Content-addressed cache of compiled simulations (icarus .vvp files), shared
+# between testbenches, parametrizations, runs and concurrent xdist workers.
+#
+# Used by mqnic_tb.run_sim for the cocotb flow.  For flows that call iverilog
+# directly (e.g. MyHDL testbenches), put the iverilog_cache directory first
+# on PATH:
+#
+#   PATH=$PWD/fpga/common/tb/iverilog_cache:$PATH pytest fpga/lib/axi/tb
+#
+# MQNIC_SIM_BUILD_CACHE sets the cache directory (empty string to disable),
+# MQNIC_SIM_BUILD_CACHE_ENTRIES the number of entries kept (least recently
+# used are evicted first).
+
+import contextlib
+import fcntl
+import functools
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+SIM_BUILD_CACHE = os.environ.get("MQNIC_SIM_BUILD_CACHE",
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "sim_build_cache"))
+
+SIM_BUILD_CACHE_ENTRIES = int(os.environ.get("MQNIC_SIM_BUILD_CACHE_ENTRIES", "256"))
+
+# set while the cache is building, so a wrapped iverilog does not cache again
+NESTED_ENV = "MQNIC_SIM_BUILD_CACHE_NESTED"
+
+
+@functools.lru_cache()
+def get_tool_version(tool="iverilog"):
+    try:
+        out = subprocess.run([tool, "-V"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL, universal_newlines=True).stdout
+    except OSError:
+        return None
+    return out.splitlines()[0] if out else None
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def hash_dir(path):
+    # include directories: hash all Verilog files, as any may be included
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        if os.path.splitext(name)[1] in ('.v', '.vh', '.sv', '.svh'):
+            h.update(name.encode())
+            h.update(hash_file(os.path.join(path, name)))
+    return h.digest()
+
+
+@contextlib.contextmanager
+def locked(path, blocking=True):
+    while True:
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                # retry if the lock file was removed by evict() while waiting
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+
+    try:
+        yield
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def evict(cache=None, entries=None):
+    # drop least recently used entries and stale lock files; skip any another
+    # worker holds, and entries another worker removes while we scan
+    cache = cache or SIM_BUILD_CACHE
+    entries = SIM_BUILD_CACHE_ENTRIES if entries is None else entries
+
+    dirs = []
+    locks = []
+    for e in os.scandir(cache):
+        try:
+            if e.name.endswith(".lock"):
+                locks.append(e.path)
+            elif e.is_dir() and not e.name.startswith("build."):
+                dirs.append((e.stat().st_mtime, e.path))
+        except OSError:
+            pass
+
+    dirs.sort()
+
+    for mtime, path in dirs[:max(len(dirs)-entries, 0)]:
+        try:
+            with locked(path+".lock", blocking=False):
+                shutil.rmtree(path, ignore_errors=True)
+                os.unlink(path+".lock")
+        except OSError:
+            pass
+
+    for path in locks:
+        entry = path[:-len(".lock")]
+        if os.path.exists(entry) or not os.path.exists(path):
+            continue
+        try:
+            with locked(path, blocking=False):
+                # entry may have been built while we were not holding the lock
+                if not os.path.exists(entry):
+                    os.unlink(path)
+        except OSError:
+            pass
+
+
+def fetch(key, name, dest, build, cache=None):
+    # copy cached file name of entry key to dest, calling build(dir) on a miss
+    cache = cache or SIM_BUILD_CACHE
+    entry = os.path.join(cache, key)
+    built = False
+
+    os.makedirs(cache, exist_ok=True)
+
+    with locked(entry+".lock"):
+        if os.path.exists(os.path.join(entry, name)):
+            # mark as recently used
+            os.utime(entry)
+        else:
+            tmp_dir = tempfile.mkdtemp(prefix="build.", dir=cache)
+            os.environ[NESTED_ENV] = "1"
+            try:
+                build(tmp_dir)
+                shutil.rmtree(entry, ignore_errors=True)
+                os.replace(tmp_dir, entry)
+                built = True
+            finally:
+                del os.environ[NESTED_ENV]
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # fresh copy is newer than the sources, so make-style checks skip compilation
+        shutil.copyfile(os.path.join(entry, name), dest)
+
+    if built:
+        evict(cache)
+
+
+def find_tool(name):
+    # first match on PATH other than this wrapper
+    wrapper_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "iverilog_cache")
+    path = os.pathsep.join(p for p in os.environ.get("PATH", "").split(os.pathsep)
+        if p and os.path.realpath(p) != wrapper_dir)
+    return shutil.which(name, path=path)
+
+
+def iverilog_main(args):
+    # iverilog command line wrapper, caching the -o output
+    tool = find_tool("iverilog")
+    if tool is None:
+        print("iverilog not found", file=sys.stderr)
+        return 127
+
+    out = None
+    key_args = []
+    it = iter(args)
+    for arg in it:
+        if arg == "-o":
+            out = next(it, None)
+            continue
+        if arg.startswith("-o"):
+            out = arg[2:]
+            continue
+        key_args.append(arg)
+
+    if not SIM_BUILD_CACHE or os.getenv(NESTED_ENV) or out is None:
+        return subprocess.call([tool] + args)
+
+    h = hashlib.sha256()
+    h.update(repr(get_tool_version(tool)).encode())
+    for arg in key_args:
+        h.update(repr(arg).encode())
+        # sources and command files by content, include/library dirs by contents
+        path = arg[2:] if arg.startswith(("-I", "-y")) and len(arg) > 2 else arg
+        if os.path.isfile(path):
+            h.update(hash_file(path))
+        elif os.path.isdir(path):
+            h.update(hash_dir(path))
+
+    def build(tmp_dir):
+        subprocess.run([tool, "-o", os.path.join(tmp_dir, "out.vvp")] + key_args, check=True)
+
+    try:
+        fetch(h.hexdigest()[:32], "out.vvp", out, build)
+    except subprocess.CalledProcessError as e:
+        return e.returncode
+
+    return 0
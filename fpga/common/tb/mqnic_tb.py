@@ -0,0 +1,585 @@
+# SPDX-License-Identifier: BSD-2-Clause-Views
+# Copyright (c) 2023 The Regents of the University of California
+
+import hashlib
+import logging
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import cocotb
+import cocotb_test.simulator
+from cocotb.clock import Clock
+from cocotb.log import SimLog
+from cocotb.triggers import RisingEdge, FallingEdge, Timer
+
+from cocotbext.axi import AxiStreamBus
+from cocotbext.axi import AddressSpace
+from cocotbext.axi import AxiLiteMaster, AxiLiteBus
+from cocotbext.axi import AxiSlave, AxiBus, SparseMemoryRegion
+from cocotbext.eth import EthMac, XgmiiSource, XgmiiSink
+from cocotbext.pcie.core import RootComplex
+from cocotbext.pcie.intel.ptile import PTilePcieDevice, PTileRxBus, PTileTxBus
+from cocotbext.pcie.intel.s10 import S10PcieDevice, S10RxBus, S10TxBus
+from cocotbext.pcie.xilinx.us import UltraScalePcieDevice, UltraScalePlusPcieDevice
+
+try:
+    import mqnic
+    import mqnic_loopback
+    import mqnic_sim_cache
+except ImportError:
+    # attempt import from current directory
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
+    try:
+        import mqnic
+        import mqnic_loopback
+        import mqnic_sim_cache
+    finally:
+        del sys.path[0]
+
+
+class BaseTB(object):
+    def __init__(self, dut):
+        self.dut = dut
+
+        self.log = SimLog("cocotb.tb")
+        self.log.setLevel(logging.DEBUG)
+
+        # core clock and reset, and resets pulsed by init()
+        self.clk = None
+        self.rst = None
+        self.resets = []
+
+        self.rc = None
+        self.dev = None
+        self.pool = None
+        self.hw_regs = None
+        self.driver = mqnic.Driver()
+        self.loopback = None
+
+    def init_pcie_rc(self):
+        self.rc = RootComplex()
+
+        self.rc.max_payload_size = 0x1  # 256 bytes
+        self.rc.max_read_request_size = 0x2  # 512 bytes
+
+        return self.rc
+
+    def init_pcie_dev(self, dev_cls, core_pcie, clk, rst, pcie_if=None, **kwargs):
+        # PCIe hard IP model on the standard mqnic_core_pcie_* port names;
+        # kwargs set board specific options (link width, clock frequency)
+        dut = self.dut
+        msix_count = 2**len(core_pcie.irq_index)
+
+        self.init_pcie_rc()
+
+        args = dict(
+            pcie_generation=3,
+            pf_count=1,
+            enable_extended_tag=True,
+
+            pf0_msi_enable=False,
+            pf0_msi_count=32,
+            pf1_msi_enable=False,
+            pf1_msi_count=1,
+            pf0_msix_enable=True,
+            pf0_msix_table_size=msix_count-1,
+            pf0_msix_table_bir=0,
+            pf0_msix_table_offset=0x00010000,
+            pf0_msix_pba_bir=0,
+            pf0_msix_pba_offset=0x00018000,
+        )
+
+        pf_count = 2 if dev_cls is UltraScalePcieDevice else 4
+        for pf in range(1, pf_count):
+            if pf > 1:
+                args[f'pf{pf}_msi_enable'] = False
+                args[f'pf{pf}_msi_count'] = 1
+            args[f'pf{pf}_msix_enable'] = False
+            args[f'pf{pf}_msix_table_size'] = 0
+            args[f'pf{pf}_msix_table_bir'] = 0
+            args[f'pf{pf}_msix_table_offset'] = 0x00000000
+            args[f'pf{pf}_msix_pba_bir'] = 0
+            args[f'pf{pf}_msix_pba_offset'] = 0x00000000
+
+        if dev_cls in (UltraScalePcieDevice, UltraScalePlusPcieDevice):
+            rc_valid = pcie_if.pcie_us_if_rc_inst.rx_cpl_tlp_valid_reg
+
+            args.update(
+                user_clk_frequency=250e6,
+                alignment="dword",
+                rc_straddle=len(rc_valid) > 1,
+                max_payload_size=1024,
+                enable_client_tag=True,
+                enable_parity=False,
+                enable_rx_msg_interface=False,
+                enable_sriov=False,
+                enable_extended_configuration=False,
+
+                user_clk=clk,
+                user_reset=rst,
+                rq_bus=AxiStreamBus.from_prefix(dut, "m_axis_rq"),
+                rc_bus=AxiStreamBus.from_prefix(dut, "s_axis_rc"),
+                cq_bus=AxiStreamBus.from_prefix(dut, "s_axis_cq"),
+                cc_bus=AxiStreamBus.from_prefix(dut, "m_axis_cc"),
+                cfg_mgmt_addr=dut.cfg_mgmt_addr,
+                cfg_mgmt_write=dut.cfg_mgmt_write,
+                cfg_mgmt_write_data=dut.cfg_mgmt_write_data,
+                cfg_mgmt_byte_enable=dut.cfg_mgmt_byte_enable,
+                cfg_mgmt_read=dut.cfg_mgmt_read,
+                cfg_mgmt_read_data=dut.cfg_mgmt_read_data,
+                cfg_mgmt_read_write_done=dut.cfg_mgmt_read_write_done,
+                cfg_max_payload=dut.cfg_max_payload,
+                cfg_max_read_req=dut.cfg_max_read_req,
+                cfg_rcb_status=dut.cfg_rcb_status,
+                cfg_fc_ph=dut.cfg_fc_ph,
+                cfg_fc_pd=dut.cfg_fc_pd,
+                cfg_fc_nph=dut.cfg_fc_nph,
+                cfg_fc_npd=dut.cfg_fc_npd,
+                cfg_fc_cplh=dut.cfg_fc_cplh,
+                cfg_fc_cpld=dut.cfg_fc_cpld,
+                cfg_fc_sel=dut.cfg_fc_sel,
+                cfg_err_cor_in=dut.status_error_cor,
+                cfg_err_uncor_in=dut.status_error_uncor,
+                cfg_interrupt_msix_enable=dut.cfg_interrupt_msix_enable,
+                cfg_interrupt_msix_mask=dut.cfg_interrupt_msix_mask,
+                cfg_interrupt_msix_vf_enable=dut.cfg_interrupt_msix_vf_enable,
+                cfg_interrupt_msix_vf_mask=dut.cfg_interrupt_msix_vf_mask,
+                cfg_interrupt_msix_address=dut.cfg_interrupt_msix_address,
+                cfg_interrupt_msix_data=dut.cfg_interrupt_msix_data,
+                cfg_interrupt_msix_int=dut.cfg_interrupt_msix_int,
+                cfg_interrupt_msix_sent=dut.cfg_interrupt_msix_sent,
+                cfg_interrupt_msix_fail=dut.cfg_interrupt_msix_fail,
+                cfg_interrupt_msi_function_number=dut.cfg_interrupt_msi_function_number,
+            )
+
+            if dev_cls is UltraScalePlusPcieDevice:
+                args.update(
+                    cq_straddle=len(pcie_if.pcie_us_if_cq_inst.rx_req_tlp_valid_reg) > 1,
+                    cc_straddle=len(pcie_if.pcie_us_if_cc_inst.out_tlp_valid) > 1,
+                    rq_straddle=len(pcie_if.pcie_us_if_rq_inst.out_tlp_valid) > 1,
+                    rc_4tlp_straddle=len(rc_valid) > 2,
+
+                    pcie_rq_seq_num0=dut.s_axis_rq_seq_num_0,
+                    pcie_rq_seq_num_vld0=dut.s_axis_rq_seq_num_valid_0,
+                    pcie_rq_seq_num1=dut.s_axis_rq_seq_num_1,
+                    pcie_rq_seq_num_vld1=dut.s_axis_rq_seq_num_valid_1,
+                    cfg_mgmt_function_number=dut.cfg_mgmt_function_number,
+                    cfg_interrupt_msix_vec_pending=dut.cfg_interrupt_msix_vec_pending,
+                    cfg_interrupt_msix_vec_pending_status=dut.cfg_interrupt_msix_vec_pending_status,
+                )
+            else:
+                args.update(
+                    pcie_rq_seq_num=dut.s_axis_rq_seq_num,
+                    pcie_rq_seq_num_vld=dut.s_axis_rq_seq_num_valid,
+                )
+
+        elif dev_cls is S10PcieDevice:
+            args.update(
+                max_payload_size=1024,
+
+                reset_status=rst,
+                coreclkout_hip=clk,
+                rx_bus=S10RxBus.from_prefix(dut, "rx_st"),
+                tx_bus=S10TxBus.from_prefix(dut, "tx_st"),
+                tx_ph_cdts=dut.tx_ph_cdts,
+                tx_pd_cdts=dut.tx_pd_cdts,
+                tx_nph_cdts=dut.tx_nph_cdts,
+                tx_npd_cdts=dut.tx_npd_cdts,
+                tx_cplh_cdts=dut.tx_cplh_cdts,
+                tx_cpld_cdts=dut.tx_cpld_cdts,
+                tx_hdr_cdts_consumed=dut.tx_hdr_cdts_consumed,
+                tx_data_cdts_consumed=dut.tx_data_cdts_consumed,
+                tx_cdts_type=dut.tx_cdts_type,
+                tx_cdts_data_value=dut.tx_cdts_data_value,
+                tl_cfg_func=dut.tl_cfg_func,
+                tl_cfg_add=dut.tl_cfg_add,
+                tl_cfg_ctl=dut.tl_cfg_ctl,
+            )
+
+        elif dev_cls is PTilePcieDevice:
+            args.update(
+                max_payload_size=512,
+                pf0_msi_count=1,
+
+                reset_status=rst,
+                coreclkout_hip=clk,
+                rx_bus=PTileRxBus.from_prefix(dut, "rx_st"),
+                tx_bus=PTileTxBus.from_prefix(dut, "tx_st"),
+                rx_buffer_limit=dut.rx_buffer_limit,
+                rx_buffer_limit_tdm_idx=dut.rx_buffer_limit_tdm_idx,
+                tx_cdts_limit=dut.tx_cdts_limit,
+                tx_cdts_limit_tdm_idx=dut.tx_cdts_limit_tdm_idx,
+                tl_cfg_func=dut.tl_cfg_func,
+                tl_cfg_add=dut.tl_cfg_add,
+                tl_cfg_ctl=dut.tl_cfg_ctl,
+            )
+
+        else:
+            raise Exception(f"Unsupported PCIe device model {dev_cls.__name__}")
+
+        args.update(kwargs)
+
+        self.dev = dev_cls(**args)
+
+        self.rc.make_port().connect(self.dev)
+
+        self.dev.functions[0].configure_bar(0, 2**len(core_pcie.axil_ctrl_araddr), ext=True, prefetch=True)
+        if hasattr(core_pcie, 'pcie_app_ctrl'):
+            self.dev.functions[0].configure_bar(2, 2**len(core_pcie.axil_app_ctrl_araddr), ext=True, prefetch=True)
+
+        # core reset comes from the device model
+        self.clk = clk
+        self.rst = rst
+
+        return self.dev
+
+    def init_axi_host(self, clk, rst, period=4):
+        # AXI-lite register access and AXI DMA into host memory
+        cocotb.start_soon(Clock(clk, period, units="ns").start())
+
+        self.address_space = AddressSpace()
+        self.pool = self.address_space.create_pool(0, 0x8000_0000)
+
+        self.axil_master = AxiLiteMaster(AxiLiteBus.from_prefix(self.dut, "s_axil_ctrl"), clk, rst)
+        self.address_space.register_region(self.axil_master, 0x10_0000_0000)
+        self.hw_regs = self.address_space.create_window(0x10_0000_0000, self.axil_master.size)
+
+        self.axi_slave = AxiSlave(AxiBus.from_prefix(self.dut, "m_axi"), clk, rst, self.address_space)
+
+        # core reset driven by init()
+        self.clk = clk
+        self.rst = rst
+        self.resets.append(rst)
+
+    def init_ptp_clk(self, period=6.4, sample_period=8):
+        cocotb.start_soon(Clock(self.dut.ptp_clk, period, units="ns").start())
+        self.dut.ptp_rst.setimmediatevalue(0)
+        cocotb.start_soon(Clock(self.dut.ptp_sample_clk, sample_period, units="ns").start())
+
+        self.resets.append(self.dut.ptp_rst)
+
+    def init_xgmii_port(self, obj, prefix, suffix="", period=6.4):
+        # XGMII port named <prefix>rxd<suffix>, <prefix>rx_clk<suffix>, etc.
+        def sig(name):
+            return getattr(obj, prefix+name+suffix)
+
+        cocotb.start_soon(Clock(sig("rx_clk"), period, units="ns").start())
+        source = XgmiiSource(sig("rxd"), sig("rxc"), sig("rx_clk"), sig("rx_rst"))
+        cocotb.start_soon(Clock(sig("tx_clk"), period, units="ns").start())
+        sink = XgmiiSink(sig("txd"), sig("txc"), sig("tx_clk"), sig("tx_rst"))
+
+        sig("rx_status").setimmediatevalue(1)
+        if hasattr(obj, prefix+"rx_error_count"+suffix):
+            sig("rx_error_count").setimmediatevalue(0)
+
+        self.resets.extend([sig("rx_rst"), sig("tx_rst")])
+
+        return source, sink
+
+    def init_eth_mac(self, obj, prefix, period=3.102, speed=100e9):
+        # AXI stream MAC interface named <prefix>tx_axis, <prefix>tx_clk, etc.
+        def sig(name):
+            return getattr(obj, prefix+name)
+
+        cocotb.start_soon(Clock(sig("rx_clk"), period, units="ns").start())
+        cocotb.start_soon(Clock(sig("tx_clk"), period, units="ns").start())
+
+        mac = EthMac(
+            tx_clk=sig("tx_clk"),
+            tx_rst=sig("tx_rst"),
+            tx_bus=AxiStreamBus.from_prefix(obj, prefix+"tx_axis"),
+            tx_ptp_time=sig("tx_ptp_time"),
+            tx_ptp_ts=sig("tx_ptp_ts"),
+            tx_ptp_ts_tag=sig("tx_ptp_ts_tag"),
+            tx_ptp_ts_valid=sig("tx_ptp_ts_valid"),
+            rx_clk=sig("rx_clk"),
+            rx_rst=sig("rx_rst"),
+            rx_bus=AxiStreamBus.from_prefix(obj, prefix+"rx_axis"),
+            rx_ptp_time=sig("rx_ptp_time"),
+            ifg=12, speed=speed
+        )
+
+        sig("rx_status").setimmediatevalue(1)
+        if hasattr(obj, prefix+"rx_lfc_req"):
+            sig("rx_lfc_req").setimmediatevalue(0)
+            sig("rx_pfc_req").setimmediatevalue(0)
+
+        self.resets.extend([sig("rx_rst"), sig("tx_rst")])
+
+        return mac
+
+    def init_core(self, core_inst, eth_prefix="eth_"):
+        # mqnic_core testbenches: MACs on the core ports, DDR/HBM models, tie-offs
+        dut = self.dut
+
+        # Ethernet
+        self.port_mac = []
+
+        eth_int_if_width = len(core_inst.m_axis_tx_tdata) / len(core_inst.m_axis_tx_tvalid)
+        eth_clock_period = 6.4
+        eth_speed = 10e9
+
+        if eth_int_if_width == 64:
+            # 10G
+            eth_clock_period = 6.4
+            eth_speed = 10e9
+        elif eth_int_if_width == 128:
+            # 25G
+            eth_clock_period = 2.56
+            eth_speed = 25e9
+        elif eth_int_if_width == 512:
+            # 100G
+            eth_clock_period = 3.102
+            eth_speed = 100e9
+
+        for iface in core_inst.iface:
+            for k in range(len(iface.port)):
+                cocotb.start_soon(Clock(iface.port[k].port_rx_clk, eth_clock_period, units="ns").start())
+                cocotb.start_soon(Clock(iface.port[k].port_tx_clk, eth_clock_period, units="ns").start())
+
+                iface.port[k].port_rx_rst.setimmediatevalue(0)
+                iface.port[k].port_tx_rst.setimmediatevalue(0)
+
+                mac = EthMac(
+                    tx_clk=iface.port[k].port_tx_clk,
+                    tx_rst=iface.port[k].port_tx_rst,
+                    tx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_tx_inst, "m_axis_tx"),
+                    tx_ptp_time=iface.port[k].port_tx_ptp_ts_tod,
+                    tx_ptp_ts=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_ts,
+                    tx_ptp_ts_tag=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_tag,
+                    tx_ptp_ts_valid=iface.interface_inst.port[k].port_inst.port_tx_inst.s_axis_tx_cpl_valid,
+                    rx_clk=iface.port[k].port_rx_clk,
+                    rx_rst=iface.port[k].port_rx_rst,
+                    rx_bus=AxiStreamBus.from_prefix(iface.interface_inst.port[k].port_inst.port_rx_inst, "s_axis_rx"),
+                    rx_ptp_time=iface.port[k].port_rx_ptp_ts_tod,
+                    ifg=12, speed=eth_speed
+                )
+
+                self.port_mac.append(mac)
+                self.resets.extend([mac.rx.reset, mac.tx.reset])
+
+        port_mask = 2**len(core_inst.m_axis_tx_tvalid)-1
+        getattr(dut, eth_prefix+"tx_status").setimmediatevalue(port_mask)
+        getattr(dut, eth_prefix+"tx_fc_quanta_clk_en").setimmediatevalue(port_mask)
+        getattr(dut, eth_prefix+"rx_status").setimmediatevalue(port_mask)
+        getattr(dut, eth_prefix+"rx_lfc_req").setimmediatevalue(0)
+        getattr(dut, eth_prefix+"rx_pfc_req").setimmediatevalue(0)
+        getattr(dut, eth_prefix+"rx_fc_quanta_clk_en").setimmediatevalue(port_mask)
+
+        # DDR
+        self.ddr_group_size = core_inst.DDR_GROUP_SIZE.value
+        self.ddr_ram = []
+        self.ddr_axi_if = []
+        if hasattr(core_inst, 'ddr'):
+            ram = None
+            for i, ch in enumerate(core_inst.ddr.dram_if_inst.ch):
+                cocotb.start_soon(Clock(ch.ch_clk, 3.332, units="ns").start())
+                ch.ch_rst.setimmediatevalue(0)
+                ch.ch_status.setimmediatevalue(1)
+
+                if i % self.ddr_group_size == 0:
+                    ram = SparseMemoryRegion()
+                    self.ddr_ram.append(ram)
+                self.ddr_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
+                self.resets.append(ch.ch_rst)
+
+        # HBM
+        self.hbm_group_size = core_inst.HBM_GROUP_SIZE.value
+        self.hbm_ram = []
+        self.hbm_axi_if = []
+        if hasattr(core_inst, 'hbm'):
+            ram = None
+            for i, ch in enumerate(core_inst.hbm.dram_if_inst.ch):
+                cocotb.start_soon(Clock(ch.ch_clk, 2.222, units="ns").start())
+                ch.ch_rst.setimmediatevalue(0)
+                ch.ch_status.setimmediatevalue(1)
+
+                if i % self.hbm_group_size == 0:
+                    ram = SparseMemoryRegion()
+                    self.hbm_ram.append(ram)
+                self.hbm_axi_if.append(AxiSlave(AxiBus.from_prefix(ch, "axi_ch"), ch.ch_clk, ch.ch_rst, target=ram))
+                self.resets.append(ch.ch_rst)
+
+        dut.ctrl_reg_wr_wait.setimmediatevalue(0)
+        dut.ctrl_reg_wr_ack.setimmediatevalue(0)
+        dut.ctrl_reg_rd_data.setimmediatevalue(0)
+        dut.ctrl_reg_rd_wait.setimmediatevalue(0)
+        dut.ctrl_reg_rd_ack.setimmediatevalue(0)
+
+        self.init_ptp_clk(6.4)
+
+        dut.s_axis_stat_tdata.setimmediatevalue(0)
+        dut.s_axis_stat_tid.setimmediatevalue(0)
+        dut.s_axis_stat_tvalid.setimmediatevalue(0)
+
+        self.init_loopback([(mac.tx, mac.rx) for mac in self.port_mac])
+
+    def init_loopback(self, links):
+        self.loopback = mqnic_loopback.Loopback(links)
+        return self.loopback
+
+    async def init(self):
+        # pulse resets, then enumerate when on PCIe
+        for rst in self.resets:
+            rst.setimmediatevalue(0)
+
+        await RisingEdge(self.clk)
+        await RisingEdge(self.clk)
+
+        for rst in self.resets:
+            rst.setimmediatevalue(1)
+
+        if self.rc is not None:
+            await FallingEdge(self.rst)
+            await Timer(100, 'ns')
+
+        await RisingEdge(self.clk)
+        await RisingEdge(self.clk)
+
+        for rst in self.resets:
+            rst.setimmediatevalue(0)
+
+        if self.rc is not None:
+            await self.rc.enumerate()
+
+    async def init_driver(self, interfaces=None):
+        # init driver, open interfaces (default all) and enable all TX queues
+        self.log.info("Init driver")
+        if self.rc is not None:
+            await self.driver.init_pcie_dev(self.rc.find_device(self.dev.functions[0].pcie_id))
+        else:
+            await self.driver.init_axi_dev(self.pool, self.hw_regs, irq=self.dut.irq)
+
+        if interfaces is None:
+            interfaces = range(len(self.driver.interfaces))
+        interfaces = [self.driver.interfaces[k] for k in interfaces]
+
+        for interface in interfaces:
+            await interface.open()
+
+        # enable queues
+        self.log.info("Enable queues")
+        for interface in interfaces:
+            await interface.sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
+            for k in range(len(interface.txq)):
+                await interface.sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
+
+        # wait for all writes to complete
+        await self.driver.hw_regs.read_dword(0)
+        self.log.info("Init complete")
+
+
+def sim_build_key(toplevel, verilog_sources, parameters=None, defines=None, includes=None,
+        compile_args=None, timescale=None, waves=None, **kwargs):
+    # content hash, so identical elaborations match regardless of source paths
+    if waves is None:
+        # same default as cocotb-test; waves adds the iverilog_dump module
+        waves = bool(int(os.getenv("WAVES", 0)))
+    h = hashlib.sha256()
+    h.update(repr((toplevel, sorted((parameters or {}).items()), defines, includes,
+        compile_args, kwargs.get('verilog_compile_args'), timescale, waves,
+        mqnic_sim_cache.get_tool_version())).encode())
+    for src in verilog_sources:
+        h.update(mqnic_sim_cache.hash_file(src))
+    for inc in includes or []:
+        h.update(mqnic_sim_cache.hash_dir(inc))
+    return h.hexdigest()[:32]
+
+
+# total simulated time of the last run_sim call (read by the pytest plugin)
+sim_time_ns = None
+
+
+def get_sim_time_ns(results_file):
+    try:
+        tree = ET.parse(results_file)
+    except (OSError, TypeError, ET.ParseError):
+        return None
+    return sum(float(tc.get('sim_time_ns', 0)) for tc in tree.iter('testcase'))
+
+
+def run_sim(**kwargs):
+    # cocotb_test.simulator.run, reusing a cached icarus build when possible
+    global sim_time_ns
+
+    if not mqnic_sim_cache.SIM_BUILD_CACHE or os.getenv("SIM", "icarus") != "icarus" or kwargs.get('force_compile'):
+        results = cocotb_test.simulator.run(**kwargs)
+        sim_time_ns = get_sim_time_ns(results)
+        return results
+
+    toplevel = kwargs['toplevel']
+    sim_build = kwargs.get('sim_build', "sim_build")
+    vvp = toplevel + ".vvp"
+
+    def build(tmp_dir):
+        cocotb_test.simulator.run(**dict(kwargs, sim_build=tmp_dir, compile_only=True))
+
+    # fresh copy is newer than the sources, so cocotb-test skips compilation
+    os.makedirs(sim_build, exist_ok=True)
+    mqnic_sim_cache.fetch(sim_build_key(**kwargs), vvp, os.path.join(sim_build, vvp), build)
+
+    results = cocotb_test.simulator.run(**kwargs)
+    sim_time_ns = get_sim_time_ns(results)
+    return results
+
+
+# transaction-level host: run a PCIe core testbench module (same mqnic_core
+# configuration and test body) against the AXI core wrapper, so register access
+# and DMA go through cocotbext-axi models instead of the TLP-level PCIe device
+# model; selected by the *_axi_host tests
+AXI_HOST_TOPLEVEL = "mqnic_core_axi"
+
+
+def axi_host():
+    # in the simulator: True if the testbench module runs on the AXI core wrapper
+    return os.getenv("TOPLEVEL") == AXI_HOST_TOPLEVEL
+
+
+PCIE_ONLY_PARAMS = ('AXIS_PCIE_', 'SEG_', 'TX_SEQ_NUM_', 'PCIE_', 'PF_COUNT', 'VF_COUNT',
+    'L_TILE', 'IRQ_INDEX_WIDTH', 'STAT_PCIE_ENABLE')
+
+
+def fast_host(verilog_sources, parameters, axi_data_width=128):
+    # swap PCIe host interface sources and parameters for the AXI equivalents
+    rtl_dir = None
+    dma_rtl_dir = None
+    sources = []
+    for src in verilog_sources:
+        name = os.path.basename(src)
+        if name == "mqnic_core.v":
+            rtl_dir = os.path.dirname(src)
+        if name == "dma_if_mux.v":
+            dma_rtl_dir = os.path.dirname(src)
+        if name.startswith(("mqnic_core_pcie", "pcie_", "dma_if_pcie", "stats_dma_if_pcie")):
+            continue
+        sources.append(src)
+
+    if rtl_dir is None or dma_rtl_dir is None:
+        raise Exception("Transaction-level host mode requires an mqnic_core based testbench")
+
+    sources.insert(0, os.path.join(rtl_dir, "mqnic_core_axi.v"))
+    sources.append(os.path.join(rtl_dir, "stats_dma_if_axi.v"))
+    sources.append(os.path.join(dma_rtl_dir, "dma_if_axi.v"))
+    sources.append(os.path.join(dma_rtl_dir, "dma_if_axi_rd.v"))
+    sources.append(os.path.join(dma_rtl_dir, "dma_if_axi_wr.v"))
+
+    params = {}
+    for k, v in parameters.items():
+        if k.startswith(PCIE_ONLY_PARAMS):
+            continue
+        params[k.replace('AXIS_ETH_', 'AXIS_', 1)] = v
+
+    params['AXI_DATA_WIDTH'] = axi_data_width
+    params['AXI_ADDR_WIDTH'] = 49
+    params['AXI_STRB_WIDTH'] = params['AXI_DATA_WIDTH'] // 8
+    params['AXI_ID_WIDTH'] = 6
+    params['AXI_DMA_MAX_BURST_LEN'] = 16
+    params['AXI_DMA_READ_USE_ID'] = 0
+    params['AXI_DMA_WRITE_USE_ID'] = 1
+    params['AXI_DMA_READ_OP_TABLE_SIZE'] = 2**params['AXI_ID_WIDTH']
+    params['AXI_DMA_WRITE_OP_TABLE_SIZE'] = 2**params['AXI_ID_WIDTH']
+    params['IRQ_COUNT'] = 32
+    params['STAT_AXI_ENABLE'] = parameters.get('STAT_PCIE_ENABLE', 1)
+
+    return sources, params
@@ -1,7 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2020-2023 The Regents of the University of California
 
-import logging
 import os
 import sys
 
@@ -9,276 +8,36 @@ import scapy.utils
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP, UDP
 
-import cocotb_test.simulator
-
 import cocotb
-from cocotb.log import SimLog
-from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge, FallingEdge, Timer
+from cocotb.triggers import RisingEdge
 
-from cocotbext.axi import AxiStreamBus
-from cocotbext.eth import EthMac
-from cocotbext.pcie.core import RootComplex
-from cocotbext.pcie.intel.ptile import PTilePcieDevice, PTileRxBus, PTileTxBus
+from cocotbext.pcie.intel.ptile import PTilePcieDevice
 
 try:
-    import mqnic
+    import mqnic_tb
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
-        import mqnic
+        import mqnic_tb
     finally:
         del sys.path[0]
 
 
-class TB(object):
-    def __init__(self, dut, msix_count=32):
-        self.dut = dut
-
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
+class TB(mqnic_tb.BaseTB):
+    def __init__(self, dut):
+        super().__init__(dut)
 
         # PCIe
-        self.rc = RootComplex()
-
-        self.rc.max_payload_size = 0x1  # 256 bytes
-        self.rc.max_read_request_size = 0x2  # 512 bytes
-
-        self.dev = PTilePcieDevice(
-            # configuration options
-            pcie_generation=3,
-            pcie_link_width=16,
-            pld_clk_frequency=250e6,
-            pf_count=1,
-            max_payload_size=512,
-            enable_extended_tag=True,
-
-            pf0_msi_enable=False,
-            pf0_msi_count=1,
-            pf1_msi_enable=False,
-            pf1_msi_count=1,
-            pf2_msi_enable=False,
-            pf2_msi_count=1,
-            pf3_msi_enable=False,
-            pf3_msi_count=1,
-            pf0_msix_enable=True,
-            pf0_msix_table_size=msix_count-1,
-            pf0_msix_table_bir=0,
-            pf0_msix_table_offset=0x00010000,
-            pf0_msix_pba_bir=0,
-            pf0_msix_pba_offset=0x00018000,
-            pf1_msix_enable=False,
-            pf1_msix_table_size=0,
-            pf1_msix_table_bir=0,
-            pf1_msix_table_offset=0x00000000,
-            pf1_msix_pba_bir=0,
-            pf1_msix_pba_offset=0x00000000,
-            pf2_msix_enable=False,
-            pf2_msix_table_size=0,
-            pf2_msix_table_bir=0,
-            pf2_msix_table_offset=0x00000000,
-            pf2_msix_pba_bir=0,
-            pf2_msix_pba_offset=0x00000000,
-            pf3_msix_enable=False,
-            pf3_msix_table_size=0,
-            pf3_msix_table_bir=0,
-            pf3_msix_table_offset=0x00000000,
-            pf3_msix_pba_bir=0,
-            pf3_msix_pba_offset=0x00000000,
-
-            # signals
-            # Clock and reset
-            reset_status=dut.rst_250mhz,
-            # reset_status_n=dut.reset_status_n,
-            coreclkout_hip=dut.clk_250mhz,
-            # refclk0=dut.refclk0,
-            # refclk1=dut.refclk1,
-            # pin_perst_n=dut.pin_perst_n,
-
-            # RX interface
-            rx_bus=PTileRxBus.from_prefix(dut, "rx_st"),
-            # rx_par_err=dut.rx_par_err,
-
-            # TX interface
-            tx_bus=PTileTxBus.from_prefix(dut, "tx_st"),
-            # tx_par_err=dut.tx_par_err,
-
-            # RX flow control
-            rx_buffer_limit=dut.rx_buffer_limit,
-            rx_buffer_limit_tdm_idx=dut.rx_buffer_limit_tdm_idx,
-
-            # TX flow control
-            tx_cdts_limit=dut.tx_cdts_limit,
-            tx_cdts_limit_tdm_idx=dut.tx_cdts_limit_tdm_idx,
-
-            # Power management and hard IP status interface
-            # link_up=dut.link_up,
-            # dl_up=dut.dl_up,
-            # surprise_down_err=dut.surprise_down_err,
-            # ltssm_state=dut.ltssm_state,
-            # pm_state=dut.pm_state,
-            # pm_dstate=dut.pm_dstate,
-            # apps_pm_xmt_pme=dut.apps_pm_xmt_pme,
-            # app_req_retry_en=dut.app_req_retry_en,
-
-            # Interrupt interface
-            # app_int=dut.app_int,
-            # msi_pnd_func=dut.msi_pnd_func,
-            # msi_pnd_byte=dut.msi_pnd_byte,
-            # msi_pnd_addr=dut.msi_pnd_addr,
-
-            # Error interface
-            # serr_out=dut.serr_out,
-            # hip_enter_err_mode=dut.hip_enter_err_mode,
-            # app_err_valid=dut.app_err_valid,
-            # app_err_hdr=dut.app_err_hdr,
-            # app_err_info=dut.app_err_info,
-            # app_err_func_num=dut.app_err_func_num,
-
-            # Completion timeout interface
-            # cpl_timeout=dut.cpl_timeout,
-            # cpl_timeout_avmm_clk=dut.cpl_timeout_avmm_clk,
-            # cpl_timeout_avmm_address=dut.cpl_timeout_avmm_address,
-            # cpl_timeout_avmm_read=dut.cpl_timeout_avmm_read,
-            # cpl_timeout_avmm_readdata=dut.cpl_timeout_avmm_readdata,
-            # cpl_timeout_avmm_readdatavalid=dut.cpl_timeout_avmm_readdatavalid,
-            # cpl_timeout_avmm_write=dut.cpl_timeout_avmm_write,
-            # cpl_timeout_avmm_writedata=dut.cpl_timeout_avmm_writedata,
-            # cpl_timeout_avmm_waitrequest=dut.cpl_timeout_avmm_waitrequest,
-
-            # Configuration output
-            tl_cfg_func=dut.tl_cfg_func,
-            tl_cfg_add=dut.tl_cfg_add,
-            tl_cfg_ctl=dut.tl_cfg_ctl,
-            # dl_timer_update=dut.dl_timer_update,
-
-            # Configuration intercept interface
-            # cii_req=dut.cii_req,
-            # cii_hdr_poisoned=dut.cii_hdr_poisoned,
-            # cii_hdr_first_be=dut.cii_hdr_first_be,
-            # cii_func_num=dut.cii_func_num,
-            # cii_wr_vf_active=dut.cii_wr_vf_active,
-            # cii_vf_num=dut.cii_vf_num,
-            # cii_wr=dut.cii_wr,
-            # cii_addr=dut.cii_addr,
-            # cii_dout=dut.cii_dout,
-            # cii_override_en=dut.cii_override_en,
-            # cii_override_din=dut.cii_override_din,
-            # cii_halt=dut.cii_halt,
-
-            # Hard IP reconfiguration interface
-            # hip_reconfig_clk=dut.hip_reconfig_clk,
-            # hip_reconfig_address=dut.hip_reconfig_address,
-            # hip_reconfig_read=dut.hip_reconfig_read,
-            # hip_reconfig_readdata=dut.hip_reconfig_readdata,
-            # hip_reconfig_readdatavalid=dut.hip_reconfig_readdatavalid,
-            # hip_reconfig_write=dut.hip_reconfig_write,
-            # hip_reconfig_writedata=dut.hip_reconfig_writedata,
-            # hip_reconfig_waitrequest=dut.hip_reconfig_waitrequest,
-
-            # Page request service
-            # prs_event_valid=dut.prs_event_valid,
-            # prs_event_func=dut.prs_event_func,
-            # prs_event=dut.prs_event,
-
-            # SR-IOV (VF error)
-            # vf_err_ur_posted_s0=dut.vf_err_ur_posted_s0,
-            # vf_err_ur_posted_s1=dut.vf_err_ur_posted_s1,
-            # vf_err_ur_posted_s2=dut.vf_err_ur_posted_s2,
-            # vf_err_ur_posted_s3=dut.vf_err_ur_posted_s3,
-            # vf_err_func_num_s0=dut.vf_err_func_num_s0,
-            # vf_err_func_num_s1=dut.vf_err_func_num_s1,
-            # vf_err_func_num_s2=dut.vf_err_func_num_s2,
-            # vf_err_func_num_s3=dut.vf_err_func_num_s3,
-            # vf_err_ca_postedreq_s0=dut.vf_err_ca_postedreq_s0,
-            # vf_err_ca_postedreq_s1=dut.vf_err_ca_postedreq_s1,
-            # vf_err_ca_postedreq_s2=dut.vf_err_ca_postedreq_s2,
-            # vf_err_ca_postedreq_s3=dut.vf_err_ca_postedreq_s3,
-            # vf_err_vf_num_s0=dut.vf_err_vf_num_s0,
-            # vf_err_vf_num_s1=dut.vf_err_vf_num_s1,
-            # vf_err_vf_num_s2=dut.vf_err_vf_num_s2,
-            # vf_err_vf_num_s3=dut.vf_err_vf_num_s3,
-            # vf_err_poisonedwrreq_s0=dut.vf_err_poisonedwrreq_s0,
-            # vf_err_poisonedwrreq_s1=dut.vf_err_poisonedwrreq_s1,
-            # vf_err_poisonedwrreq_s2=dut.vf_err_poisonedwrreq_s2,
-            # vf_err_poisonedwrreq_s3=dut.vf_err_poisonedwrreq_s3,
-            # vf_err_poisonedcompl_s0=dut.vf_err_poisonedcompl_s0,
-            # vf_err_poisonedcompl_s1=dut.vf_err_poisonedcompl_s1,
-            # vf_err_poisonedcompl_s2=dut.vf_err_poisonedcompl_s2,
-            # vf_err_poisonedcompl_s3=dut.vf_err_poisonedcompl_s3,
-            # user_vfnonfatalmsg_func_num=dut.user_vfnonfatalmsg_func_num,
-            # user_vfnonfatalmsg_vfnum=dut.user_vfnonfatalmsg_vfnum,
-            # user_sent_vfnonfatalmsg=dut.user_sent_vfnonfatalmsg,
-            # vf_err_overflow=dut.vf_err_overflow,
-
-            # FLR
-            # flr_rcvd_pf=dut.flr_rcvd_pf,
-            # flr_rcvd_vf=dut.flr_rcvd_vf,
-            # flr_rcvd_pf_num=dut.flr_rcvd_pf_num,
-            # flr_rcvd_vf_num=dut.flr_rcvd_vf_num,
-            # flr_completed_pf=dut.flr_completed_pf,
-            # flr_completed_vf=dut.flr_completed_vf,
-            # flr_completed_pf_num=dut.flr_completed_pf_num,
-            # flr_completed_vf_num=dut.flr_completed_vf_num,
-
-            # VirtIO
-            # virtio_pcicfg_vfaccess=dut.virtio_pcicfg_vfaccess,
-            # virtio_pcicfg_vfnum=dut.virtio_pcicfg_vfnum,
-            # virtio_pcicfg_pfnum=dut.virtio_pcicfg_pfnum,
-            # virtio_pcicfg_bar=dut.virtio_pcicfg_bar,
-            # virtio_pcicfg_length=dut.virtio_pcicfg_length,
-            # virtio_pcicfg_baroffset=dut.virtio_pcicfg_baroffset,
-            # virtio_pcicfg_cfgdata=dut.virtio_pcicfg_cfgdata,
-            # virtio_pcicfg_cfgwr=dut.virtio_pcicfg_cfgwr,
-            # virtio_pcicfg_cfgrd=dut.virtio_pcicfg_cfgrd,
-            # virtio_pcicfg_appvfnum=dut.virtio_pcicfg_appvfnum,
-            # virtio_pcicfg_apppfnum=dut.virtio_pcicfg_apppfnum,
-            # virtio_pcicfg_rdack=dut.virtio_pcicfg_rdack,
-            # virtio_pcicfg_rdbe=dut.virtio_pcicfg_rdbe,
-            # virtio_pcicfg_data=dut.virtio_pcicfg_data,
-        )
-
-        # self.dev.log.setLevel(logging.DEBUG)
-
-        self.rc.make_port().connect(self.dev)
-
-        self.driver = mqnic.Driver()
-
-        self.dev.functions[0].configure_bar(0, 2**len(dut.uut.core_inst.core_pcie_inst.axil_ctrl_araddr), ext=True, prefetch=True)
-        if hasattr(dut.uut.core_inst.core_pcie_inst, 'pcie_app_ctrl'):
-            self.dev.functions[0].configure_bar(2, 2**len(dut.uut.core_inst.core_pcie_inst.axil_app_ctrl_araddr), ext=True, prefetch=True)
-
-        cocotb.start_soon(Clock(dut.ptp_clk, 2.482, units="ns").start())
-        dut.ptp_rst.setimmediatevalue(0)
-        cocotb.start_soon(Clock(dut.ptp_sample_clk, 10, units="ns").start())
+        self.init_pcie_dev(PTilePcieDevice, dut.uut.core_inst.core_pcie_inst, dut.clk_250mhz, dut.rst_250mhz, pcie_link_width=16, pld_clk_frequency=250e6)
+
+        self.init_ptp_clk(2.482, 10)
 
         # Ethernet
         self.qsfpdd_mac = []
 
         for ch in self.dut.ch:
-            cocotb.start_soon(Clock(ch.ch_mac_tx_clk, 2.482, units="ns").start())
-            cocotb.start_soon(Clock(ch.ch_mac_rx_clk, 2.482, units="ns").start())
-
-            mac = EthMac(
-                tx_clk=ch.ch_mac_tx_clk,
-                tx_rst=ch.ch_mac_tx_rst,
-                tx_bus=AxiStreamBus.from_prefix(ch, "ch_mac_tx_axis"),
-                tx_ptp_time=ch.ch_mac_tx_ptp_time,
-                tx_ptp_ts=ch.ch_mac_tx_ptp_ts,
-                tx_ptp_ts_tag=ch.ch_mac_tx_ptp_ts_tag,
-                tx_ptp_ts_valid=ch.ch_mac_tx_ptp_ts_valid,
-                rx_clk=ch.ch_mac_rx_clk,
-                rx_rst=ch.ch_mac_rx_rst,
-                rx_bus=AxiStreamBus.from_prefix(ch, "ch_mac_rx_axis"),
-                rx_ptp_time=ch.ch_mac_rx_ptp_time,
-                ifg=12, speed=100e9
-            )
-
-            ch.ch_mac_rx_status.setimmediatevalue(1)
-            ch.ch_mac_rx_lfc_req.setimmediatevalue(0)
-            ch.ch_mac_rx_pfc_req.setimmediatevalue(0)
-
+            mac = self.init_eth_mac(ch, "ch_mac_", period=2.482)
             self.qsfpdd_mac.append(mac)
 
         dut.qsfpdda_interrupt_n.setimmediatevalue(1)
@@ -296,68 +55,17 @@ class TB(object):
 
         # dut.qspi_dq_i.setimmediatevalue(0)
 
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
-
-    async def init(self):
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-        for ch in self.dut.ch:
-            ch.ch_mac_tx_rst.setimmediatevalue(0)
-            ch.ch_mac_rx_rst.setimmediatevalue(0)
-
-        await RisingEdge(self.dut.clk_250mhz)
-        await RisingEdge(self.dut.clk_250mhz)
-
-        self.dut.ptp_rst.setimmediatevalue(1)
-        for ch in self.dut.ch:
-            ch.ch_mac_tx_rst.setimmediatevalue(1)
-            ch.ch_mac_rx_rst.setimmediatevalue(1)
-
-        await FallingEdge(self.dut.rst_250mhz)
-        await Timer(100, 'ns')
-
-        await RisingEdge(self.dut.clk_250mhz)
-        await RisingEdge(self.dut.clk_250mhz)
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-        for ch in self.dut.ch:
-            ch.ch_mac_tx_rst.setimmediatevalue(0)
-            ch.ch_mac_rx_rst.setimmediatevalue(0)
-
-        await self.rc.enumerate()
-
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk_250mhz)
-
-            if self.loopback_enable:
-                for mac in self.qsfpdd_mac:
-                    if not mac.tx.empty():
-                        await mac.rx.send(await mac.tx.recv())
+        self.init_loopback([(mac.tx, mac.rx) for mac in self.qsfpdd_mac])
 
 
 @cocotb.test()
 async def run_test_nic(dut):
 
-    tb = TB(dut, msix_count=2**len(dut.uut.core_inst.core_pcie_inst.irq_index))
+    tb = TB(dut)
 
     await tb.init()
 
-    tb.log.info("Init driver")
-    await tb.driver.init_pcie_dev(tb.rc.find_device(tb.dev.functions[0].pcie_id))
-    await tb.driver.interfaces[0].open()
-    # await tb.driver.interfaces[1].open()
-
-    # enable queues
-    tb.log.info("Enable queues")
-    await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
-    for k in range(len(tb.driver.interfaces[0].txq)):
-        await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
-
-    # wait for all writes to complete
-    await tb.driver.hw_regs.read_dword(0)
-    tb.log.info("Init complete")
+    await tb.init_driver(interfaces=[0])
 
     tb.log.info("Send and receive single packet")
 
@@ -415,7 +123,7 @@ async def run_test_nic(dut):
 
     data = bytearray([x % 256 for x in range(1024)])
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, k)
@@ -428,7 +136,7 @@ async def run_test_nic(dut):
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
         assert pkt.queue == k
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, 0)
 
@@ -439,7 +147,7 @@ async def run_test_nic(dut):
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, k, k)
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     queues = set()
 
@@ -465,7 +173,7 @@ async def run_test_nic(dut):
 
     assert len(queues) == 4
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_rss_mask(0, 0)
 
@@ -475,7 +183,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -487,7 +195,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple large packets")
 
@@ -495,7 +203,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -507,7 +215,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Jumbo frames")
 
@@ -515,7 +223,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(9014)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -527,7 +235,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await RisingEdge(dut.clk_250mhz)
     await RisingEdge(dut.clk_250mhz)
@@ -769,7 +477,7 @@ def test_fpga_core(request):
     sim_build = os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
-    cocotb_test.simulator.run(
+    mqnic_tb.run_sim(
         python_search=[tests_dir],
         verilog_sources=verilog_sources,
         toplevel=toplevel,
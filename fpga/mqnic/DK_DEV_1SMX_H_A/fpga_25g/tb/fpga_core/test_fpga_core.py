@@ -1,7 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2020-2023 The Regents of the University of California
 
-import logging
 import os
 import struct
 import sys
@@ -10,194 +9,33 @@ import scapy.utils
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP, UDP
 
-import cocotb_test.simulator
-
 import cocotb
-from cocotb.log import SimLog
-from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge, FallingEdge, Timer
+from cocotb.triggers import RisingEdge
 
-from cocotbext.eth import XgmiiSource, XgmiiSink, XgmiiFrame
-from cocotbext.pcie.core import RootComplex
-from cocotbext.pcie.intel.s10 import S10PcieDevice, S10RxBus, S10TxBus
+from cocotbext.eth import XgmiiFrame
+from cocotbext.pcie.intel.s10 import S10PcieDevice
 
 try:
     import mqnic
+    import mqnic_tb
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_tb
     finally:
         del sys.path[0]
 
 
-class TB(object):
-    def __init__(self, dut, msix_count=32):
-        self.dut = dut
-
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
+class TB(mqnic_tb.BaseTB):
+    def __init__(self, dut):
+        super().__init__(dut)
 
         # PCIe
-        self.rc = RootComplex()
-
-        self.rc.max_payload_size = 0x1  # 256 bytes
-        self.rc.max_read_request_size = 0x2  # 512 bytes
-
-        self.dev = S10PcieDevice(
-            # configuration options
-            pcie_generation=3,
-            pcie_link_width=8,
-            pld_clk_frequency=250e6,
-            l_tile=False,
-            pf_count=1,
-            max_payload_size=1024,
-            enable_extended_tag=True,
-
-            pf0_msi_enable=False,
-            pf0_msi_count=32,
-            pf1_msi_enable=False,
-            pf1_msi_count=1,
-            pf2_msi_enable=False,
-            pf2_msi_count=1,
-            pf3_msi_enable=False,
-            pf3_msi_count=1,
-            pf0_msix_enable=True,
-            pf0_msix_table_size=msix_count-1,
-            pf0_msix_table_bir=0,
-            pf0_msix_table_offset=0x00010000,
-            pf0_msix_pba_bir=0,
-            pf0_msix_pba_offset=0x00018000,
-            pf1_msix_enable=False,
-            pf1_msix_table_size=0,
-            pf1_msix_table_bir=0,
-            pf1_msix_table_offset=0x00000000,
-            pf1_msix_pba_bir=0,
-            pf1_msix_pba_offset=0x00000000,
-            pf2_msix_enable=False,
-            pf2_msix_table_size=0,
-            pf2_msix_table_bir=0,
-            pf2_msix_table_offset=0x00000000,
-            pf2_msix_pba_bir=0,
-            pf2_msix_pba_offset=0x00000000,
-            pf3_msix_enable=False,
-            pf3_msix_table_size=0,
-            pf3_msix_table_bir=0,
-            pf3_msix_table_offset=0x00000000,
-            pf3_msix_pba_bir=0,
-            pf3_msix_pba_offset=0x00000000,
-
-            # signals
-            # Clock and reset
-            # npor=dut.npor,
-            # pin_perst=dut.pin_perst,
-            # ninit_done=dut.ninit_done,
-            # pld_clk_inuse=dut.pld_clk_inuse,
-            # pld_core_ready=dut.pld_core_ready,
-            reset_status=dut.rst_250mhz,
-            # clr_st=dut.clr_st,
-            # refclk=dut.refclk,
-            coreclkout_hip=dut.clk_250mhz,
-
-            # RX interface
-            rx_bus=S10RxBus.from_prefix(dut, "rx_st"),
-
-            # TX interface
-            tx_bus=S10TxBus.from_prefix(dut, "tx_st"),
-
-            # TX flow control
-            tx_ph_cdts=dut.tx_ph_cdts,
-            tx_pd_cdts=dut.tx_pd_cdts,
-            tx_nph_cdts=dut.tx_nph_cdts,
-            tx_npd_cdts=dut.tx_npd_cdts,
-            tx_cplh_cdts=dut.tx_cplh_cdts,
-            tx_cpld_cdts=dut.tx_cpld_cdts,
-            tx_hdr_cdts_consumed=dut.tx_hdr_cdts_consumed,
-            tx_data_cdts_consumed=dut.tx_data_cdts_consumed,
-            tx_cdts_type=dut.tx_cdts_type,
-            tx_cdts_data_value=dut.tx_cdts_data_value,
-
-            # Hard IP status
-            # int_status=dut.int_status,
-            # int_status_common=dut.int_status_common,
-            # derr_cor_ext_rpl=dut.derr_cor_ext_rpl,
-            # derr_rpl=dut.derr_rpl,
-            # derr_cor_ext_rcv=dut.derr_cor_ext_rcv,
-            # derr_uncor_ext_rcv=dut.derr_uncor_ext_rcv,
-            # rx_par_err=dut.rx_par_err,
-            # tx_par_err=dut.tx_par_err,
-            # ltssmstate=dut.ltssmstate,
-            # link_up=dut.link_up,
-            # lane_act=dut.lane_act,
-            # currentspeed=dut.currentspeed,
-
-            # Power management
-            # pm_linkst_in_l1=dut.pm_linkst_in_l1,
-            # pm_linkst_in_l0s=dut.pm_linkst_in_l0s,
-            # pm_state=dut.pm_state,
-            # pm_dstate=dut.pm_dstate,
-            # apps_pm_xmt_pme=dut.apps_pm_xmt_pme,
-            # apps_ready_entr_l23=dut.apps_ready_entr_l23,
-            # apps_pm_xmt_turnoff=dut.apps_pm_xmt_turnoff,
-            # app_init_rst=dut.app_init_rst,
-            # app_xfer_pending=dut.app_xfer_pending,
-
-            # Interrupt interface
-            # app_msi_req=dut.app_msi_req,
-            # app_msi_ack=dut.app_msi_ack,
-            # app_msi_tc=dut.app_msi_tc,
-            # app_msi_num=dut.app_msi_num,
-            # app_msi_func_num=dut.app_msi_func_num,
-            # app_int_sts=dut.app_int_sts,
-
-            # Error interface
-            # app_err_valid=dut.app_err_valid,
-            # app_err_hdr=dut.app_err_hdr,
-            # app_err_info=dut.app_err_info,
-            # app_err_func_num=dut.app_err_func_num,
-
-            # Configuration output
-            tl_cfg_func=dut.tl_cfg_func,
-            tl_cfg_add=dut.tl_cfg_add,
-            tl_cfg_ctl=dut.tl_cfg_ctl,
-
-            # Configuration extension bus
-            # ceb_req=dut.ceb_req,
-            # ceb_ack=dut.ceb_ack,
-            # ceb_addr=dut.ceb_addr,
-            # ceb_din=dut.ceb_din,
-            # ceb_dout=dut.ceb_dout,
-            # ceb_wr=dut.ceb_wr,
-            # ceb_cdm_convert_data=dut.ceb_cdm_convert_data,
-            # ceb_func_num=dut.ceb_func_num,
-            # ceb_vf_num=dut.ceb_vf_num,
-            # ceb_vf_active=dut.ceb_vf_active,
-
-            # Hard IP reconfiguration interface
-            # hip_reconfig_clk=dut.hip_reconfig_clk,
-            # hip_reconfig_address=dut.hip_reconfig_address,
-            # hip_reconfig_read=dut.hip_reconfig_read,
-            # hip_reconfig_readdata=dut.hip_reconfig_readdata,
-            # hip_reconfig_readdatavalid=dut.hip_reconfig_readdatavalid,
-            # hip_reconfig_write=dut.hip_reconfig_write,
-            # hip_reconfig_writedata=dut.hip_reconfig_writedata,
-            # hip_reconfig_waitrequest=dut.hip_reconfig_waitrequest,
-        )
-
-        # self.dev.log.setLevel(logging.DEBUG)
-
-        self.rc.make_port().connect(self.dev)
-
-        self.driver = mqnic.Driver()
-
-        self.dev.functions[0].configure_bar(0, 2**len(dut.core_inst.core_pcie_inst.axil_ctrl_araddr), ext=True, prefetch=True)
-        if hasattr(dut.core_inst.core_pcie_inst, 'pcie_app_ctrl'):
-            self.dev.functions[0].configure_bar(2, 2**len(dut.core_inst.core_pcie_inst.axil_app_ctrl_araddr), ext=True, prefetch=True)
-
-        cocotb.start_soon(Clock(dut.ptp_clk, 6.206, units="ns").start())
-        dut.ptp_rst.setimmediatevalue(0)
-        cocotb.start_soon(Clock(dut.ptp_sample_clk, 8, units="ns").start())
+        self.init_pcie_dev(S10PcieDevice, dut.core_inst.core_pcie_inst, dut.clk_250mhz, dut.rst_250mhz, pcie_link_width=8, pld_clk_frequency=250e6, l_tile=False)
+
+        self.init_ptp_clk(6.206)
 
         # Ethernet
         self.qsfp_source = []
@@ -207,14 +45,9 @@ class TB(object):
             sources = []
             sinks = []
             for y in range(1, 5):
-                cocotb.start_soon(Clock(getattr(dut, f"qsfp{x}_rx_clk_{y}"), 2.56, units="ns").start())
-                source = XgmiiSource(getattr(dut, f"qsfp{x}_rxd_{y}"), getattr(dut, f"qsfp{x}_rxc_{y}"), getattr(dut, f"qsfp{x}_rx_clk_{y}"), getattr(dut, f"qsfp{x}_rx_rst_{y}"))
+                source, sink = self.init_xgmii_port(dut, f"qsfp{x}_", f"_{y}", period=2.56)
                 sources.append(source)
-                cocotb.start_soon(Clock(getattr(dut, f"qsfp{x}_tx_clk_{y}"), 2.56, units="ns").start())
-                sink = XgmiiSink(getattr(dut, f"qsfp{x}_txd_{y}"), getattr(dut, f"qsfp{x}_txc_{y}"), getattr(dut, f"qsfp{x}_tx_clk_{y}"), getattr(dut, f"qsfp{x}_tx_rst_{y}"))
                 sinks.append(sink)
-                getattr(dut, f"qsfp{x}_rx_status_{y}").setimmediatevalue(1)
-                getattr(dut, f"qsfp{x}_rx_error_count_{y}").setimmediatevalue(0)
             self.qsfp_source.append(sources)
             self.qsfp_sink.append(sinks)
 
@@ -224,72 +57,18 @@ class TB(object):
         dut.qsfp_i2c_scl_i.setimmediatevalue(1)
         dut.qsfp_i2c_sda_i.setimmediatevalue(1)
 
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
-
-    async def init(self):
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-        for x in range(2):
-            for y in range(1, 5):
-                getattr(self.dut, f"qsfp{x}_rx_rst_{y}").setimmediatevalue(0)
-                getattr(self.dut, f"qsfp{x}_tx_rst_{y}").setimmediatevalue(0)
-
-        await RisingEdge(self.dut.clk_250mhz)
-        await RisingEdge(self.dut.clk_250mhz)
-
-        self.dut.ptp_rst.setimmediatevalue(1)
-        for x in range(2):
-            for y in range(1, 5):
-                getattr(self.dut, f"qsfp{x}_rx_rst_{y}").setimmediatevalue(1)
-                getattr(self.dut, f"qsfp{x}_tx_rst_{y}").setimmediatevalue(1)
-
-        await FallingEdge(self.dut.rst_250mhz)
-        await Timer(100, 'ns')
-
-        await RisingEdge(self.dut.clk_250mhz)
-        await RisingEdge(self.dut.clk_250mhz)
-
-        self.dut.ptp_rst.setimmediatevalue(0)
-        for x in range(2):
-            for y in range(1, 5):
-                getattr(self.dut, f"qsfp{x}_rx_rst_{y}").setimmediatevalue(0)
-                getattr(self.dut, f"qsfp{x}_tx_rst_{y}").setimmediatevalue(0)
-
-        await self.rc.enumerate()
-
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk_250mhz)
-
-            if self.loopback_enable:
-                for x in range(len(self.qsfp_sink)):
-                    for y in range(len(self.qsfp_sink[x])):
-                        if not self.qsfp_sink[x][y].empty():
-                            await self.qsfp_source[x][y].send(await self.qsfp_sink[x][y].recv())
+        self.init_loopback([(sink, source) for sinks, sources in zip(self.qsfp_sink, self.qsfp_source)
+            for sink, source in zip(sinks, sources)])
 
 
 @cocotb.test()
 async def run_test_nic(dut):
 
-    tb = TB(dut, msix_count=2**len(dut.core_inst.core_pcie_inst.irq_index))
+    tb = TB(dut)
 
     await tb.init()
 
-    tb.log.info("Init driver")
-    await tb.driver.init_pcie_dev(tb.rc.find_device(tb.dev.functions[0].pcie_id))
-    await tb.driver.interfaces[0].open()
-    # await tb.driver.interfaces[1].open()
-
-    # enable queues
-    tb.log.info("Enable queues")
-    await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
-    for k in range(len(tb.driver.interfaces[0].txq)):
-        await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
-
-    # wait for all writes to complete
-    await tb.driver.hw_regs.read_dword(0)
-    tb.log.info("Init complete")
+    await tb.init_driver(interfaces=[0])
 
     tb.log.info("Send and receive single packet")
 
@@ -347,7 +126,7 @@ async def run_test_nic(dut):
 
     data = bytearray([x % 256 for x in range(1024)])
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, k)
@@ -360,7 +139,7 @@ async def run_test_nic(dut):
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
         assert pkt.queue == k
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, 0)
 
@@ -371,7 +150,7 @@ async def run_test_nic(dut):
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, k, k)
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     queues = set()
 
@@ -397,7 +176,7 @@ async def run_test_nic(dut):
 
     assert len(queues) == 4
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_rss_mask(0, 0)
 
@@ -407,7 +186,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -419,7 +198,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple large packets")
 
@@ -427,7 +206,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -439,7 +218,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     if tb.driver.interfaces[0].if_feature_lfc:
         tb.log.info("Test LFC pause frame RX")
@@ -455,7 +234,7 @@ async def run_test_nic(dut):
 
         pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         for p in pkts:
             await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -468,7 +247,7 @@ async def run_test_nic(dut):
             if tb.driver.interfaces[0].if_feature_rx_csum:
                 assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     await RisingEdge(dut.clk_250mhz)
     await RisingEdge(dut.clk_250mhz)
@@ -713,7 +492,7 @@ def test_fpga_core(request):
     sim_build = os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
-    cocotb_test.simulator.run(
+    mqnic_tb.run_sim(
         python_search=[tests_dir],
         verilog_sources=verilog_sources,
         toplevel=toplevel,
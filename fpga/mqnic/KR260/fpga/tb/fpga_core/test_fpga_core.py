@@ -1,7 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2020-2023 The Regents of the University of California
 
-import logging
 import os
 import struct
 import sys
@@ -10,61 +9,36 @@ import scapy.utils
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP, UDP
 
-import cocotb_test.simulator
-
 import cocotb
-from cocotb.log import SimLog
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
 
-from cocotbext.axi import AddressSpace
-from cocotbext.axi import AxiLiteMaster, AxiLiteBus
-from cocotbext.axi import AxiSlave, AxiBus
-from cocotbext.eth import XgmiiSource, XgmiiSink, XgmiiFrame
+from cocotbext.eth import XgmiiFrame
 
 try:
     import mqnic
+    import mqnic_tb
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_tb
     finally:
         del sys.path[0]
 
 
-class TB(object):
+class TB(mqnic_tb.BaseTB):
     def __init__(self, dut):
-        self.dut = dut
-
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
-
-        cocotb.start_soon(Clock(dut.clk_250mhz, 4, units="ns").start())
+        super().__init__(dut)
 
         # AXI
-        self.address_space = AddressSpace()
-        self.pool = self.address_space.create_pool(0, 0x8000_0000)
-
-        self.axil_master = AxiLiteMaster(AxiLiteBus.from_prefix(dut, "s_axil_ctrl"), dut.clk_250mhz, dut.rst_250mhz)
-        self.address_space.register_region(self.axil_master, 0x10_0000_0000)
-        self.hw_regs = self.address_space.create_window(0x10_0000_0000, self.axil_master.size)
-
-        self.axi_slave = AxiSlave(AxiBus.from_prefix(dut, "m_axi"), dut.clk_250mhz, dut.rst_250mhz, self.address_space)
+        self.init_axi_host(dut.clk_250mhz, dut.rst_250mhz)
 
-        self.driver = mqnic.Driver()
-
-        cocotb.start_soon(Clock(dut.ptp_clk, 6.4, units="ns").start())
-        dut.ptp_rst.setimmediatevalue(0)
-        cocotb.start_soon(Clock(dut.ptp_sample_clk, 8, units="ns").start())
+        self.init_ptp_clk(6.4)
 
         # Ethernet
-        cocotb.start_soon(Clock(dut.sfp_rx_clk, 6.4, units="ns").start())
-        self.sfp_source = XgmiiSource(dut.sfp_rxd, dut.sfp_rxc, dut.sfp_rx_clk, dut.sfp_rx_rst)
-        cocotb.start_soon(Clock(dut.sfp_tx_clk, 6.4, units="ns").start())
-        self.sfp_sink = XgmiiSink(dut.sfp_txd, dut.sfp_txc, dut.sfp_tx_clk, dut.sfp_tx_rst)
-
-        dut.sfp_rx_status.setimmediatevalue(1)
+        self.sfp_source, self.sfp_sink = self.init_xgmii_port(dut, "sfp_", period=6.4)
 
         dut.sfp_tx_fault.setimmediatevalue(0)
         dut.sfp_rx_los.setimmediatevalue(0)
@@ -77,41 +51,7 @@ class TB(object):
         dut.sfp_drp_do.setimmediatevalue(0)
         dut.sfp_drp_rdy.setimmediatevalue(0)
 
-        dut.sfp_rx_error_count.setimmediatevalue(0)
-
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
-
-    async def init(self):
-
-        self.dut.rst_250mhz.setimmediatevalue(0)
-        self.dut.ptp_rst.setimmediatevalue(0)
-        self.dut.sfp_rx_rst.setimmediatevalue(0)
-        self.dut.sfp_tx_rst.setimmediatevalue(0)
-
-        await RisingEdge(self.dut.clk_250mhz)
-        await RisingEdge(self.dut.clk_250mhz)
-
-        self.dut.rst_250mhz.value = 1
-        self.dut.ptp_rst.setimmediatevalue(1)
-        self.dut.sfp_rx_rst.setimmediatevalue(1)
-        self.dut.sfp_tx_rst.setimmediatevalue(1)
-
-        await RisingEdge(self.dut.clk_250mhz)
-        await RisingEdge(self.dut.clk_250mhz)
-
-        self.dut.rst_250mhz.value = 0
-        self.dut.ptp_rst.setimmediatevalue(0)
-        self.dut.sfp_rx_rst.setimmediatevalue(0)
-        self.dut.sfp_tx_rst.setimmediatevalue(0)
-
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk_250mhz)
-
-            if self.loopback_enable:
-                if not self.sfp_sink.empty():
-                    await self.sfp_source.send(await self.sfp_sink.recv())
+        self.init_loopback([(self.sfp_sink, self.sfp_source)])
 
 
 @cocotb.test()
@@ -121,19 +61,7 @@ async def run_test_nic(dut):
 
     await tb.init()
 
-    tb.log.info("Init driver")
-    await tb.driver.init_axi_dev(tb.pool, tb.hw_regs, irq=dut.irq)
-    await tb.driver.interfaces[0].open()
-
-    # enable queues
-    tb.log.info("Enable queues")
-    await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
-    for k in range(len(tb.driver.interfaces[0].txq)):
-        await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
-
-    # wait for all writes to complete
-    await tb.driver.hw_regs.read_dword(0)
-    tb.log.info("Init complete")
+    await tb.init_driver(interfaces=[0])
 
     tb.log.info("Send and receive single packet")
 
@@ -179,7 +107,7 @@ async def run_test_nic(dut):
 
     data = bytearray([x % 256 for x in range(1024)])
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, k)
@@ -192,7 +120,7 @@ async def run_test_nic(dut):
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
         assert pkt.queue == k
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, 0)
 
@@ -203,7 +131,7 @@ async def run_test_nic(dut):
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, k, k)
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     queues = set()
 
@@ -229,7 +157,7 @@ async def run_test_nic(dut):
 
     assert len(queues) == 4
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_rss_mask(0, 0)
 
@@ -239,7 +167,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -251,7 +179,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple large packets")
 
@@ -259,7 +187,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -271,7 +199,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     if tb.driver.interfaces[0].if_feature_lfc:
         tb.log.info("Test LFC pause frame RX")
@@ -287,7 +215,7 @@ async def run_test_nic(dut):
 
         pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         for p in pkts:
             await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -300,7 +228,7 @@ async def run_test_nic(dut):
             if tb.driver.interfaces[0].if_feature_rx_csum:
                 assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     await RisingEdge(dut.clk_250mhz)
     await RisingEdge(dut.clk_250mhz)
@@ -527,7 +455,7 @@ def test_fpga_core(request):
     sim_build = os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
-    cocotb_test.simulator.run(
+    mqnic_tb.run_sim(
         python_search=[tests_dir],
         verilog_sources=verilog_sources,
         toplevel=toplevel,
@@ -0,0 +1 @@
+../../../../../common/tb/mqnic_sim_cache.py
\ No newline at end of file
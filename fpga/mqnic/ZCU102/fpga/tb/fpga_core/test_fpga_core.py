@@ -1,7 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause-Views
 # Copyright (c) 2020-2023 The Regents of the University of California
 
-import logging
 import os
 import struct
 import sys
@@ -10,67 +9,42 @@ import scapy.utils
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP, UDP
 
-import cocotb_test.simulator
-
 import cocotb
-from cocotb.log import SimLog
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
 
-from cocotbext.axi import AddressSpace
-from cocotbext.axi import AxiLiteMaster, AxiLiteBus
-from cocotbext.axi import AxiSlave, AxiBus
-from cocotbext.eth import XgmiiSource, XgmiiSink, XgmiiFrame
+from cocotbext.eth import XgmiiFrame
 
 try:
     import mqnic
+    import mqnic_tb
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
         import mqnic
+        import mqnic_tb
     finally:
         del sys.path[0]
 
 
-class TB(object):
+class TB(mqnic_tb.BaseTB):
     def __init__(self, dut):
-        self.dut = dut
-
-        self.log = SimLog("cocotb.tb")
-        self.log.setLevel(logging.DEBUG)
-
-        cocotb.start_soon(Clock(dut.clk_300mhz, 3332, units="ps").start())
+        super().__init__(dut)
 
         # AXI
-        self.address_space = AddressSpace()
-        self.pool = self.address_space.create_pool(0, 0x8000_0000)
-
-        self.axil_master = AxiLiteMaster(AxiLiteBus.from_prefix(dut, "s_axil_ctrl"), dut.clk_300mhz, dut.rst_300mhz)
-        self.address_space.register_region(self.axil_master, 0x10_0000_0000)
-        self.hw_regs = self.address_space.create_window(0x10_0000_0000, self.axil_master.size)
-
-        self.axi_slave = AxiSlave(AxiBus.from_prefix(dut, "m_axi"), dut.clk_300mhz, dut.rst_300mhz, self.address_space)
+        self.init_axi_host(dut.clk_300mhz, dut.rst_300mhz, period=3.332)
 
-        self.driver = mqnic.Driver()
-
-        cocotb.start_soon(Clock(dut.ptp_clk, 6.4, units="ns").start())
-        dut.ptp_rst.setimmediatevalue(0)
-        cocotb.start_soon(Clock(dut.ptp_sample_clk, 8, units="ns").start())
+        self.init_ptp_clk(6.4)
 
         # Ethernet
         self.sfp_source = []
         self.sfp_sink = []
 
         for k in range(4):
-            cocotb.start_soon(Clock(getattr(dut, f"sfp{k}_rx_clk"), 6.4, units="ns").start())
-            source = XgmiiSource(getattr(dut, f"sfp{k}_rxd"), getattr(dut, f"sfp{k}_rxc"), getattr(dut, f"sfp{k}_rx_clk"), getattr(dut, f"sfp{k}_rx_rst"))
+            source, sink = self.init_xgmii_port(dut, f"sfp{k}_", period=6.4)
             self.sfp_source.append(source)
-            cocotb.start_soon(Clock(getattr(dut, f"sfp{k}_tx_clk"), 6.4, units="ns").start())
-            sink = XgmiiSink(getattr(dut, f"sfp{k}_txd"), getattr(dut, f"sfp{k}_txc"), getattr(dut, f"sfp{k}_tx_clk"), getattr(dut, f"sfp{k}_tx_rst"))
             self.sfp_sink.append(sink)
-            getattr(dut, f"sfp{k}_rx_status").setimmediatevalue(1)
-            getattr(dut, f"sfp{k}_rx_error_count").setimmediatevalue(0)
 
         cocotb.start_soon(Clock(dut.sfp_drp_clk, 8, units="ns").start())
         dut.sfp_drp_rst.setimmediatevalue(0)
@@ -84,43 +58,7 @@ class TB(object):
         dut.btnc.setimmediatevalue(0)
         dut.sw.setimmediatevalue(0)
 
-        self.loopback_enable = False
-        cocotb.start_soon(self._run_loopback())
-
-    async def init(self):
-
-        self.dut.rst_300mhz.setimmediatevalue(0)
-        self.dut.ptp_rst.setimmediatevalue(0)
-        for k in range(4):
-            getattr(self.dut, f"sfp{k}_rx_rst").setimmediatevalue(0)
-            getattr(self.dut, f"sfp{k}_tx_rst").setimmediatevalue(0)
-
-        await RisingEdge(self.dut.clk_300mhz)
-        await RisingEdge(self.dut.clk_300mhz)
-
-        self.dut.rst_300mhz.value = 1
-        self.dut.ptp_rst.setimmediatevalue(1)
-        for k in range(4):
-            getattr(self.dut, f"sfp{k}_rx_rst").setimmediatevalue(1)
-            getattr(self.dut, f"sfp{k}_tx_rst").setimmediatevalue(1)
-
-        await RisingEdge(self.dut.clk_300mhz)
-        await RisingEdge(self.dut.clk_300mhz)
-
-        self.dut.rst_300mhz.value = 0
-        self.dut.ptp_rst.setimmediatevalue(0)
-        for k in range(4):
-            getattr(self.dut, f"sfp{k}_rx_rst").setimmediatevalue(0)
-            getattr(self.dut, f"sfp{k}_tx_rst").setimmediatevalue(0)
-
-    async def _run_loopback(self):
-        while True:
-            await RisingEdge(self.dut.clk_300mhz)
-
-            if self.loopback_enable:
-                for x in range(len(self.sfp_sink)):
-                        if not self.sfp_sink[x].empty():
-                            await self.sfp_source[x].send(await self.sfp_sink[x].recv())
+        self.init_loopback(list(zip(self.sfp_sink, self.sfp_source)))
 
 
 @cocotb.test()
@@ -130,20 +68,7 @@ async def run_test_nic(dut):
 
     await tb.init()
 
-    tb.log.info("Init driver")
-    await tb.driver.init_axi_dev(tb.pool, tb.hw_regs, irq=dut.irq)
-    await tb.driver.interfaces[0].open()
-    # await tb.driver.interfaces[1].open()
-
-    # enable queues
-    tb.log.info("Enable queues")
-    await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].rb.write_dword(mqnic.MQNIC_RB_SCHED_RR_REG_CTRL, 0x00000001)
-    for k in range(len(tb.driver.interfaces[0].txq)):
-        await tb.driver.interfaces[0].sched_blocks[0].schedulers[0].hw_regs.write_dword(4*k, 0x00000003)
-
-    # wait for all writes to complete
-    await tb.driver.hw_regs.read_dword(0)
-    tb.log.info("Init complete")
+    await tb.init_driver(interfaces=[0])
 
     tb.log.info("Send and receive single packet")
 
@@ -201,7 +126,7 @@ async def run_test_nic(dut):
 
     data = bytearray([x % 256 for x in range(1024)])
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, k)
@@ -214,7 +139,7 @@ async def run_test_nic(dut):
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
         assert pkt.queue == k
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, 0, 0)
 
@@ -225,7 +150,7 @@ async def run_test_nic(dut):
     for k in range(4):
         await tb.driver.interfaces[0].set_rx_queue_map_indir_table(0, k, k)
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     queues = set()
 
@@ -251,7 +176,7 @@ async def run_test_nic(dut):
 
     assert len(queues) == 4
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     await tb.driver.interfaces[0].set_rx_queue_map_rss_mask(0, 0)
 
@@ -261,7 +186,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(60)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -273,7 +198,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     tb.log.info("Multiple large packets")
 
@@ -281,7 +206,7 @@ async def run_test_nic(dut):
 
     pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-    tb.loopback_enable = True
+    tb.loopback.enable = True
 
     for p in pkts:
         await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -293,7 +218,7 @@ async def run_test_nic(dut):
         assert pkt.data == pkts[k]
         assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-    tb.loopback_enable = False
+    tb.loopback.enable = False
 
     if tb.driver.interfaces[0].if_feature_lfc:
         tb.log.info("Test LFC pause frame RX")
@@ -309,7 +234,7 @@ async def run_test_nic(dut):
 
         pkts = [bytearray([(x+k) % 256 for x in range(1514)]) for k in range(count)]
 
-        tb.loopback_enable = True
+        tb.loopback.enable = True
 
         for p in pkts:
             await tb.driver.interfaces[0].start_xmit(p, 0)
@@ -322,7 +247,7 @@ async def run_test_nic(dut):
             if tb.driver.interfaces[0].if_feature_rx_csum:
                 assert pkt.rx_checksum == ~scapy.utils.checksum(bytes(pkt.data[14:])) & 0xffff
 
-        tb.loopback_enable = False
+        tb.loopback.enable = False
 
     await RisingEdge(dut.clk_300mhz)
     await RisingEdge(dut.clk_300mhz)
@@ -549,7 +474,7 @@ def test_fpga_core(request):
     sim_build = os.path.join(tests_dir, "sim_build",
         request.node.name.replace('[', '-').replace(']', ''))
 
-    cocotb_test.simulator.run(
+    mqnic_tb.run_sim(
         python_search=[tests_dir],
         verilog_sources=verilog_sources,
         toplevel=toplevel,